@@ -10,6 +10,7 @@ import time
 
 import utils
 import logs
+import procfs
 import cpu_load_wd_config
 import global_config
 
@@ -66,25 +67,18 @@ class WDThread(threading.Thread):
             self._stop_event.set()
         #self._log.info('Leaving _check_cpu_load()')   
 
-    # Get the 5 minute cpu load average using
-    # using the uptime shell command
+    # Get the 5 minute cpu load average
+    # from /proc/loadavg
     def _get_5_min_cpu_load(self):
         #self._log.info('Entering _get_5_min_cpu_load()')
-        (output, error) = utils.call_subprocess('uptime')
-        #self._log.info('  uptime cmd output is %s ' % output)
-        fields = output.split()
-        num_fields = len(fields)
-        load_index = num_fields - 2
-        if load_index < 0:
-            self._log.error('uptime parsing error, not enough fields')
+        loads = procfs.read_loadavg()
+        if loads is None:
+            self._log.error('Could not read /proc/loadavg')
             #self._log.error('Leaving _get_5_min_cpu_load()')
             return 0.0
-        load_str = fields[load_index]
-        #self._log.info('  load_str is %s ' % load_str)
-        load_str = load_str.replace(",", "")
-        #self._log.info('  returning %f ' % float(load_str))
+        #self._log.info('  returning %f ' % loads[1])
         #self._log.info('Leaving _get_5_min_cpu_load()')
-        return float(load_str)
+        return loads[1]
               
     def is_running(self):
         return self._running
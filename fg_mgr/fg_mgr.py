@@ -104,13 +104,9 @@ class DataThread(threading.Thread):
             self._stop_event.set()
             
         self._log.info('Waiting for UTC synchronization')
-        hw_mgr_server = None
-        dummy_lock = utils.Lock(self._log)
-        while not self._stop_event.isSet():
-            [utc_sync_age, hw_mgr_server] = utils.get_hw_status('sync_age', hw_mgr_server, dummy_lock, self._log)
-            if (utc_sync_age is not None) and (utc_sync_age < 10000):
-                break
-            utils.wait(0.5)
+        # hw_mgr answers when a refresh brings sync_age below 10000
+        utils.wait_for_hw_status('sync_age', '<', 10000,
+                                stop_event=self._stop_event, log=self._log)
         if not self._stop_event.isSet(): 
             self._log.info('Synchronized with UTC')
             self._port.flushInput()          
@@ -14,27 +14,21 @@ import file_svr_config
 import global_config
 
 
-class ClientConnection(threading.Thread):
+class ClientConnection(utils.BaseThread):
     """Handle a single file server client"""
     def __init__(self, sock_h, log, exit_callback=None):
-        threading.Thread.__init__(self)
+        utils.BaseThread.__init__(self)
         self._sock_h = sock_h
         self._log = log
         self._exit_callback = exit_callback
-        self.setDaemon(False)
-        self._stop_event = threading.Event()
+        self._stop_event = utils.Wakeup()
         self.name = 'ClientConnection thread'
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
             
     def run(self):
         """The actual thread code"""
         #self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         
         self._manage_file_xfer(self._sock_h)
             
@@ -112,7 +106,8 @@ class ClientConnection(threading.Thread):
         max_rx_buf_len = 200
         rx_buf = ''
         while not self._shut_down_is_pending():
-            rx_bytes = utils.q_get(self._sock_h.get_read_q(), timeout_secs)
+            rx_bytes = utils.q_get(self._sock_h.get_read_q(), timeout_secs,
+                                    wakeup=self._stop_event)
             if rx_bytes is None:
                 continue    # timed out
             rx_buf += rx_bytes
@@ -155,46 +150,41 @@ class ClientConnection(threading.Thread):
         """Stop this thread """
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
         
         
-class ClientConnector(threading.Thread):
+class ClientConnector(utils.BaseThread):
     """Handle client connection requests"""
     def __init__(self, host, log, exit_callback=None):
-        threading.Thread.__init__(self)
+        utils.BaseThread.__init__(self)
         self._log = log
         self._exit_callback = exit_callback
-        self.setDaemon(False)
         self._host = host
         self._port = global_config.file_server_port
         self._children = []
         self._children_lock = threading.Lock()
+        self._listener = None
         self._stop_event = threading.Event()
         self.name = '%s ClientConnector thread'
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                                         
     def run(self):
         """The actual thread code"""
         #self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
+        self._listener = sock_utils.SockListener(self._log, self._host, self._port)
         while not self._stop_event.isSet():
-            sock, addr, connected_flag = \
-                    sock_utils.connect_to_client(self._log,
-                                                self._host,
-                                                self._port,
-                                                self._stop_event)                    
+            sock, addr = self._listener.accept()
+            if sock is None:
+                continue
             if self._stop_event.isSet():
+                utils.close_sock(sock)
                 continue
             sock_handler = sock_utils.SockHandler(sock,
                                      self._log,
                                      log_all_data=False,
-                                     read_data_q=Queue.Queue(),
-                                     write_data_q=Queue.Queue(),
+                                     read_data_q=sock_utils.new_sock_q(),
+                                     write_data_q=sock_utils.new_sock_q(),
                                      hand_exit_callback=None,
                                      type='stream')
             self._children_lock.acquire()
@@ -204,6 +194,7 @@ class ClientConnector(threading.Thread):
                                                                 
         self._running = False
         #self._log.debug('Stopping %s ' % self.name)
+        self._listener.close()
         for ch in self._children:
             ch.stop()
         if self._exit_callback:
@@ -225,9 +216,10 @@ class ClientConnector(threading.Thread):
         #self._log.debug('ClientConnector: entering stop()')
         if self._running:
             self._stop_event.set()
-            # Issue dummy connection request so connect_to_client() returns
-            sock_utils.dummy_connection(self._host, self._port)
-            self.join()
+            if self._listener is not None:
+                # wake the accept() wait
+                self._listener.close()
+            self._join()
             
                 
 def _run_svr(log):
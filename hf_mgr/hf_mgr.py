@@ -11,6 +11,7 @@ import xmlrpclib
 
 import utils
 import logs
+import procfs
 import usb_mgr_config
 import hf_mgr_config
 import global_config
@@ -337,13 +338,9 @@ class HFMgrThread(threading.Thread):
         return False
         
     def _wait_for_UTC_sync(self):
-        hw_mgr_server = None
-        dummy_lock = utils.Lock(self._log)
-        while not self._stop_event.isSet():
-            [utc_sync_age, hw_mgr_server] = utils.get_hw_status('sync_age', hw_mgr_server, dummy_lock, self._log)
-            if (utc_sync_age is not None) and (utc_sync_age < 10000):
-                break
-            utils.wait(0.5)
+        # hw_mgr answers when a refresh brings sync_age below 10000
+        utils.wait_for_hw_status('sync_age', '<', 10000,
+                                stop_event=self._stop_event, log=self._log)
         
     def _store_rx_buf(self):
         if len(self._rx_buf_list) == 0:
@@ -412,18 +409,7 @@ class HFMgrThread(threading.Thread):
         self._log.debug(self._port)
     
     def _get_cpu_serial_num(self):
-        cpu_sn = '?'
-        [s, stderr] = utils.call_subprocess('cat /proc/cpuinfo')
-        #self._log.debug('s = %s' % s)
-        lines = s.split('\n')
-        for line in lines:
-            #self._log.debug('line = %s' % line)
-            if line.find('Serial') != -1:
-                fields = line.split()
-                #self._log.debug('fields = %s' % repr(fields))
-                cpu_sn = fields[2]
-                break
-        return cpu_sn
+        return procfs.get_cpu_serial()
 
     def _get_fg_electronics_temp(self):
         """ Return the FG electronics temp.
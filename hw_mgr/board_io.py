@@ -0,0 +1,419 @@
+# Board I/O backends for hw_mgr
+#
+# There are three exposed classes:
+#     SbcctlServer
+#     SbcctlFork
+#     SimBoard
+#
+# and one exposed function:
+#     open_backend
+#
+# Each backend runs sbcctl commands, given as strings without the
+# executable name, e.g. 'setpin DIO1 0 on' or 'status'.
+# run(cmds) runs a batch of commands and returns the list of
+# their outputs, stdout and stderr together as with the shell's
+# 2>&1, or None if the board could not be reached.  run_one(cmd)
+# runs a single command.
+#
+# SbcctlServer keeps one 'sbcctl serve' co-process, which opens
+# the board once and reads commands from a pipe.  A batch is
+# written in one write.  If the co-process dies (sbcctl gives each
+# command 20 seconds) it is started again.
+#
+# SbcctlFork forks sbcctl through the shell for each command, as
+# hw_mgr always did.  It is used when the sbcctl on the board
+# does not have the serve command.
+#
+# SimBoard simulates the TS-7260 DIO, power, LED and ADC
+# registers, and prints status in sbcctl's format, so hw_mgr can
+# be run and timed on a Linux desktop.  Run as a program, this
+# module is a simulated sbcctl:
+#     python board_io.py <command> [options]
+#     python board_io.py serve
+
+import sys
+import time
+import threading
+import subprocess
+
+import utils
+
+SERVE_END_MARKER = '** Finished **'
+
+
+class SbcctlServer:
+    """
+        Run sbcctl commands in a long lived 'sbcctl serve'
+        co-process
+
+        exe = sbcctl executable, a string or a list of
+              program and arguments
+        Raise IOError if the co-process does not answer.
+    """
+    def __init__(self, exe, log):
+        if isinstance(exe, str):
+            exe = [exe]
+        self._exe = list(exe)
+        self._log = log
+        self._lock = threading.Lock()
+        self._proc = None
+        self.starts = 0
+        self._start()
+
+    def _start(self):
+        """Start the co-process and wait for it to answer"""
+        self._stop_proc()
+        self._proc = subprocess.Popen(self._exe + ['serve'],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    close_fds=True)
+        self.starts += 1
+        # an empty line is answered with the end marker
+        self._exchange([''])
+
+    def _exchange(self, cmds):
+        """Send commands, return their outputs"""
+        proc = self._proc
+        lines = [cmd.replace('\n', ' ') for cmd in cmds]
+        proc.stdin.write('\n'.join(lines) + '\n')
+        proc.stdin.flush()
+        outputs = []
+        for cmd in cmds:
+            output = []
+            while True:
+                line = proc.stdout.readline()
+                if not line:
+                    raise IOError, 'sbcctl serve exited'
+                line = line.rstrip('\n')
+                if line == SERVE_END_MARKER:
+                    break
+                output.append(line)
+            outputs.append('\n'.join(output))
+        return outputs
+
+    def run(self, cmds):
+        """Run a batch of commands, return the list of their outputs
+
+        Return None if sbcctl failed twice.
+        """
+        self._lock.acquire()
+        try:
+            for attempt in (1, 2):
+                try:
+                    if self._proc is None:
+                        self._start()
+                    return self._exchange(cmds)
+                except (IOError, OSError), e:
+                    self._log.error('SbcctlServer: %s, restarting sbcctl' % e)
+                    self._stop_proc()
+            return None
+        finally:
+            self._lock.release()
+
+    def run_one(self, cmd):
+        outputs = self.run([cmd])
+        if outputs is None:
+            return None
+        return outputs[0]
+
+    def _stop_proc(self):
+        proc = self._proc
+        self._proc = None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        # sbcctl exits at end of input, unless it is stuck
+        for i in range(20):
+            if proc.poll() is not None:
+                break
+            utils.wait(0.05)
+        else:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+            proc.wait()
+        proc.stdout.close()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._stop_proc()
+        finally:
+            self._lock.release()
+
+
+class SbcctlFork:
+    """
+        Fork sbcctl for each command
+
+        lock = None or the lock held while forking
+    """
+    def __init__(self, exe, log, lock=None):
+        if not isinstance(exe, str):
+            exe = ' '.join(exe)
+        self._exe = exe
+        self._log = log
+        self._lock = lock
+
+    def run(self, cmds):
+        outputs = []
+        for cmd in cmds:
+            output = self.run_one(cmd)
+            if output is None:
+                return None
+            outputs.append(output)
+        return outputs
+
+    def run_one(self, cmd):
+        if self._lock is not None:
+            self._lock.acquire()
+        try:
+            (con_out, con_err) = utils.call_subprocess(' '.join([self._exe, cmd]))
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+        if (con_out is None) and (con_err is None):
+            return None
+        return con_out
+
+    def close(self):
+        pass
+
+
+class SimBoard:
+    """
+        Simulated TS-7260 board with the router board ADC inputs
+
+        The analog inputs are in volts, set with set_router_v()
+        and set_ep9301_v().
+    """
+    DIO_NUM_PINS = {'dio1': 7, 'dio2': 8}
+    JUMPERS = (2, 3, 4, 5, 6)
+    SPEEDS = ('min', '42', '166', 'max')
+
+    def __init__(self, log=None):
+        self._log = log
+        self._lock = threading.Lock()
+        self.pins = {'dio1': 0, 'dio2': 0}
+        self.dirs = {'dio1': 0, 'dio2': 0}
+        self.power = {'ethernet': 1, 'usb': 1, 'pc104': 0, 'rs232': 1}
+        self.leds = {'red': 0, 'green': 0}
+        self.cpu_speed = 'max'
+        self.jumpers = dict([(jp, 0) for jp in SimBoard.JUMPERS])
+        self.temp_c = 25.0
+        self.ep9301_v = [0.0] * 5
+        # batt 1-3 temps, batt 1-3 volts, router temp, input current
+        self.router_v = [2.5, 2.5, 2.5, 2.87, 2.87, 2.87, 2.5, 0.3]
+        self.commands = 0
+        self._cmds = {'status': (0, self._status),
+                      'setdir': (3, self._set_dir),
+                      'setdirs': (2, self._set_dirs),
+                      'setpin': (3, self._set_pin),
+                      'setpins': (2, self._set_pins),
+                      'setled': (2, self._set_led),
+                      'led': (2, self._set_led),
+                      'ethernet': (1, self._set_power),
+                      'usb': (1, self._set_power),
+                      'pc104': (1, self._set_power),
+                      'rs232': (1, self._set_power),
+                      'cpu': (1, self._set_cpu),
+                      'help': (0, self._help)}
+
+    def set_router_v(self, channel, volts):
+        self._lock.acquire()
+        self.router_v[channel] = volts
+        self._lock.release()
+
+    def set_ep9301_v(self, channel, volts):
+        self._lock.acquire()
+        self.ep9301_v[channel] = volts
+        self._lock.release()
+
+    def run(self, cmds):
+        return [self.run_one(cmd) for cmd in cmds]
+
+    def run_one(self, cmd):
+        option = cmd.lower().split()
+        if not option:
+            return ''
+        out = []
+        self._lock.acquire()
+        try:
+            self.commands += 1
+            if option[0] not in self._cmds:
+                out.append('Command not recognized: %s' % option[0])
+                out.append('  (Use "help" for a list of valid commands)')
+                ok = False
+            elif len(option) <= self._cmds[option[0]][0]:
+                out.append('Not enough parameters')
+                ok = False
+            else:
+                try:
+                    ok = self._cmds[option[0]][1](option, out)
+                except ValueError:
+                    ok = False
+        finally:
+            self._lock.release()
+        if not ok:
+            out.append('Error')
+        return '\n'.join(out)
+
+    def _state(self, value):
+        return int(value in ('on', '1'))
+
+    def _port(self, name, out):
+        if name not in self.pins:
+            out.append('Unknown port')
+            return None
+        return name
+
+    def _set_bit(self, regs, port, pin, value):
+        if value:
+            regs[port] |= 1 << pin
+        else:
+            regs[port] &= ~(1 << pin)
+
+    def _set_dir(self, option, out):
+        if option[3] not in ('in', 'out'):
+            out.append('Unknown direction: %s' % option[3])
+            return False
+        port = self._port(option[1], out)
+        if port is None:
+            return False
+        self._set_bit(self.dirs, port, int(option[2], 0), option[3] == 'out')
+        return True
+
+    def _set_dirs(self, option, out):
+        port = self._port(option[1], out)
+        if port is None:
+            return False
+        self.dirs[port] = int(option[2], 0)
+        return True
+
+    def _set_pin(self, option, out):
+        port = self._port(option[1], out)
+        if port is None:
+            return False
+        self._set_bit(self.pins, port, int(option[2], 0), self._state(option[3]))
+        return True
+
+    def _set_pins(self, option, out):
+        port = self._port(option[1], out)
+        if port is None:
+            return False
+        self.pins[port] = int(option[2], 0)
+        return True
+
+    def _set_led(self, option, out):
+        if option[1] == 'red':
+            self.leds['red'] = self._state(option[2])
+        else:
+            self.leds['green'] = self._state(option[2])
+        return True
+
+    def _set_power(self, option, out):
+        self.power[option[0]] = self._state(option[1])
+        return True
+
+    def _set_cpu(self, option, out):
+        if option[1] not in SimBoard.SPEEDS:
+            out.append('Unknown speed: %s' % option[1])
+            return False
+        self.cpu_speed = option[1]
+        return True
+
+    def _help(self, option, out):
+        out.append('SBC Control Program, simulated')
+        out.append('Commands: %s' % ' '.join(sorted(self._cmds.keys())))
+        return True
+
+    def _status(self, option, out):
+        hasadc = not ((len(option) == 2) and (option[1] == 'noadc'))
+        out.append('[metadata]')
+        out.append('version: sim')
+        out.append('timestamp: %s' % time.strftime('%Y-%m-%d %H:%M:%S'))
+        for port in ('dio1', 'dio2'):
+            out.append('[%s]' % port.upper())
+            num_pins = SimBoard.DIO_NUM_PINS[port]
+            dirs = self.dirs[port]
+            out.append('pins.input:' + ''.join([' %d' % pin for pin in range(num_pins)
+                                                if not (dirs & (1 << pin))]))
+            out.append('pins.output:' + ''.join([' %d' % pin for pin in range(num_pins)
+                                                if dirs & (1 << pin)]))
+            for pin in range(num_pins):
+                out.append('Pin %d: %d' % (pin, (self.pins[port] >> pin) & 1))
+        out.append('[jumpers]')
+        for jp in SimBoard.JUMPERS:
+            out.append('%d: %d' % (jp, self.jumpers[jp]))
+        out.append('[temp]')
+        out.append('temp_c: %f' % self.temp_c)
+        if hasadc:
+            out.append('[EP9301]')
+            for channel, volts in enumerate(self.ep9301_v):
+                out.append('channel.%d: %3.3f V' % (channel, volts))
+            out.append('[router]')
+            for channel, volts in enumerate(self.router_v):
+                out.append('router.%d: %3.3f V' % (channel, volts))
+            # reading the router inputs leaves the mux at input 7
+            self.pins['dio2'] |= 7
+        out.append('[power]')
+        for name in ('ethernet', 'usb', 'pc104', 'rs232'):
+            out.append('%s: %d' % (name, self.power[name]))
+        out.append('led.red: %d' % self.leds['red'])
+        out.append('led.green: %d' % self.leds['green'])
+        out.append('cpu: %s' % self.cpu_speed)
+        return True
+
+    def serve(self, infile, outfile):
+        """Answer sbcctl serve requests until end of input"""
+        while True:
+            line = infile.readline()
+            if not line:
+                break
+            output = self.run_one(line)
+            if output:
+                outfile.write(output + '\n')
+            outfile.write(SERVE_END_MARKER + '\n')
+            outfile.flush()
+
+    def close(self):
+        pass
+
+
+def open_backend(kind, exe, log, lock=None):
+    """Return a board I/O backend
+
+    kind = 'server' | 'fork' | 'sim'
+    exe = sbcctl executable
+    lock = None or the lock held while forking sbcctl
+    A 'server' falls back to forking sbcctl if the co-process
+    does not answer, e.g. with an sbcctl older than version 2.3.
+    """
+    if kind == 'sim':
+        log.info('Using the simulated board')
+        return SimBoard(log)
+    if kind == 'server':
+        try:
+            return SbcctlServer(exe, log)
+        except (IOError, OSError), e:
+            log.error('Could not start sbcctl serve, forking sbcctl for each command.  %s' % e)
+    return SbcctlFork(exe, log, lock)
+
+
+def get_sim_exe():
+    """Return the command that runs this module as a simulated sbcctl"""
+    return [sys.executable, __file__.replace('.pyc', '.py')]
+
+
+if __name__ == '__main__':
+    board = SimBoard()
+    if sys.argv[1:] == ['serve']:
+        board.serve(sys.stdin, sys.stdout)
+    else:
+        output = board.run_one(' '.join(sys.argv[1:]))
+        if output:
+            print output
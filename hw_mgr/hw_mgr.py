@@ -8,9 +8,13 @@ import xmlrpclib
 import math
 import time
 import copy
+import operator
 
 import utils
 import logs
+import status_shm
+import board_io
+import procfs
 import global_config
 import fg_mgr_config
 import hw_mgr_config
@@ -20,6 +24,10 @@ from SockConsole import SockConsole
 
 # Global Status Dictionary
 status = {}
+
+# Shared memory copy of the status dict,
+#  None if not published
+status_table = None
             
 # Some global values used to speed up
 #  temperature calculations
@@ -35,6 +43,9 @@ adc_gain = 1.0
 # Global subprocess mutex
 subprocess_lock = None
 
+# Board I/O backend, runs the sbcctl commands
+board = None
+
 def garmin_to_degs(garm):
     """Convert a Garmin format lat or long into
     a floating pt number of degrees
@@ -59,48 +70,67 @@ def refresh_status(console, log):
     refresh_sys_time_status(log)
     #log.debug('Calling refresh_uptime_status()')   
     refresh_uptime_status(log)
+    publish_status(log)
       
 
+def publish_status(log):
+    """Copy the global status dict to the shared memory table"""
+    global status_table
+    if status_table is None:
+        return
+    try:
+        status_table.publish(status)
+    except Exception, e:
+        log.error('Could not publish the status table, stopped publishing.  %s' % e)
+        status_table.close()
+        status_table = None
+    
+
+def _open_status_table(log):
+    """Create the shared memory status table"""
+    global status_table
+    if not hw_mgr_config.status_shm_enable:
+        return
+    try:
+        status_table = status_shm.StatusTable(hw_mgr_config.status_shm_file,
+                                                status.keys())
+    except Exception, e:
+        log.error('Could not create status table %s.  %s' % \
+                    (hw_mgr_config.status_shm_file, e))
+        return
+    publish_status(log)
+    
+    
+def _close_status_table():
+    global status_table
+    if status_table is not None:
+        status_table.close()
+        status_table = None
+    
+
 def refresh_uptime_status(log):
     """Update uptime, mem usage and CPU load status"""
     global status
-    global subprocess_lock
     
-    subprocess_lock.acquire()
-    [uptime, stderr] = utils.call_subprocess('uptime')
-    subprocess_lock.release()
-    status['uptime'] = uptime    
+    status['uptime'] = procfs.format_uptime()
 
 
 def refresh_sys_time_status(log):
     """Update the system time status"""
     global status
-    global subprocess_lock
     
-    subprocess_lock.acquire()
-    [time_stat, stderr] = utils.call_subprocess('cat /proc/gps_pps')
-    subprocess_lock.release()
-    # time_stat looks like:
-    #     Sync Age,Sys Time Error,Lat,Long
-    #     1284036102,0.0,0.0,0.0
-    # or:
-    #     Sync Age,Sys Time Error,Lat,Long
-    #     60,-0.996319,4217.6544,-08342.6943
     status['sync_age'] = 0
     status['sys_time_error'] = 0.0
     status['lat'] = 0.0
     status['long'] = 0.0
-    lines = time_stat.split('\n')
-    if len(lines) < 2:
+    time_stat = procfs.read_gps_pps()
+    if time_stat is None:
         # gps_pps driver not running
         return
-    if lines[0].split(',')[0] != 'Sync Age':
-        return
-    fields = lines[1].split(',')
-    status['sync_age'] = int(fields[0])
-    status['sys_time_error'] = float(fields[1])
-    status['lat'] = garmin_to_degs(float(fields[2]))
-    status['long'] = garmin_to_degs(float(fields[3]))
+    status['sync_age'] = time_stat['sync_age']
+    status['sys_time_error'] = time_stat['sys_time_error']
+    status['lat'] = garmin_to_degs(time_stat['lat'])
+    status['long'] = garmin_to_degs(time_stat['long'])
     
     
 def refresh_fg_status(log):
@@ -129,17 +159,12 @@ def refresh_sbcctl_status(log):
     """
     global status
     
-    executable = ''.join([global_config.field_bin_dir, '/sbcctl'])
-    subprocess_lock.acquire()
-    #log.debug('refresh_sbcctl_status(): Calling utils.call_subprocess')
-    (con_out, con_err) = utils.call_subprocess([executable, 'status'])
-    #log.debug('refresh_sbcctl_status(): Returned from utils.call_subprocess')
-    subprocess_lock.release()
-    if (con_out is None) and (con_err is None):
-        log.error('utils.subprocess failed')
+    #log.debug('refresh_sbcctl_status(): Calling board.run_one')
+    con_out = board.run_one('status')
+    #log.debug('refresh_sbcctl_status(): Returned from board.run_one')
+    if con_out is None:
+        log.error('sbcctl status failed')
         return
-    if con_err:
-        log.error('Error from sbcctl status command: %s' % con_err)
         
     #log.debug('refresh_sbcctl_status(): starting sbcctl output parsing')
     lines = con_out.split('\n')
@@ -353,21 +378,32 @@ def sbcctl_cmd(args, log):
     """Execute any sbcctl command.
     Does not return sbcctl console output
     args is a string of command arguments"""
+    sbcctl_cmds([args], log)
     
-    #log.debug('Entering sbcctl_cmd.  args = %s' % args)
-    executable = ''.join([global_config.field_bin_dir, '/sbcctl'])
-    exe_and_args = ' '.join([executable, args])
-    #log.debug('  exe_and_args = %s' % exe_and_args)
-    subprocess_lock.acquire()
-    (con_out, con_err) = utils.call_subprocess(exe_and_args)
-    subprocess_lock.release()
-    if (con_out is None) and (con_err is None):
-        log.error('utils.call_subprocess failed trying to execute: %s' % exe_and_args)
-        #log.debug('Exiting sbcctl_cmd')
+    
+def sbcctl_cmds(cmds, log):
+    """Execute a batch of sbcctl commands.
+    Does not return sbcctl console output
+    cmds is a list of command argument strings"""
+    
+    #log.debug('Entering sbcctl_cmds.  cmds = %s' % cmds)
+    outputs = board.run(cmds)
+    if outputs is None:
+        log.error('sbcctl failed trying to execute: %s' % '; '.join(cmds))
+        #log.debug('Exiting sbcctl_cmds')
         return
-    if con_err:
-        log.error('Error from %s command: %s' % (exe_and_args, con_err))
-    #log.debug('Exiting sbcctl_cmd')
+    for args, con_out in zip(cmds, outputs):
+        if 'Error' in con_out.split('\n'):
+            log.error('Error from sbcctl %s command: %s' % (args, con_out))
+    #log.debug('Exiting sbcctl_cmds')
+    
+
+def _open_board(log):
+    """Open the board I/O backend"""
+    global board
+    executable = ''.join([global_config.field_bin_dir, '/sbcctl'])
+    board = board_io.open_backend(hw_mgr_config.board_io, executable,
+                                    log, subprocess_lock)
                          
 
 def _init_adc_params(log):
@@ -376,21 +412,8 @@ def _init_adc_params(log):
     """
     global adc_offset
     global adc_gain
-    global subprocess_lock
     
-    cpu_sn = '?'
-    subprocess_lock.acquire()
-    [s, stderr] = utils.call_subprocess('cat /proc/cpuinfo')
-    subprocess_lock.release()
-    #log.debug('s = %s' % s)
-    lines = s.split('\n')
-    for line in lines:
-        #log.debug('line = %s' % line)
-        if line.find('Serial') != -1:
-            fields = line.split()
-            #log.debug('fields = %s' % repr(fields))
-            cpu_sn = fields[2]
-            break
+    cpu_sn = procfs.get_cpu_serial()
     if cpu_sn in hw_mgr_config.adc_params:
         adc_offset = hw_mgr_config.adc_params[cpu_sn][0]
         adc_gain = hw_mgr_config.adc_params[cpu_sn][1]
@@ -405,23 +428,158 @@ def _init_adc_params(log):
 
 def _init_digital_IO(log):
     # DIO1 bit directions are set in the dio1 driver.
-    # Set DIO2 bit directions.
-    sbcctl_cmd('setdir DIO2 0 out', log)
-    sbcctl_cmd('setdir DIO2 1 out', log)
-    sbcctl_cmd('setdir DIO2 2 out', log)
-    sbcctl_cmd('setdir DIO2 3 out', log)
-    sbcctl_cmd('setdir DIO2 4 in', log)
-    sbcctl_cmd('setdir DIO2 7 out', log)
-    
-    # Enable latched overcurrent detection
-    sbcctl_cmd('setpin DIO2 7 off', log)
-    
-    # Clear possible overcurrent condition
-    sbcctl_cmd('setpin DIO2 3 on', log)
+    # Set DIO2 bit directions,
+    # enable latched overcurrent detection and
+    # clear possible overcurrent condition.
+    sbcctl_cmds(['setdir DIO2 0 out',
+                 'setdir DIO2 1 out',
+                 'setdir DIO2 2 out',
+                 'setdir DIO2 3 out',
+                 'setdir DIO2 4 in',
+                 'setdir DIO2 7 out',
+                 'setpin DIO2 7 off',
+                 'setpin DIO2 3 on'], log)
     utils.wait(hw_mgr_config.over_cur_reset_dwell)
     sbcctl_cmd('setpin DIO2 3 off', log)
 
    
+# wait_for() predicate operators, status value op value
+_WAIT_OPS = {'<': operator.lt,
+             '<=': operator.le,
+             '>': operator.gt,
+             '>=': operator.ge,
+             '==': operator.eq,
+             '!=': operator.ne}
+             
+
+class _PushThread(utils.BaseThread):
+    """Send status changes to subscribers"""
+    def __init__(self, push_q, failed_callback, log):
+        utils.BaseThread.__init__(self)
+        self._push_q = push_q
+        self._failed_callback = failed_callback
+        self._log = log
+        self._stop_event = utils.Wakeup()
+        self.name = 'Status push thread'
+        self._start_and_wait()
+        
+    def run(self):
+        self._set_started()
+        while not self._stop_event.isSet():
+            item = utils.q_get(self._push_q, get_timeout=None,
+                                wakeup=self._stop_event)
+            if item is not None:
+                self._push(*item)
+        self._running = False
+        
+    def _push(self, callback_port, changes):
+        url = 'http://localhost:%d' % callback_port
+        try:
+            proxy = utils.get_XMLRPC_server_proxy(url, self._log,
+                                timeout=hw_mgr_config.push_timeout)
+            if proxy is None:
+                raise ValueError, 'no server proxy'
+            proxy.status_changed(changes)
+        except Exception, e:
+            self._log.error('Status push to %s failed, subscription dropped.  %s' % \
+                            (url, e))
+            self._failed_callback(callback_port)
+            
+            
+class StatusWatch:
+    """
+        Wakes the wait_for() calls and pushes status changes
+        to the subscribers after each refresh
+    """
+    def __init__(self, log):
+        self._log = log
+        self._lock = threading.Lock()
+        self._waiters = []          # a Wakeup per wait_for() call
+        self._subscribers = {}      # callback_port: (fields, values sent)
+        self._push_q = Queue.Queue()
+        self._push_thread = _PushThread(self._push_q, self.unsubscribe, log)
+        self.refreshes = 0
+        
+    def wait_for(self, field, op, value, timeout):
+        """Wait until status[field] op value is true
+        
+        Return [True, status value] when true,
+         [False, status value] at timeout.
+        """
+        test = _WAIT_OPS[op]
+        timeout = min(timeout, hw_mgr_config.wait_for_max_secs)
+        end_time = time.time() + timeout
+        wakeup = utils.Wakeup()
+        self._lock.acquire()
+        self._waiters.append(wakeup)
+        self._lock.release()
+        try:
+            while True:
+                wakeup.clear_poke()
+                current = status[field]
+                if test(current, value):
+                    return [True, current]
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return [False, current]
+                wakeup.wait_set(remaining)
+        finally:
+            self._lock.acquire()
+            self._waiters.remove(wakeup)
+            self._lock.release()
+            wakeup.close()
+            
+    def subscribe(self, fields, callback_port):
+        """Push the changed values of fields to callback_port
+            after each refresh
+            
+        Return a dict of the values now.  Subscribing again
+        replaces the subscription.
+        """
+        values = {}
+        for field in fields:
+            values[field] = status[field]
+        self._lock.acquire()
+        self._subscribers[callback_port] = (list(fields), dict(values))
+        self._lock.release()
+        return values
+            
+    def unsubscribe(self, callback_port):
+        self._lock.acquire()
+        self._subscribers.pop(callback_port, None)
+        self._lock.release()
+        
+    def _queue_changes(self, callback_port):
+        """Queue the changed values of a subscription, called
+            with the lock held
+        """
+        fields, sent = self._subscribers[callback_port]
+        changes = {}
+        for field in fields:
+            value = status[field]
+            if (field not in sent) or (sent[field] != value):
+                changes[field] = value
+                sent[field] = value
+        if changes:
+            self._push_q.put((callback_port, changes))
+        
+    def refreshed(self):
+        """Called after each status refresh"""
+        self._lock.acquire()
+        try:
+            self.refreshes += 1
+            for callback_port in self._subscribers.keys():
+                self._queue_changes(callback_port)
+            waiters = list(self._waiters)
+        finally:
+            self._lock.release()
+        for wakeup in waiters:
+            wakeup.poke()
+            
+    def stop(self):
+        self._push_thread.stop()
+    
+
 def _stop_dig_io():
     # Disables latched overcurrent detection
     sbcctl_cmd('setpin DIO2 7 on', log)    
@@ -434,6 +592,7 @@ class XMLRPCThread(BasicXMLRPCThread):
         self._log = log
         self._console = console
         self._exec_lock = utils.Lock(log)
+        self._watch = StatusWatch(log)
         self._server.register_function(self.help)
         self._server.register_function(self.set_power)
         self._server.register_function(self.reset_overcurrent)
@@ -441,6 +600,9 @@ class XMLRPCThread(BasicXMLRPCThread):
         self._server.register_function(self.get_status)
         self._server.register_function(self.get_full_status)
         self._server.register_function(self.refresh)
+        self._server.register_function(self.wait_for)
+        self._server.register_function(self.subscribe)
+        self._server.register_function(self.unsubscribe)
            
     def help(self):
         """ Show the available XMLRPC commands """
@@ -463,6 +625,13 @@ class XMLRPCThread(BasicXMLRPCThread):
                 '       Return a single status value\n',
                 '> get_full_status\n',
                 '       Return entire status dictionary\n',
+                '> wait_for <name_of_status_value> [<op>, <value>] <timeout>\n',
+                '       Wait until the status value op value is true\n',
+                '       op: < | <= | > | >= | == | !=\n',
+                '> subscribe [<name_of_status_value>, ...] <callback_port>\n',
+                '       Return the status values, and push their changes to\n',
+                '       status_changed() of the XMLRPC server at localhost:callback_port\n',
+                '> unsubscribe <callback_port>\n',
                 '> reset_overcurrent\n',
                 '       Reset a router board overcurrent condition\n',
                 '> dis\n',
@@ -528,9 +697,51 @@ class XMLRPCThread(BasicXMLRPCThread):
         #self._log.debug('calling refresh_status()')
         refresh_status(self._console, self._log)
         self._exec_lock.release()
+        self._watch.refreshed()
         #self._log.debug('Exiting refresh')
         return 'OK'
         
+    def wait_for(self, name_of_value, predicate, timeout):
+        """Wait until a status value meets a condition
+        
+        predicate = [op, value], true when status value op value
+        timeout = secs, at most hw_mgr_config.wait_for_max_secs
+        The value is tested again after each refresh.
+        Return [True, status value] when met,
+         [False, status value] at timeout.
+        """
+        try:
+            [op, value] = predicate
+            return self._watch.wait_for(name_of_value, op, value, timeout)
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            utils.log_exc_traceback(exc_type, exc_value, exc_traceback, self._log)
+            return 'failed'
+            
+    def subscribe(self, names_of_values, callback_port):
+        """Push status value changes to an XMLRPC server
+        
+        status_changed({name: value, ...}) of the XMLRPC server
+        at localhost:callback_port is called with the changed
+        values after each refresh.
+        Return a dict of the values now.
+        """
+        try:
+            return self._watch.subscribe(names_of_values, callback_port)
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            utils.log_exc_traceback(exc_type, exc_value, exc_traceback, self._log)
+            return 'failed'
+        
+    def unsubscribe(self, callback_port):
+        """Stop pushing status changes to callback_port"""
+        self._watch.unsubscribe(callback_port)
+        return 'OK'
+        
+    def stop(self):
+        BasicXMLRPCThread.stop(self)
+        self._watch.stop()
+        
     def status(self):
         """Write the current status it to the console"""
         #self._log.debug('Entering status')
@@ -636,6 +847,8 @@ def _run_mgr(log):
     log.info('****** Starting hardware manager ******')
     subprocess_lock = utils.Lock(log)
     _init_status()   
+    _open_status_table(log)
+    _open_board(log)
     _init_digital_IO(log)
     _init_adc_params(log)
     
@@ -681,18 +894,153 @@ def _run_mgr(log):
     _stop_dig_io()                   
     console.stop()
     xmlrpc_thread.stop()
+    board.close()
+    _close_status_table()
     utils.wait_for_child_threads()
     log.info('****** Exiting hardware manager ******')
     
     
+def _benchmark_transports(log, n_calls=500, port=44460):
+    """Time get_full_status over XMLRPC and the local RPC socket,
+        and a snapshot of the shared memory status table
+    
+    CPU times are for the whole process, client and server.
+    """
+    import os
+    _init_status()
+    xmlrpc_thread = XMLRPCThread('localhost', port, None, log)
+    url = 'http://localhost:%d' % port
+    def run(label, func):
+        start_cpu = os.times()
+        start_time = time.time()
+        for i in range(n_calls):
+            full_status = func()
+        secs = time.time() - start_time
+        cpu = [end - start for start, end in zip(start_cpu, os.times())]
+        assert full_status == status
+        print '%-28s %6.3f ms/call  user %6.3f  sys %6.3f ms/call' % \
+                (label, secs * 1000 / n_calls, cpu[0] * 1000 / n_calls,
+                    cpu[1] * 1000 / n_calls)
+    try:
+        print 'get_full_status, %d calls, %d values' % (n_calls, len(status))
+        run('XMLRPC, new proxy per call',
+                lambda: xmlrpclib.ServerProxy(url).get_full_status())
+        xml_proxy = xmlrpclib.ServerProxy(url, transport=utils.KeepAliveTransport())
+        run('XMLRPC, keep-alive', xml_proxy.get_full_status)
+        local_proxy = utils.LocalRPCProxy(utils.get_local_rpc_path(port), log)
+        run('local RPC socket', local_proxy.get_full_status)
+        local_proxy('close')()
+        xml_proxy('close')()
+        shm_file = '/tmp/hw_mgr_status_bench'
+        table = status_shm.StatusTable(shm_file, status.keys())
+        try:
+            table.publish(status)
+            reader = status_shm.StatusReader(shm_file)
+            run('shared memory table', lambda: reader.get_snapshot()[0])
+            reader.close()
+        finally:
+            table.close()
+    finally:
+        xmlrpc_thread.stop()
+    
+    
+def _benchmark_board_io(log, n_reps=20):
+    """Time sbcctl commands forked, in a co-process and in the
+        simulated board, and the hw_mgr API on the simulated board
+    
+    The forked and co-process sbcctl is board_io.py run as a
+    simulated sbcctl.
+    """
+    global board
+    global subprocess_lock
+    subprocess_lock = utils.Lock(log)
+    exe = board_io.get_sim_exe()
+    init_cmds = ['setdir DIO2 %d out' % pin for pin in (0, 1, 2, 3, 7)] + \
+                ['setdir DIO2 4 in', 'setpin DIO2 7 off', 'setpin DIO2 3 on']
+    def run(label, func):
+        start_time = time.time()
+        for i in range(n_reps):
+            func()
+        print '%-40s %8.3f ms' % (label, (time.time() - start_time) * 1000 / n_reps)
+    backends = [('forked sbcctl', board_io.SbcctlFork(exe, log, subprocess_lock)),
+                ('sbcctl serve co-process', board_io.SbcctlServer(exe, log)),
+                ('simulated board', board_io.SimBoard(log))]
+    for name, backend in backends:
+        run('%s: setpin' % name, lambda: backend.run_one('setpin DIO1 5 on'))
+        run('%s: status' % name, lambda: backend.run_one('status'))
+        run('%s: %d init commands' % (name, len(init_cmds)),
+                lambda: backend.run(init_cmds))
+        backend.close()
+    _init_status()
+    board = board_io.SimBoard(log)
+    xmlrpc_thread = XMLRPCThread('localhost', 44461, None, log)
+    try:
+        run('simulated board: set_power', lambda: xmlrpc_thread.set_power('htr', 'on'))
+        run('simulated board: refresh_sbcctl_status',
+                lambda: refresh_sbcctl_status(log))
+        run('refresh_uptime_status', lambda: refresh_uptime_status(log))
+        run('refresh_sys_time_status', lambda: refresh_sys_time_status(log))
+        assert status['htr_pwr'] == 1
+    finally:
+        xmlrpc_thread.stop()
+    
+    
+def _test_status_push(log, port=44462, callback_port=44463):
+    """Check that a utils.HwStatusSubscriber gets the changes
+        pushed after each refresh, on the simulated board
+    """
+    global board
+    global subprocess_lock
+    subprocess_lock = utils.Lock(log)
+    _init_status()
+    board = board_io.SimBoard(log)
+    xmlrpc_thread = XMLRPCThread('localhost', port, None, log)
+    pushed = Queue.Queue()
+    subscriber = utils.HwStatusSubscriber(['htr_pwr', 'gps_pwr'], callback_port,
+                            log, callback=pushed.put,
+                            url='http://localhost:%d' % port)
+    def refresh_and_get():
+        xmlrpc_thread.refresh()
+        try:
+            return pushed.get(timeout=5)
+        except Queue.Empty:
+            return None
+    try:
+        assert subscriber.get_value('htr_pwr') == 0
+        start_time = time.time()
+        xmlrpc_thread.set_power('htr', 'on')
+        changes = refresh_and_get()
+        print 'status push: %s after %.1f ms' % \
+                (changes, (time.time() - start_time) * 1000)
+        assert changes == {'htr_pwr': 1}
+        assert subscriber.get_value('htr_pwr') == 1
+        # nothing is pushed when nothing changed
+        xmlrpc_thread.refresh()
+        xmlrpc_thread.set_power('htr', 'off')
+        xmlrpc_thread.set_power('gps', 'on')
+        assert refresh_and_get() == {'htr_pwr': 0, 'gps_pwr': 1}
+        assert pushed.empty()
+        subscriber.close()
+        xmlrpc_thread.set_power('gps', 'off')
+        assert refresh_and_get() is None
+    finally:
+        xmlrpc_thread.stop()
+    
+    
 if __name__ == '__main__':
     sys.setcheckinterval(global_config.check_interval)
-    if hw_mgr_config.daemonize:
+    bench = (len(sys.argv) > 1) and (sys.argv[1] == 'bench')
+    if hw_mgr_config.daemonize and not bench:
         utils.daemonize()
     log = logs.open(hw_mgr_config.log_name,
                     hw_mgr_config.log_dir,
                     hw_mgr_config.log_level,
                     file_max_bytes = hw_mgr_config.log_file_max_bytes,
                     num_backup_files = hw_mgr_config.log_files_backup_files)
-    _run_mgr(log)
+    if bench:
+        _benchmark_transports(log)
+        _benchmark_board_io(log)
+        _test_status_push(log)
+    else:
+        _run_mgr(log)
 
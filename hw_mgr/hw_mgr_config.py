@@ -26,6 +26,27 @@ console_port =                  base_port + 0
 XMLRPC_port =                   base_port + 40
 XMLRPC_URL =                    ''.join(('http://localhost:', str(XMLRPC_port)))
 
+# Shared memory status table.
+# hw_mgr publishes its status dict to this file after each
+#  refresh.  utils.get_hw_status() and friends read it there,
+#  and use the XMLRPC methods when it is not available.
+status_shm_enable =             True
+status_shm_file =               '/dev/shm/hw_mgr_status'
+
+# Board I/O.
+#  'server' runs the sbcctl commands in one 'sbcctl serve'
+#     co-process, or forks sbcctl if it has no serve command.
+#  'fork' forks sbcctl for each command.
+#  'sim' simulates the board, to run hw_mgr on a desktop.
+board_io =                      'server'
+
+# Status waits and subscriptions.
+# A wait_for call waits at most wait_for_max_secs, less than
+#  the clients' 10 second RPC timeout, and the client calls
+#  again.  Pushes to subscribers time out after push_timeout.
+wait_for_max_secs =             5.0
+push_timeout =                  2.0
+
 # Miscellaneous
 accept_sigint =                 True
 daemonize =                     False
@@ -12,6 +12,11 @@ import traceback
 import cStringIO
 import select
 import sys
+import threading
+import socket
+import random
+import time
+import Queue
 
 import datefunc
 import modem_config
@@ -19,6 +24,8 @@ import lockfile
 import logs
 import utils
 import sock_utils
+import fec_utils
+from ProxyPkt import ProxyPkt, PassthroughPkt
 
 class RudicsModemSim:
     
@@ -126,12 +133,154 @@ class RudicsModemSim:
             parts.append(self._read_q.get())
         return ''.join(parts)
                
-def _runTest(log):
-    print 'No test available'
+class _NoisyRudicsServer(threading.Thread):
+    """Simulated RUDICS server for the FEC benchmark
+    
+    Echoes the data it receives back to the modem, with bit
+    errors injected at the bit error rate ber.  Errors come in
+    bursts spread over burst_bits bits, like the error bursts
+    of an Iridium link.
+    """
+    def __init__(self, ber, burst_bits=16):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self._listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listen_sock.bind(('localhost', 0))
+        self._listen_sock.listen(1)
+        self.port = self._listen_sock.getsockname()[1]
+        self._burst_bits = burst_bits
+        # Bursts flip half of their bits on average
+        self._burst_rate = ber * 2.0 / (burst_bits + 1)
+        self._next_burst = self._burst_gap()
+        self._stop_event = threading.Event()
+        self.start()
+        
+    def _burst_gap(self):
+        """Return the number of good bits before the next burst"""
+        if self._burst_rate == 0:
+            return sys.maxint
+        return int(random.expovariate(self._burst_rate))
+    
+    def _corrupt(self, data):
+        """Return data with bit errors"""
+        buf = bytearray(data)
+        n_bits = 8 * len(buf)
+        bit = self._next_burst
+        while bit < n_bits:
+            for i in range(bit, min(bit + self._burst_bits, n_bits)):
+                if (i == bit) or (random.random() < 0.5):
+                    buf[i / 8] ^= 1 << (i % 8)
+            bit += self._burst_bits + self._burst_gap()
+        self._next_burst = bit - n_bits
+        return str(buf)
+        
+    def run(self):
+        sock, addr = self._listen_sock.accept()
+        sock.settimeout(0.1)
+        while not self._stop_event.isSet():
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            if not data:
+                break
+            sock.sendall(self._corrupt(data))
+        sock.close()
+        self._listen_sock.close()
+        
+    def stop(self):
+        self._stop_event.set()
+        
+        
+def _measure_goodput(log, ber, data_pkts, parity_pkts, n_pkts, link_bps):
+    """Send n_pkts passthrough pkts through a noisy RUDICS link
+    
+    Return (fraction of pkts delivered, goodput in bits per second
+    for a link_bps link)
+    """
+    server = _NoisyRudicsServer(ber)
+    modem = RudicsModemSim(log, 'localhost', server.port)
+    if not modem.dialup():
+        print 'Could not connect to the simulated RUDICS server'
+        return (0.0, 0.0)
+    pkts = []
+    for i in range(n_pkts):
+        data_len = random.randint(200, 480)
+        pkts.append(PassthroughPkt(1, 2,
+                ''.join([chr(random.randint(0, 255)) for j in range(data_len)])))
+    pkt_q = Queue.Queue()
+    for pkt_buf in pkts:
+        pkt_q.put(pkt_buf)
+    if parity_pkts > 0:
+        frame_q = fec_utils.FecEncoder(pkt_q, data_pkts, parity_pkts, flush_delay=0)
+    else:
+        frame_q = pkt_q
+    frames = []
+    while True:
+        try:
+            frames.append(frame_q.get(False))
+        except Queue.Empty:
+            break
+    wire_bytes = sum([len(frame) for frame in frames])
+    # Write from another thread so the echoed data is read meanwhile
+    writer = threading.Thread(target=lambda: [modem.write(f) for f in frames])
+    writer.setDaemon(True)
+    writer.start()
+    
+    framer = sock_utils.PktFramer(log)
+    decoder = fec_utils.FecDecoder(log, hold_time=0.5)
+    sent = set(pkts)
+    delivered = 0
+    payload_bytes = 0
+    idle_end = time.time() + 2
+    while time.time() < idle_end:
+        data = modem.read()
+        if data is None:
+            break
+        rx_pkts = []
+        if data:
+            idle_end = time.time() + 2
+            for pkt_buf in framer.feed(data):
+                rx_pkts.extend(decoder.decode(pkt_buf))
+        else:
+            rx_pkts.extend(decoder.expire())
+            utils.wait(0.02)
+        for pkt_buf in rx_pkts:
+            if pkt_buf in sent:
+                sent.discard(pkt_buf)
+                delivered += 1
+                payload_bytes += len(pkt_buf) - ProxyPkt.PASSTHROUGH_DATA - \
+                                    ProxyPkt.CKSUM_LEN
+    modem.hangup()
+    server.stop()
+    goodput = float(link_bps) * payload_bytes / wire_bytes
+    return (float(delivered) / n_pkts, goodput)
+    
+    
+def _runTest(log, n_pkts=300, link_bps=2400):
+    """Benchmark proxy goodput against bit error rate, with and without FEC
+    
+    Goodput counts the passthrough data of the pkts delivered on
+    the first try, as if the link ran at link_bps.
+    """
+    print 'Goodput of %d passthrough pkts at %d bps' % (n_pkts, link_bps)
+    print '     BER   FEC k+m   delivered   goodput (bps)'
+    for ber in (0, 1e-5, 1e-4, 3e-4, 1e-3):
+        for data_pkts, parity_pkts in ((0, 0), (8, 1), (8, 2), (4, 2)):
+            if parity_pkts > 0:
+                label = '%d+%d' % (data_pkts, parity_pkts)
+            else:
+                label = 'off'
+            delivered, goodput = _measure_goodput(log, ber, data_pkts,
+                                    parity_pkts, n_pkts, link_bps)
+            print '%8g   %7s   %8.1f%%   %13.0f' % \
+                    (ber, label, 100 * delivered, goodput)
 
 if __name__ == '__main__':
     """Test the RudicsModemSim class"""
-    print "Testing RudicsModemSim class"
+    print "Testing RudicsModemSim class with the FEC benchmark"
     log = logs.open(modem_config.log_name_modem,
                     modem_config.log_dir,
                     logging.DEBUG)
@@ -23,7 +23,7 @@ from BasicXMLRPCThread import BasicXMLRPCThread
 from ProxyPkt import ProxyPkt
 
 
-class ModemReadThread(threading.Thread):
+class ModemReadThread(utils.BaseThread):
     """Read data from the modem, write it to a queue.
     Exit if timed out waiting for data.
     """
@@ -31,24 +31,18 @@ class ModemReadThread(threading.Thread):
                 modem,
                 data_q,
                 log):
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._log = log
-        self._stop_event = threading.Event()
+        self._stop_event = utils.Wakeup()
         self.name = 'ModemReadThread'
         self._modem = modem
         self._data_q = data_q
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
 
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         rx_timer = time.time()
         
         while not self._stop_event.isSet():
@@ -61,7 +55,9 @@ class ModemReadThread(threading.Thread):
                 rx_timer = time.time()
                 #self._log.debug('ModemReadThread received %s bytes:' % str(len(data)))
                 #self._log.debug('ModemReadThread data to %s' % repr(self._data_q))
-                self._data_q.put(data[:])
+                if not utils.q_put(self._data_q, data[:], wakeup=self._stop_event):
+                    # stopped while svr_proxy was not reading
+                    break
                 data = self._modem.read()
             self._stop_event.wait(0.1)
             
@@ -75,10 +71,10 @@ class ModemReadThread(threading.Thread):
     def stop(self):
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
 
    
-class ModemWriteThread(threading.Thread):
+class ModemWriteThread(utils.BaseThread):
     """Read data from a queue, write it to the modem.
         Exit only when stopped by parent
     """
@@ -86,27 +82,22 @@ class ModemWriteThread(threading.Thread):
                 modem,
                 write_q,
                 log):
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._log = log
-        self._stop_event = threading.Event()
+        self._stop_event = utils.Wakeup()
         self.name = 'ModemWriteThread'
         self._modem = modem
         self._data_q = write_q
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
 
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         
         while not self._stop_event.isSet():
-            data = utils.q_get(self._data_q, get_timeout=0.5)
+            data = utils.q_get(self._data_q, get_timeout=None,
+                                wakeup=self._stop_event)
             if data:
                 #self._log.debug('ModemWriteThread sent a pkt')
                 self._modem.write(data)
@@ -121,12 +112,10 @@ class ModemWriteThread(threading.Thread):
     def stop(self):
         if self._running:
             self._stop_event.set()
-            # force thread code to run
-            self._data_q.put('This wakes up the modem write thread')
-            self.join()
+            self._join()
 
 
-class RUDICSSvrProxyConnection(threading.Thread):
+class RUDICSSvrProxyConnection(utils.BaseThread):
     """Handle a single svr_proxy-modem connection.
     Creates ModemReadThread and ModemWriteThread.
     Exits if svr_proxy connection dies or the
@@ -135,8 +124,7 @@ class RUDICSSvrProxyConnection(threading.Thread):
     def __init__(self, client_sock, modem, log):
         """
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._modem = modem
         self._client_sock = client_sock
         self._log = log
@@ -145,20 +133,16 @@ class RUDICSSvrProxyConnection(threading.Thread):
         self._read_thread = None
         self._write_thread = None
         self._client_sock_h = None        
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                                         
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
 
-        self._inbound_data_q = Queue.Queue()  # inbound from modem
-        self._outbound_data_q = Queue.Queue() # outbound to modem       
+        # Bounded, so a slow modem holds back svr_proxy
+        self._inbound_data_q = sock_utils.new_sock_q()  # inbound from modem
+        self._outbound_data_q = sock_utils.new_sock_q() # outbound to modem       
         self._client_sock_h = sock_utils.SockHandler(self._client_sock,
                                     self._log,
                                     read_data_q=self._outbound_data_q,
@@ -196,10 +180,10 @@ class RUDICSSvrProxyConnection(threading.Thread):
         """Stop the this thread and its child threads"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
     
 
-class SvrProxyConnector(threading.Thread):
+class SvrProxyConnector(utils.BaseThread):
     """ Open a server port so the svr_proxy can make
     a socket connection.
     Makes one connection and then waits to be stopped.
@@ -207,36 +191,39 @@ class SvrProxyConnector(threading.Thread):
     def __init__(self,
                 log,
                 exit_callback=None):
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._log = log
         self._host = 'localhost'
         self._port = modem_svr_config.client_port
         self._exit_callback = exit_callback
         self.sock = None
+        self._listener = None
         self._stop_event = threading.Event()
         self.name = 'SvrProxyConnector thread'
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
     
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
-        connected = False
+        # Listen before _set_started(), so stop() always has
+        #  a listener to close
+        try:
+            self._listener = sock_utils.SockListener(self._log, self._host,
+                                                    self._port, backlog=1)
+        except socket.error, e:
+            self._log.error('SvrProxyConnector: cannot listen on port %d, %s' % \
+                            (self._port, e))
+            self._stop_event.set()
+        self._set_started()
         
         while not self._stop_event.isSet():
-            if connected:
-                break
             # The following blocks until a client connects
-            self.sock, addr, connected_flag = sock_utils.connect_to_client(self._log,
-                                self._host,
-                                self._port,
-                                self._stop_event)
+            sock, addr = self._listener.accept()
+            if sock is not None:
+                self.sock = sock
+                break
+        if self._listener is not None:
+            self._listener.close()
         
         while not self._stop_event.isSet():
             self._stop_event.wait(0.5)
@@ -257,12 +244,13 @@ class SvrProxyConnector(threading.Thread):
     def stop(self):
         if self._running:
             self._stop_event.set()
-            # force connect_to_client to return
-            sock_utils.dummy_connection(self._host, self._port)
-            self.join()
+            if self._listener is not None:
+                # wake the accept() wait
+                self._listener.close()
+            self._join()
 
 
-class RUDICSSvrProxyConnector(threading.Thread):
+class RUDICSSvrProxyConnector(utils.BaseThread):
     """Keeps trying to connect the svr_proxy
         to the RUDICS server
 	"""
@@ -270,8 +258,7 @@ class RUDICSSvrProxyConnector(threading.Thread):
                 log,
                 xmlrpc_thread,
                 exit_callback=None):
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._log = log
         xmlrpc_thread.set_rudics_conn_thread(self)
         self._modem = None
@@ -280,17 +267,12 @@ class RUDICSSvrProxyConnector(threading.Thread):
         self._stop_event = threading.Event()
         self.name = 'RUDICSSvrProxyConnector thread'
         self._exit_callback = exit_callback
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
     
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         state = 'start'
         
         while True:
@@ -371,7 +353,7 @@ class RUDICSSvrProxyConnector(threading.Thread):
     def stop(self):
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
 
             
                         
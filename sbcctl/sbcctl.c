@@ -61,6 +61,11 @@
  *				avoid conflict with gps_pps driver which is controlling
  *				DIO1.7 and DIO1.8.
  *
+ *  2026-10-18  Added serve mode: commands are read from stdin,
+ *              one per line, and run on one open board, so
+ *              hw_mgr does not fork sbcctl for each command.
+ *              Version 2.3
+ *
  ************************************************************************/
 
 #include <unistd.h>
@@ -73,12 +78,15 @@
 #include "logging.c"
 
 // Global Constants
+#define SERVE_END_MARKER	"** Finished **"
+#define SERVE_MAX_LINE		256
+#define SERVE_MAX_ARGS		16
 #define LOG_FILE_DIR 		"/var/log"
 #define LOG_FILE_NAME 		"sbcctl"
 #define LOG_FILE_MAX_SIZE 	50000
 
 
-static const char* VERSION = "2.2.1";
+static const char* VERSION = "2.3";
 
 typedef int (Callback)(Board* board, char* option[], int numOpts);
 
@@ -545,6 +553,79 @@ void PrintUsage()
     printf("  -m    - print Start/Finish markers\n");
     printf("  -h    - print this help screen\n");
     printf("\n");
+    printf("sbcctl serve\n");
+    printf("  Read commands from stdin, one per line.  The output of\n");
+    printf("  each command, including errors, ends with a\n");
+    printf("  \"%s\" line.\n", SERVE_END_MARKER);
+    printf("\n");
+}
+
+// Run a command on an open board.
+// option[0] is the command name.
+int RunCommand(Board* board, char* option[], int numOpts)
+{
+    int k;
+
+    for (k=0; k<NumCommands; k++) {
+        if (strcmp(option[0],Commands[k].name)==0) {
+            if (numOpts <= Commands[k].numOptions) {
+                fprintf(stderr,"Not enough parameters\n");
+                fprintf(stderr,"  Usage: sbcctl %s\n",Commands[k].usage);
+                return 0;
+            }
+            return Commands[k].callback(board,option,numOpts);
+        }
+    }
+
+    fprintf(stderr,"Command not recognized: %s\n",option[0]);
+    fprintf(stderr,"  (Use \"help\" for a list of valid commands)\n");
+    return 0;
+}
+
+// Run commands read from stdin until end of file.
+// The board is opened once for all commands.
+int Serve(void)
+{
+    char    line[SERVE_MAX_LINE];
+    char*   option[SERVE_MAX_ARGS];
+    char*   token;
+    int     numOpts;
+    int     k;
+    Board*  board;
+
+    // Errors go to the command output, as with 2>&1
+    dup2(STDOUT_FILENO, STDERR_FILENO);
+    setvbuf(stderr, NULL, _IONBF, 0);
+
+    board = board_new();
+    if (!board) {
+        return 0;
+    }
+
+    while (fgets(line, sizeof(line), stdin)) {
+        numOpts = 0;
+        token = strtok(line, " \t\r\n");
+        while (token && (numOpts < SERVE_MAX_ARGS)) {
+            option[numOpts++] = token;
+            token = strtok(NULL, " \t\r\n");
+        }
+        if (numOpts > 0) {
+            for (k=0; k<numOpts; k++) {
+                LowerCase(option[k]);
+            }
+            /* Each command has 20 seconds to complete. */
+            alarm(20);
+            if (!RunCommand(board, option, numOpts)) {
+                fprintf(stderr,"Error\n");
+            }
+            alarm(0);
+        }
+        printf("%s\n", SERVE_END_MARKER);
+        fflush(stdout);
+    }
+
+    board_delete(board);
+    return 1;
 }
 
 int ProcessCommand(int argc, char* argv[])
@@ -663,6 +744,10 @@ int main (int argc, char* argv[])
 		system("/aal-pip/field/bin/install_dio1");
 		//printf("Installed dio1 driver\n");
 	}
+
+	if ((argc == 2) && (strcmp(argv[1], "serve") == 0)) {
+		return Serve() ? EXIT_SUCCESS : EXIT_FAILURE;
+	}
     /* This program has 20 seconds to complete. */
     alarm(20);
 
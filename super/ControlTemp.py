@@ -24,18 +24,15 @@ class ControlTemp:
         self._hw_mgr_server = utils.set_power_state('htr', 'off', self._hw_mgr_server, self._hw_mgr_lock, self._log)
         
     def _control_temp(self):
-        [temp, self._hw_mgr_server] = utils.get_hw_status('router_temp', self._hw_mgr_server, self._hw_mgr_lock, self._log)       
-        if temp is None:
-            self._log.error('Could not get router board temp from hw_mgr')
+        [values, self._hw_mgr_server] = utils.get_hw_status_list(['router_temp', 'htr_pwr'], self._hw_mgr_server, self._hw_mgr_lock, self._log)       
+        if values is None:
+            self._log.error('Could not get router board temp and heater power status from hw_mgr')
             return        
+        [temp, htr_state] = values
         if temp > (self.setpoint + self._hysteresis):
             self._htr_desired_state = 0
         if temp < (self.setpoint - self._hysteresis):
             self._htr_desired_state = 1       
-        [htr_state, self._hw_mgr_server] = utils.get_hw_status('htr_pwr', self._hw_mgr_server, self._hw_mgr_lock, self._log)
-        if htr_state is None:
-            self._log.error('Could not get heater power status from hw_mgr')
-            return       
         if htr_state != self._htr_desired_state:
             if self._htr_desired_state == 1:
                 self._hw_mgr_server = utils.set_power_state('htr', 'on', self._hw_mgr_server, self._hw_mgr_lock, self._log)
@@ -8,6 +8,7 @@ import super_config
 import hw_mgr_config
 import usb_mgr_config
 import utils
+import procfs
 
 
 class SaveFileThread(threading.Thread):
@@ -181,10 +182,12 @@ class StoreHskp:
         except Exception, e:
             self._log.error('StoreHskp._get_data_row exception: %s' % e)
             return None       
-        # get uptime_secs and idle_secs
-        [ut, std_error] = utils.call_subprocess('cat /proc/uptime')    
-        fields = ut.split()
-        parts.append('%d,' % int(float(fields[0])))
+        # get uptime_secs
+        uptime = procfs.read_uptime()
+        if uptime is None:
+            self._log.error('StoreHskp._get_data_row: could not read uptime')
+            return None
+        parts.append('%d,' % int(uptime[0]))
         ut = hw_status['uptime'].replace(',', '')
         fields = ut.split()
         last = len(fields)- 1
@@ -21,44 +21,188 @@ import logs
 import global_config
 import modem_svr_config
 import svr_proxy_config
-from ProxyPkt import ProxyPkt, DisconnectPkt
+from ProxyPkt import ProxyPkt, ProxyPktView, ConnectPkt, DisconnectPkt, \
+                        ResumePkt
 import proxy_utils
+import fec_utils
 from BasicXMLRPCThread import BasicXMLRPCThread
 
-class ModemSvrConnection(threading.Thread):
-    """There is only one ModemSvrConnection.
+class ChannelTable:
+    """The ServerConnections of the proxy link
+    
+    The routing table, keyed by (server port, client port).
+    It outlives each ModemSvrConnection, so when the RUDICS
+    call drops, channels that can be resumed are parked here
+    instead of being closed.  A parked channel is closed if
+    it is not resumed within the grace period.
+    """
+    def __init__(self, pkt_sched, log):
+        """
+        pkt_sched = the modem server pkt scheduler
+        log = log object
+        """
+        self._pkt_sched = pkt_sched
+        self._log = log
+        self._lock = threading.Lock()
+        self._channels = {}     # (server port, client port) -> ServerConnection
+        
+    def get(self, key):
+        """Return the ServerConnection for key, or None"""
+        self._lock.acquire()
+        try:
+            return self._channels.get(key)
+        finally:
+            self._lock.release()
+        
+    def replace(self, key):
+        """Close the stale channel the other proxy is reopening
+        
+        Call before the new ServerConnection is created, so
+        none of its pkts are queued when the old ones are dropped.
+        """
+        self._lock.acquire()
+        old_sc = self._channels.pop(key, None)
+        self._lock.release()
+        if old_sc is not None:
+            # The other proxy lost the old channel, don't DISCONNECT the new one.
+            #  Drop first to release blocked writers, again for pkts put while stopping.
+            self._pkt_sched.drop_channel(*key)
+            old_sc.replace()
+            self._pkt_sched.drop_channel(*key)
+            self._pkt_sched.forget_channel(*key)
+        
+    def add(self, sc):
+        """Add a new ServerConnection"""
+        key = (sc.get_server_port(), sc.get_client_port())
+        self._lock.acquire()
+        old_sc = self._channels.get(key)
+        self._channels[key] = sc
+        self._lock.release()
+        if old_sc is not None:
+            # not replace()d first, leave the scheduler to the new sc
+            old_sc.replace()
+        if not sc.is_running():
+            # died before it was added
+            self.remove(sc)
+        
+    def remove(self, sc):
+        """ServerConnection exit callback"""
+        key = (sc.get_server_port(), sc.get_client_port())
+        self._lock.acquire()
+        # if sc failed to init or was replaced, it won't be in the table
+        removed = self._channels.get(key) is sc
+        if removed:
+            del self._channels[key]
+        self._lock.release()
+        if removed:
+            self._pkt_sched.forget_channel(*key)
+        
+    def get_stats(self):
+        """Return a dict of channel stats, keyed by 'server port:client port'"""
+        stats = {}
+        for sc in self._get_all():
+            stats['%d:%d' % (sc.get_server_port(), sc.get_client_port())] = \
+                                sc.get_stats()
+        return stats
+        
+    def get_parked(self):
+        """Return the list of parked ServerConnections"""
+        return [sc for sc in self._get_all() if sc.is_parked()]
+        
+    def park_all(self):
+        """Park the channels that can be resumed, close the others"""
+        for sc in self._get_all():
+            if sc.can_resume():
+                sc.park()
+            else:
+                self._close(sc)
+                
+    def expire_parked(self, grace):
+        """Close the channels parked for more than grace seconds"""
+        now = time.time()
+        for sc in self.get_parked():
+            if now - sc.get_park_time() > grace:
+                self._log.info('ChannelTable: channel %d:%d was not resumed, closing' % \
+                                (sc.get_server_port(), sc.get_client_port()))
+                self._close(sc)
+                
+    def stop_all(self):
+        """Close all channels"""
+        for sc in self._get_all():
+            if sc.is_parked():
+                self._close(sc)
+            else:
+                sc.stop()
+            
+    def _get_all(self):
+        self._lock.acquire()
+        try:
+            return self._channels.values()
+        finally:
+            self._lock.release()
+        
+    def _close(self, sc):
+        """Stop a channel the other proxy will not acknowledge"""
+        key = (sc.get_server_port(), sc.get_client_port())
+        if self.get(key) is sc:
+            self._pkt_sched.drop_channel(*key)
+        sc.abandon()
+        self.remove(sc)
+
+
+class ModemSvrConnection(utils.BaseThread):
+    """There is only one ModemSvrConnection at a time.
     Handles CONNECT proxy protocol packets by creating
     ServerConnections.
     Directs packets from the modem server to
     the correct ServerConnection.
+    ServerConnections are found in the channel table.
+    Channels parked by the previous ModemSvrConnection
+    are resumed with RESUME pkts.
+    Pkts received are counted in link_stats, the pkts sent
+    are counted by the scheduler.
     Exits when the modem_svr connection is lost or
     when stopped by parent.
     """
-    def __init__(self, modem_svr_sock_h, xfer_rec, log):
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+    def __init__(self, modem_svr_sock_h, xfer_rec, pkt_sched, channels,
+                    link_stats, log):
+        utils.BaseThread.__init__(self)
         self._modem_svr_sock_h = modem_svr_sock_h
         self._xfer_rec = xfer_rec
+        self._pkt_sched = pkt_sched
+        self._channels = channels
+        self._link_stats = link_stats
+        self._fec_encoder = None
+        self._connect_time = time.time()
         self._log = log
-        self._stop_event = threading.Event()
+        self._stop_event = utils.Wakeup()
         self.name = 'ModemSvrConnection thread'
         self._modem_svr_proxy = None
-        self._children = []
-        self._children_lock = threading.Lock()
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._unknown_channel_pkts = 0
+        self._start_and_wait()
 
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         read_pkt_q = self._modem_svr_sock_h.get_read_q()
-        write_pkt_q = self._modem_svr_sock_h.get_write_q()
+        # All pkts to the modem server go through the scheduler.
+        #  Parked channels' pkts are kept for the resumed session.
+        parked = self._channels.get_parked()
+        if not parked:
+            self._pkt_sched.flush()
+        if svr_proxy_config.fec_parity_pkts > 0:
+            self._fec_encoder = fec_utils.FecEncoder(self._pkt_sched,
+                                        svr_proxy_config.fec_data_pkts,
+                                        svr_proxy_config.fec_parity_pkts,
+                                        svr_proxy_config.fec_flush_delay)
+            self._modem_svr_sock_h.set_write_q(self._fec_encoder)
+        else:
+            self._modem_svr_sock_h.set_write_q(self._pkt_sched)
+        write_pkt_q = self._pkt_sched
         self._update_connected_flag()
+        for sc in parked:
+            sc.send_resume()
         
         #self._log.debug('ModemSvrConnection: modem_svr_sock_h read q is %s' % repr(read_pkt_q))
         #self._log.debug('ModemSvrConnection: modem_svr_sock_h write q is %s' % repr(write_pkt_q))
@@ -67,9 +211,12 @@ class ModemSvrConnection(threading.Thread):
             if not self._modem_svr_sock_h.is_running():
                 self._stop_event.set()
                 continue
-            pkt_buf = utils.q_get(read_pkt_q, get_timeout=0.5)
+            pkt_buf = utils.q_get(read_pkt_q, get_timeout=None,
+                                    wakeup=self._stop_event)
             if pkt_buf:
-                pkt = ProxyPkt(pkt_buf)
+                self._link_stats.count_rx(len(pkt_buf), 1)
+                self._link_stats.note_q_depth('modem_rx_q', read_pkt_q.qsize())
+                pkt = ProxyPktView(pkt_buf)
                 #self._log.debug('ModemSvrConnection: received pkt')                
                 #self._log.debug(pkt.str())                
                 pkt_type = pkt.get_type()
@@ -82,44 +229,87 @@ class ModemSvrConnection(threading.Thread):
                     self._send_iccid(write_pkt_q)
                     continue
                 if (pkt_type == ProxyPkt.PASSTHROUGH) or \
+                    (pkt_type == ProxyPkt.COMPRESSED_PASSTHROUGH) or \
+                    (pkt_type == ProxyPkt.JUMBO_PASSTHROUGH) or \
+                    (pkt_type == ProxyPkt.ACK) or \
                     (pkt_type == ProxyPkt.DISCONNECT):
                     self._xfer_rec.set_time(time.time())                    
-                    self._children_lock.acquire()
-                    for ch in self._children:                       
-                        if (ch.get_server_port() == pkt.get_dest_port()) and \
-                                (ch.get_client_port() == pkt.get_src_port()):
-                            ch.send(pkt)
-                            break
-                    self._children_lock.release()
+                    ch = self._channels.get((pkt.get_dest_port(), pkt.get_src_port()))
+                    if ch is not None:
+                        ch.send(pkt)
+                    else:
+                        self._handle_unknown_channel_pkt(pkt, write_pkt_q)
                     continue                    
                     
+                if pkt_type == ProxyPkt.RESUME:
+                    self._xfer_rec.set_time(time.time())
+                    ch = self._channels.get((pkt.get_dest_port(), pkt.get_src_port()))
+                    if (ch is not None) and ch.can_resume():
+                        ch.resume(pkt)
+                    else:
+                        self._handle_unknown_channel_pkt(pkt, write_pkt_q)
+                    continue
+                    
+
                 if pkt_type == ProxyPkt.CONNECT:
                     self._xfer_rec.set_time(time.time())
                     self._log.debug('ModemSvrConnection: got CONNECT')
+                    self._channels.replace((pkt.get_dest_port(), pkt.get_src_port()))
                     sc = ServerConnection(write_pkt_q,
                                         pkt.get_dest_port(),
                                         pkt.get_src_port(),
                                         self._log,
-                                        exit_callback=self._my_exit_callback)
+                                        exit_callback=self._channels.remove,
+                                        peer_caps=pkt.get_caps(),
+                                        connect_time=time.time())
                     if sc.is_connected():
-                        self._children_lock.acquire()
-                        self._children.append(sc)
-                        self._children_lock.release()
+                        self._channels.add(sc)
             
-        self._running = False
         self._log.debug('Stopping %s' % self.name)
         self._update_disconnected_flag()
-        for ch in self._children:
-            ch.stop()
+        self._log_stats()
+        # Park before the connector can start the next connection
+        self._channels.park_all()
+        self._running = False
         self._log.debug('Exiting %s' % self.name)
-                                  
-    def _my_exit_callback(self, child):
-        """Child threads call this when they die"""
-        if self._running:
-            self._children_lock.acquire()
-            # if child failed to init, it won't be in self._children
-            utils.safe_remove(self._children, child)
-            self._children_lock.release()
+            
+    def _log_stats(self):
+        """Log the traffic and errors of this connection,
+            add the errors to the link totals
+        """
+        read_stats = self._modem_svr_sock_h.get_read_stats()
+        self._link_stats.add_counters(read_stats)
+        self._log.info('ModemSvrConnection: connected %.0f seconds, link totals %s' % \
+                        (time.time() - self._connect_time, self._link_stats.str()))
+        self._log.info('ModemSvrConnection: read errors %s' % \
+                        utils.dict_str(read_stats))
+        self._log.info('ModemSvrConnection: write queues %s' % \
+                        utils.dict_str(self._pkt_sched.get_stats()))
+        if self._fec_encoder is not None:
+            self._log.info('ModemSvrConnection: FEC %s' % \
+                        utils.dict_str(self._fec_encoder.get_stats()))
+                        
+    def get_stats(self):
+        """Return a dict of this connection's live counters"""
+        stats = self._modem_svr_sock_h.get_read_stats()
+        stats['connected_secs'] = time.time() - self._connect_time
+        stats['unknown_channel_pkts'] = self._unknown_channel_pkts
+        if self._fec_encoder is not None:
+            for name, value in self._fec_encoder.get_stats().items():
+                stats['fec_' + name] = value
+        return stats
+            
+    def _handle_unknown_channel_pkt(self, pkt, write_q):
+        """Count a pkt for a channel that does not exist.
+            Tell the other proxy to close the channel.
+        """
+        self._unknown_channel_pkts += 1
+        if pkt.get_type() in (ProxyPkt.DISCONNECT, ProxyPkt.ACK):
+            # the channel is already closed at both ends
+            return
+        self._log.debug('ModemSvrConnection: pkt for unknown channel %d:%d, sending DISCONNECT' % \
+                        (pkt.get_dest_port(), pkt.get_src_port()))
+        write_q.put(DisconnectPkt(pkt.get_dest_port(), pkt.get_src_port()))
                         
     def _send_iccid(self, write_q):
         """Transmit a pkt containing the modem SIM ICCID"""
@@ -169,14 +359,18 @@ class ModemSvrConnection(threading.Thread):
         """Stop this thread and its child threads"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
 
 
-class ServerConnection(threading.Thread):
+class ServerConnection(utils.BaseThread):
     """Handles a single client-server connection
     Creates packetize and depacketize threads.
     Exits if either the packetize or depacketize thread dies.
     Exits if stopped by parent.
+    A channel with sequenced pkts can be parked while the
+    RUDICS call is down, and resumed after re-dial.  Pkts in
+    flight when the call dropped are lost, so channels
+    without sequencing cannot be resumed.
     """
 
     def __init__(self,
@@ -184,15 +378,18 @@ class ServerConnection(threading.Thread):
                 svr_port,
                 client_port,
                 log,
-                exit_callback=None):
+                exit_callback=None,
+                peer_caps=0,
+                connect_time=None):
         """
         pkt_write_q = outgoing pkts to the modem server
         svr_port = Port number of server on local machine
         client_port = port number of client on the other machine
         log = log object
+        peer_caps = capability flags offered in the peer's CONNECT pkt
+        connect_time = time the CONNECT pkt was received
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._host = 'localhost'
         self._port = client_port
         self._pkt_write_q = pkt_write_q
@@ -203,14 +400,24 @@ class ServerConnection(threading.Thread):
         self._depack_thread = None
         self._log = log
         self._exit_callback = exit_callback        
+        self._peer_caps = peer_caps
+        self._caps = peer_caps & self._our_caps()
+        self._arq = None
+        self._park_time = None
+        self._resume_sent = False
+        self._abandoned = False
+        self._replaced = False
+        self._stats = proxy_utils.LinkStats()
+        if connect_time is None:
+            connect_time = time.time()
+        self._connect_time = connect_time
+        self._setup_secs = 0.0
+        self._policy = svr_proxy_config.channel_policies.get(svr_port,
+                                svr_proxy_config.default_channel_policy)
         self._connected = False
         self._stop_event = threading.Event()
         self.name = 'ServerConnection thread, server port %s' % str(svr_port)
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                                         
     def run(self):
         """The actual thread code"""
@@ -222,31 +429,55 @@ class ServerConnection(threading.Thread):
                                     self._host,
                                     self._svr_port,
                                     exit_callback=self._my_exit_callback,
-                                    data_type='stream')
+                                    data_type='stream',
+                                    reactor=svr_proxy_config.sock_reactor,
+                                    sock_opts={'tcp_nodelay': self._policy == 'latency'})
+        self._setup_secs = time.time() - self._connect_time
         if self._sock_h is None:
             self._log.debug('ServerConnection: could not connect to server')
         else:
-            self._log.debug('ServerConnection: Connected to server')
+            self._log.debug('ServerConnection: Connected to server in %.2f seconds' % \
+                            self._setup_secs)
             self._connected = True
               
-        self._started = True
-        self._running = True
         if self._sock_h is not None:
             #self._log.debug('ServerConnection: connected to server')
             #self._log.debug('  server proxy port is %s' % str(self._sock_h.get_peer_port()))
             #self._log.debug('  local port is %s' % str(self._sock_h.get_sock_port()))
+            if self._peer_caps:
+                # Tell the peer which of its capabilities we accepted
+                self._pkt_write_q.put(ConnectPkt(self._svr_port,
+                                        self._client_port, self._caps))
+            if self._caps & ProxyPkt.CAP_ARQ:
+                self._arq = proxy_utils.ArqChannel(self._pkt_write_q,
+                                        self._svr_port,
+                                        self._client_port,
+                                        log,
+                                        window=svr_proxy_config.arq_window)
             self._pack_thread = proxy_utils.Packetize(self._sock_h,                                        
                                         self._pkt_write_q,
                                         self._svr_port,
                                         self._client_port,
                                         log,
-                                        exit_callback=self._my_exit_callback)                  
+                                        exit_callback=self._my_exit_callback,
+                                        compress=bool(self._caps & ProxyPkt.CAP_ZLIB),
+                                        policy=self._policy,
+                                        coalesce_delay=svr_proxy_config.coalesce_delay,
+                                        jumbo=self._use_jumbo_pkts(),
+                                        arq=self._arq,
+                                        stats=self._stats)
             self._depack_thread = proxy_utils.Depacketize(self._sock_h,
                                         log,
-                                        exit_callback=self._my_exit_callback)
+                                        exit_callback=self._my_exit_callback,
+                                        arq=self._arq,
+                                        stats=self._stats)
+            # Ready once the channel's pkts can be handled
+            self._set_started()
             self._stop_event.wait()
+        else:
+            self._set_started()
             
-        if not self._connected:
+        if not self._connected and not self._replaced:
             # failed to connect to server
             self._pkt_write_q.put(DisconnectPkt(self._svr_port, self._client_port))
             self._log.debug('ServerConnection: sent DISCONNECT')                
@@ -254,16 +485,42 @@ class ServerConnection(threading.Thread):
         self._running = False
         self._log.debug('Stopping %s ' % self.name)
         self._stop_all_children()
+        if self._connected:
+            self._log.info('ServerConnection: channel %d:%d closed after %.0f seconds, %s' % \
+                            (self._svr_port, self._client_port,
+                            time.time() - self._connect_time, self._stats.str()))
+            if self._arq is not None:
+                self._log.info('ServerConnection: channel %d:%d ARQ %s' % \
+                            (self._svr_port, self._client_port,
+                            utils.dict_str(self._arq.get_stats())))
         if self._exit_callback:
             self._exit_callback(self)
         self._log.debug('Exiting %s ' % self.name)
         
     def _stop_all_children(self):
+        if (self._arq is not None) and self._abandoned:
+            # Unblock the packetizer, nothing more can be delivered
+            self._arq.close()
+        if self._arq is not None:
+            # Let the pending data drain before the DISCONNECT
+            if self._pack_thread is not None:
+                self._pack_thread.stop()
+                self._pack_thread = None
         if self._depack_thread is not None:
             # if we didn't get a DISCONNECT from the other proxy, send one       
-            if not self._depack_thread.got_disconnect_pkt():
-                self._pkt_write_q.put(DisconnectPkt(self._svr_port, self._client_port))
+            if not self._depack_thread.got_disconnect_pkt() and \
+                not self._replaced:
+                if self._arq is not None:
+                    self._arq.send(ProxyPkt.DISCONNECT,
+                                    timeout=svr_proxy_config.arq_linger)
+                else:
+                    self._pkt_write_q.put(DisconnectPkt(self._svr_port, self._client_port))
                 self._log.debug('ServerConnection: sent DISCONNECT')                
+            if (self._arq is not None) and not self._abandoned:
+                if not self._arq.wait_for_acks(svr_proxy_config.arq_linger):
+                    self._log.info('ServerConnection: port %d, unacknowledged pkts dropped' % \
+                                    self._svr_port)
+                self._arq.close()
             self._depack_thread.stop()
             self._depack_thread = None
         if self._pack_thread is not None:
@@ -276,14 +533,85 @@ class ServerConnection(threading.Thread):
     def _my_exit_callback(self, child):
         self._stop_event.set()
         
+    def _our_caps(self):
+        """Return the capability flags this proxy supports"""
+        caps = 0
+        if svr_proxy_config.compress_passthrough:
+            caps |= ProxyPkt.CAP_ZLIB
+        if svr_proxy_config.jumbo_passthrough:
+            caps |= ProxyPkt.CAP_JUMBO
+        if svr_proxy_config.arq:
+            caps |= ProxyPkt.CAP_ARQ
+        return caps
+        
+    def _use_jumbo_pkts(self):
+        """Return True if jumbo pkts should be sent on this channel"""
+        return bool(self._caps & ProxyPkt.CAP_JUMBO) and \
+                (self._policy == proxy_utils.THROUGHPUT_FIRST)
+        
+    def can_resume(self):
+        """Return True if the channel can be parked and resumed"""
+        return (self._arq is not None) and self._running
+        
+    def park(self):
+        """Hold the channel while the RUDICS call is down"""
+        self._log.info('ServerConnection: parking channel %d:%d' % \
+                        (self._svr_port, self._client_port))
+        self._arq.park()
+        self._park_time = time.time()
+        self._resume_sent = False
+        
+    def is_parked(self):
+        return self._park_time is not None
+        
+    def get_park_time(self):
+        """Return the time the channel was parked"""
+        return self._park_time
+        
+    def send_resume(self):
+        """Ask the other proxy to resume the channel"""
+        self._pkt_write_q.put(ResumePkt(self._svr_port, self._client_port,
+                                        self._arq.get_next_seq()))
+        self._resume_sent = True
+        
+    def resume(self, pkt):
+        """Handle a RESUME pkt from the other proxy"""
+        if self._park_time is not None:
+            if not self._resume_sent:
+                self.send_resume()
+            self._log.info('ServerConnection: resumed channel %d:%d after %.0f seconds' % \
+                            (self._svr_port, self._client_port,
+                            time.time() - self._park_time))
+            self._park_time = None
+        # Resend what the other proxy is missing
+        self._arq.resume(pkt.get_resume_seq())
+        
     def get_server_port(self):
         return self._svr_port
         
+    def get_stats(self):
+        """Return a dict of the channel's counters and state"""
+        stats = self._stats.get_stats()
+        stats['setup_secs'] = self._setup_secs
+        stats['connected_secs'] = time.time() - self._connect_time
+        stats['policy'] = self._policy
+        stats['caps'] = self._caps
+        stats['parked'] = self.is_parked()
+        if self._arq is not None:
+            for name, value in self._arq.get_stats().items():
+                stats['arq_' + name] = value
+        return stats
+        
     def get_client_port(self):
         return self._client_port
         
     def send(self, pkt):
         """Send a packet to the server"""
+        if (self._arq is not None) and (pkt.get_type() == ProxyPkt.ACK):
+            # Handled here so ACKs still arrive while the
+            #  closing channel waits for its last pkts to be acknowledged
+            self._arq.on_ack(pkt)
+            return
         if self._depack_thread:
             self._depack_thread.send(pkt)
 
@@ -298,11 +626,21 @@ class ServerConnection(threading.Thread):
         """Stop the socket server thread and its child threads"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
+            
+    def abandon(self):
+        """Stop without waiting for the other proxy to acknowledge"""
+        self._abandoned = True
+        self.stop()
+        
+    def replace(self):
+        """Stop silently, the other proxy has reopened the channel"""
+        self._replaced = True
+        self.abandon()
 
 
 
-class ModemSvrConnector(threading.Thread):
+class ModemSvrConnector(utils.BaseThread):
     """There is only one ModemSvrConnector.
     Keeps attempting to connect to the modem_svr when
     not connected.
@@ -311,31 +649,34 @@ class ModemSvrConnector(threading.Thread):
     Resumes modem_svr connection attempts if ModemSvrConnections dies.
     Exits when stopped by parent.
     """
-    def __init__(self, xfer_rec, log):
+    def __init__(self, xfer_rec, pkt_sched, link_stats, log):
         """
+            xfer_rec = XferRec
+            pkt_sched = proxy_utils.PktScheduler for pkts to the modem server
+            link_stats = proxy_utils.LinkStats of the modem server link
             log = log object
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._stop_event = threading.Event()
         self._xfer_rec = xfer_rec
+        self._pkt_sched = pkt_sched
+        self._link_stats = link_stats
         self._log = log
         self.name = 'ModemSvrConnector thread'
         self._host = 'localhost'
         self._port = modem_svr_config.client_port
         self._modem_svr_sock_h = None
         self._modem_svr_conn = None
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._channels = ChannelTable(pkt_sched, log)
+        self._connections = 0
+        self._down_time = time.time()
+        self._reconnect_secs = 0.0
+        self._start_and_wait()
 
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         # Connect to the modem server
         #self._log.debug('Trying to connect to the modem server')
         while not self._stop_event.isSet():
@@ -345,29 +686,70 @@ class ModemSvrConnector(threading.Thread):
                                         self._host,
                                         self._port,
                                         exit_callback=self._my_exit_callback,
-                                        data_type='packet')
+                                        data_type='packet',
+                                        fec=True,
+                                        reactor=svr_proxy_config.sock_reactor)
                 if self._modem_svr_sock_h is not None:
-                    self._log.debug('Connected to the modem server')
+                    self._connections += 1
+                    self._reconnect_secs = time.time() - self._down_time
+                    self._log.debug('Connected to the modem server after %.0f seconds' % \
+                                    self._reconnect_secs)
                     self._modem_svr_conn = ModemSvrConnection(self._modem_svr_sock_h,
-                                            self._xfer_rec, self._log)
+                                            self._xfer_rec, self._pkt_sched,
+                                            self._channels, self._link_stats,
+                                            self._log)
             else:
+                conn = self._modem_svr_conn
+                sock_h = self._modem_svr_sock_h
+                if (sock_h is None) or not sock_h.is_running():
+                    # The socket may have died before the connection
+                    #  thread started waiting on it
+                    conn.stop()
                 # is modem server connection still alive?
-                if not self._modem_svr_conn.is_running():
+                if not conn.is_running():
                     self._log.debug('Disconnected from the modem server')
                     self._modem_svr_conn = None
+                    self._down_time = time.time()
+            self._channels.expire_parked(svr_proxy_config.resume_grace)
             self._stop_event.wait(0.5)                                                     
             
         self._running = False
         #self._log.debug('Stopping %s' % self.name)
         if self._modem_svr_conn:
             self._modem_svr_conn.stop()
+        self._channels.stop_all()
         self._log.debug('Exiting %s' % self.name)
         
+    def get_link_stats(self):
+        """Return a dict of modem server link totals
+        
+        Read errors of the current connection are added to the
+        totals of the previous ones.
+        """
+        stats = self._link_stats.get_stats()
+        conn = self._modem_svr_conn
+        connected = (conn is not None) and conn.is_running()
+        if connected:
+            for name, value in conn.get_stats().items():
+                stats[name] = stats.get(name, 0) + value
+        stats['connected'] = connected
+        stats['connections'] = self._connections
+        stats['reconnect_secs'] = self._reconnect_secs
+        stats['channels'] = len(self._channels.get_stats())
+        for name, value in sock_utils.get_byte_budget().get_stats().items():
+            stats['buffer_' + name] = value
+        return stats
+        
+    def get_channel_stats(self):
+        """Return a dict of channel stats, keyed by 'server port:client port'"""
+        return self._channels.get_stats()
+        
     def _my_exit_callback(self, child):
         """Child threads call this when they die"""
         if self._modem_svr_conn:
             self._modem_svr_conn.stop()
             self._modem_svr_conn = None
+            self._down_time = time.time()
         if self._modem_svr_sock_h:
             self._modem_svr_sock_h = None
         
@@ -378,21 +760,44 @@ class ModemSvrConnector(threading.Thread):
         """Stop this thread and its child threads"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
             
             
 class XMLRPCThread(BasicXMLRPCThread):
-    def __init__(self, host, port, xfer_rec, log):
+    def __init__(self, host, port, xfer_rec, pkt_sched, modem_svr_connector, log):
         BasicXMLRPCThread.__init__(self, host, port, log)
         self._log = log
         self._xfer_rec = xfer_rec
+        self._pkt_sched = pkt_sched
+        self._modem_svr_connector = modem_svr_connector
         self._server.register_function(self.time_of_last_data_xfer)
+        self._server.register_function(self.get_write_q_stats)
+        self._server.register_function(self.get_link_stats)
+        self._server.register_function(self.get_channel_stats)
            
     def time_of_last_data_xfer(self):
         """Return the time of the most recent non-ping
             data transfer
         """
         return self._xfer_rec.get_time()
+        
+    def get_write_q_stats(self):
+        """Return the modem server pkt scheduler queue depths
+            and pkt counts
+        """
+        return self._pkt_sched.get_stats()
+        
+    def get_link_stats(self):
+        """Return the modem server link counters, throughputs
+            in bits per second and read errors
+        """
+        return self._modem_svr_connector.get_link_stats()
+        
+    def get_channel_stats(self):
+        """Return the counters of each open channel,
+            keyed by 'server port:client port'
+        """
+        return self._modem_svr_connector.get_channel_stats()
 
         
 class XferRec:
@@ -424,9 +829,15 @@ def _run_proxy(log):
     log.info('****** Starting server proxy ******')
     
     xfer_rec = XferRec(log)
+    link_stats = proxy_utils.LinkStats()
+    pkt_sched = proxy_utils.PktScheduler(
+                            weights=svr_proxy_config.channel_weights,
+                            default_weight=svr_proxy_config.default_channel_weight,
+                            stats=link_stats)
     
     try:
-        modem_svr_connector = ModemSvrConnector(xfer_rec, log)
+        modem_svr_connector = ModemSvrConnector(xfer_rec, pkt_sched,
+                                                link_stats, log)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         utils.log_exc_traceback(exc_type, exc_value, exc_traceback, log)
@@ -434,7 +845,8 @@ def _run_proxy(log):
         
     try:
         xmlrpc_thread = XMLRPCThread('localhost',
-                            svr_proxy_config.XMLRPC_port, xfer_rec, log)
+                            svr_proxy_config.XMLRPC_port, xfer_rec,
+                            pkt_sched, modem_svr_connector, log)
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         utils.log_exc_traceback(exc_type, exc_value, exc_traceback, log)
@@ -465,9 +877,60 @@ def _run_proxy(log):
     utils.wait_for_child_threads()
     log.info('****** Exiting server proxy ******')
     
+    
+def _accept_servers(listener, socks):
+    """Accept channel connections until the listener closes"""
+    while True:
+        sock, addr = listener.accept()
+        if sock is None:
+            return
+        socks.append(sock)
+        
+        
+def _test_setup_time(log, n_conns=20):
+    """Measure the setup and stop times of proxied channels
+    
+    Each ServerConnection connects to a local server and is set
+    up when its packetize and depacketize threads are running.
+    """
+    listener = sock_utils.SockListener(log, 'localhost', 0)
+    socks = []
+    accept_thread = threading.Thread(target=_accept_servers,
+                                    args=(listener, socks))
+    accept_thread.start()
+    pkt_sched = proxy_utils.PktScheduler()
+    setup_times = []
+    stop_times = []
+    for i in range(n_conns):
+        start_time = time.time()
+        sc = ServerConnection(pkt_sched, listener.get_sock_port(), 4000 + i, log)
+        setup_times.append(time.time() - start_time)
+        start_time = time.time()
+        sc.stop()
+        stop_times.append(time.time() - start_time)
+    listener.close()
+    accept_thread.join()
+    for sock in socks:
+        utils.close_sock(sock)
+    print 'Channel setup and stop, %d channels' % n_conns
+    print '          mean ms   max ms'
+    for name, times in (('setup', setup_times), ('stop', stop_times)):
+        print '%-8s  %7.1f   %6.1f' % (name, 1000 * sum(times) / len(times),
+                                        1000 * max(times))
+    
 
 if __name__ == '__main__':
     sys.setcheckinterval(global_config.check_interval)
+    if sys.argv[1:] == ['test']:
+        # python svr_proxy.py test
+        log = logs.open('svr_proxy_test',
+                        '/tmp',
+                        logging.INFO,
+                        file_max_bytes = 50000,
+                        num_backup_files = 1)
+        _test_setup_time(log)
+        utils.wait_for_child_threads()
+        sys.exit(0)
     if svr_proxy_config.daemonize:
         utils.daemonize()
     log = logs.open(svr_proxy_config.log_name,
@@ -25,6 +25,63 @@ base_port = global_config.svr_proxy_base_port
 XMLRPC_port =                   base_port + 40
 XMLRPC_URL =                    ''.join(('http://localhost:', str(XMLRPC_port)))
 
+# Proxy protocol options offered to the remote proxy
+# If True, passthrough data is compressed on channels
+#  whose CONNECT packet offers zlib compression.
+compress_passthrough =          True
+# If True, throughput-first channels send jumbo
+#  passthrough packets when the remote proxy offers them.
+jumbo_passthrough =             True
+# If True, channel packets are sequenced and lost packets
+#  retransmitted when the remote proxy offers it.
+#  arq_window = maximum unacknowledged packets per channel
+#  arq_linger = seconds a closing channel waits for its
+#       last packets to be acknowledged
+arq =                           True
+arq_window =                    16
+arq_linger =                    10
+# Seconds sequenced channels are kept after the RUDICS call
+#  drops, waiting to be resumed after re-dial.
+#  0 closes them when the call drops.
+resume_grace =                  600
+# Forward error correction of the modem link.
+# After every fec_data_pkts packets, fec_parity_pkts parity
+#  packets are sent, so up to fec_parity_pkts lost packets
+#  per group are rebuilt by the remote proxy without a
+#  retransmission.  The overhead is fec_parity_pkts / fec_data_pkts.
+# A partial group is closed after fec_flush_delay idle seconds.
+# 0 parity packets disables FEC.  The remote proxy must
+#  decode FEC frames before it is enabled.
+fec_data_pkts =                 8
+fec_parity_pkts =               0
+fec_flush_delay =               0.2
+
+# Passthrough packetizing policy for each local server port
+#  'latency' = send stream data as soon as it arrives,
+#       and set TCP_NODELAY on the server socket
+#  'throughput' = merge stream data into full packets,
+#       waiting up to coalesce_delay seconds for more data
+channel_policies = {
+    global_config.SSH_server_port:      'latency',
+    global_config.file_server_port:     'throughput',
+}
+default_channel_policy =        'latency'
+coalesce_delay =                0.2
+
+# Share of the modem link given to each local server port
+#  when several channels have packets waiting.
+# Control packets are always sent first.
+channel_weights = {
+    global_config.SSH_server_port:      4,
+    global_config.file_server_port:     1,
+}
+default_channel_weight =        2
+
+# If True, the modem server and channel sockets are driven by
+#  one epoll reactor thread instead of a read and a write
+#  thread per socket.
+sock_reactor =                  False
+
 # Miscellaneous
 accept_sigint =                 True
 daemonize =                     False
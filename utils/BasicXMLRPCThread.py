@@ -2,15 +2,109 @@
 
 
 import sys
+import time
+import bisect
 import xmlrpclib
 import SimpleXMLRPCServer
 import threading
 import socket
 import SocketServer
+import Queue
+from errno import EAGAIN, EINTR, ECONNABORTED
 
 import utils
+import sock_rpc
+import global_config
 
-class XMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+
+class KeepAliveRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+        # HTTP/1.1 lets clients keep their connection open
+        #  between requests (see utils.KeepAliveTransport).
+        # A connection that is idle for timeout secs is closed.
+        protocol_version = 'HTTP/1.1'
+        timeout = 60
+        
+
+class PooledRequestHandler(KeepAliveRequestHandler):
+        # Handle one request per turn, the server hands a
+        #  kept alive connection back to a worker when the
+        #  next request arrives.
+        timeout = 10
+        
+        def handle(self):
+            self.close_connection = 1
+            self.handle_one_request()
+            
+
+class DispatchStats:
+    """
+        Per method call counts and latency histograms of an
+        XMLRPC server, returned by its system.stats method
+        
+        Calls in a system.multicall are counted one by one.
+    """
+    # upper bounds of the latency histogram bins, ms.
+    #  The last bin counts the slower calls.
+    LATENCY_BINS_MS = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000]
+    
+    def _init_stats(self):
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        self.register_function(self._system_stats, 'system.stats')
+        
+    def _dispatch(self, method, params):
+        start_time = time.time()
+        ok = False
+        try:
+            result = SimpleXMLRPCServer.SimpleXMLRPCServer._dispatch(self, method, params)
+            ok = True
+            return result
+        finally:
+            if method in self.funcs:
+                self._count_call(method, (time.time() - start_time) * 1000, ok)
+            
+    def _count_call(self, method, ms, ok):
+        self._stats_lock.acquire()
+        try:
+            stats = self._stats.get(method)
+            if stats is None:
+                stats = {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                        'hist': [0] * (len(DispatchStats.LATENCY_BINS_MS) + 1)}
+                self._stats[method] = stats
+            stats['count'] += 1
+            if not ok:
+                stats['errors'] += 1
+            stats['total_ms'] += ms
+            stats['max_ms'] = max(stats['max_ms'], ms)
+            stats['hist'][bisect.bisect_left(DispatchStats.LATENCY_BINS_MS, ms)] += 1
+        finally:
+            self._stats_lock.release()
+            
+    def _server_stats(self):
+        """Return a dict of server wide values for system.stats"""
+        return {}
+        
+    def _system_stats(self):
+        """Return the call counts and latency histograms of the methods
+        
+        Return {'bins_ms': latency bin upper bounds,
+                'methods': {method: {'count', 'errors', 'total_ms',
+                                     'max_ms', 'hist'}},
+                'server': server values}
+        """
+        self._stats_lock.acquire()
+        try:
+            methods = {}
+            for method, stats in self._stats.items():
+                methods[method] = dict(stats, hist=list(stats['hist']))
+        finally:
+            self._stats_lock.release()
+        return {'bins_ms': DispatchStats.LATENCY_BINS_MS,
+                'methods': methods,
+                'server': self._server_stats()}
+                
+
+class XMLRPCServer(DispatchStats, SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
         # Use the ThreadingMixIn to make XMLRPCServer multi-threaded.
         # Following line forces the TCPIP stack to reuse
         #  socket addresses (ports) instead of going though a
@@ -18,42 +112,294 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCS
         # Subclassing SimpleXMLRPCServer seems to be the only way
         #  to make this little trick work.
         allow_reuse_address = True
+        # Connection threads do not hold up process exit
+        daemon_threads = True
+        
+        def __init__(self, *args, **kwargs):
+            SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, *args, **kwargs)
+            self._conns_lock = threading.Lock()
+            self._conns = set()
+            self._init_stats()
+            
+        def process_request(self, request, client_address):
+            self._conns_lock.acquire()
+            self._conns.add(request)
+            self._conns_lock.release()
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+            
+        def shutdown_request(self, request):
+            self._conns_lock.acquire()
+            self._conns.discard(request)
+            self._conns_lock.release()
+            SimpleXMLRPCServer.SimpleXMLRPCServer.shutdown_request(self, request)
+            
+        def close_connections(self):
+            """Shut down the kept alive client connections"""
+            self._conns_lock.acquire()
+            try:
+                for request in self._conns:
+                    try:
+                        request.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+            finally:
+                self._conns_lock.release()
 
 
-class BasicXMLRPCThread(threading.Thread):
+class _XMLRPCWorker(utils.BaseThread):
+    """Handle the requests queued by a PooledXMLRPCServer"""
+    def __init__(self, server, work_q):
+        utils.BaseThread.__init__(self)
+        self._server = server
+        self._work_q = work_q
+        self._stop_event = utils.Wakeup()
+        self.name = 'XMLRPC worker thread'
+        self._start_and_wait()
+        
+    def run(self):
+        self._set_started()
+        while not self._stop_event.isSet():
+            item = utils.q_get(self._work_q, get_timeout=None,
+                                wakeup=self._stop_event)
+            if item is not None:
+                self._server.handle_connection(*item)
+        self._running = False
+        
+        
+class PooledXMLRPCServer(DispatchStats, SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """
+        XMLRPC server with a fixed pool of worker threads
+        
+        serve() waits in select() on the listening socket, the
+        kept alive client connections and a self-pipe.  A
+        connection with a request is queued for the workers, and
+        handed back after one request.  When the queue is full,
+        the connection is closed.  close() wakes serve() at once.
+    """
+    allow_reuse_address = True
+    IDLE_SECS = 60          # kept alive connections idle this long are closed
+    
+    def __init__(self, addr, workers=4, accept_q_size=16, log=None, **kwargs):
+        """
+            addr = (host, port)
+            workers = worker threads
+            accept_q_size = connections with a request that may
+                            wait for a worker
+        """
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, addr,
+                                    requestHandler=PooledRequestHandler, **kwargs)
+        self.socket.setblocking(0)
+        self._log = log
+        self._init_stats()
+        self._wakeup = utils.Wakeup()
+        self._lock = threading.Lock()
+        self._idle = {}         # sock -> (client_address, idle since)
+        self._returned = []     # (sock, client_address) handed back by workers
+        self._busy = 0
+        self.dropped = 0
+        self.connections = 0
+        self._work_q = Queue.Queue(accept_q_size)
+        self._workers = [_XMLRPCWorker(self, self._work_q) for i in range(workers)]
+        
+    def serve(self):
+        """Serve requests until close()"""
+        while not self._wakeup.isSet():
+            self._wakeup.clear_poke()
+            self._take_returned()
+            socks = [self.socket] + self._idle.keys()
+            for sock in self._wakeup.wait_readable_any(socks, self._idle_timeout()):
+                if sock is self.socket:
+                    self._accept()
+                elif sock in self._idle:
+                    addr = self._idle.pop(sock)[0]
+                    if self._is_closed(sock):
+                        self.shutdown_request(sock)
+                    else:
+                        self._queue(sock, addr)
+            self._close_idle()
+        for worker in self._workers:
+            worker.stop()
+        for sock in self._idle.keys():
+            self.shutdown_request(sock)
+        self._idle = {}
+        self._take_returned()
+        for sock in self._idle.keys():
+            self.shutdown_request(sock)
+        self.server_close()
+        self._wakeup.close()
+        
+    def _accept(self):
+        try:
+            sock, addr = self.socket.accept()
+        except socket.error, e:
+            if e.args[0] not in (EAGAIN, EINTR, ECONNABORTED):
+                self._log_error('PooledXMLRPCServer: accept failed: %s' % e)
+            return
+        sock.setblocking(1)
+        self.connections += 1
+        self._queue(sock, addr)
+        
+    def _is_closed(self, sock):
+        """Return True if the client closed a readable connection"""
+        try:
+            return not sock.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            return True
+            
+    def _queue(self, sock, addr):
+        """Queue a connection with a request for the workers"""
+        try:
+            self._work_q.put_nowait((sock, addr))
+        except Queue.Full:
+            self.dropped += 1
+            self._log_error('PooledXMLRPCServer: request queue full, connection closed')
+            self.shutdown_request(sock)
+            
+    def handle_connection(self, sock, addr):
+        """Handle one request, called by the workers"""
+        self._lock.acquire()
+        self._busy += 1
+        self._lock.release()
+        keep = False
+        try:
+            try:
+                handler = self.RequestHandlerClass(sock, addr, self)
+                keep = not handler.close_connection
+            except Exception:
+                self.handle_error(sock, addr)
+        finally:
+            self._lock.acquire()
+            self._busy -= 1
+            if keep and not self._wakeup.isSet():
+                self._returned.append((sock, addr))
+            else:
+                keep = False
+            self._lock.release()
+        if keep:
+            self._wakeup.poke()
+        else:
+            self.shutdown_request(sock)
+            
+    def _take_returned(self):
+        """Watch the connections the workers handed back"""
+        self._lock.acquire()
+        returned = self._returned
+        self._returned = []
+        self._lock.release()
+        now = time.time()
+        for sock, addr in returned:
+            self._idle[sock] = (addr, now)
+            
+    def _idle_timeout(self):
+        """Return the secs until the next idle connection expires"""
+        if not self._idle:
+            return None
+        oldest = min([since for addr, since in self._idle.values()])
+        return max(oldest + PooledXMLRPCServer.IDLE_SECS - time.time(), 0)
+        
+    def _close_idle(self):
+        expire_time = time.time() - PooledXMLRPCServer.IDLE_SECS
+        for sock, (addr, since) in self._idle.items():
+            if since <= expire_time:
+                del self._idle[sock]
+                self.shutdown_request(sock)
+                
+    def handle_error(self, request, client_address):
+        if self._log:
+            self._log.error('PooledXMLRPCServer: exception handling request from %s' % \
+                            str(client_address))
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            utils.log_exc_traceback(exc_type, exc_value, exc_traceback, self._log)
+            
+    def _log_error(self, msg):
+        if self._log:
+            self._log.error(msg)
+            
+    def _server_stats(self):
+        return {'workers': len(self._workers),
+                'busy': self._busy,
+                'queued': self._work_q.qsize(),
+                'idle_connections': len(self._idle),
+                'connections': self.connections,
+                'dropped': self.dropped}
+                
+    def close(self):
+        """Stop serve(), may be called from any thread"""
+        self._wakeup.set()
+        
+
+class LocalRPCServer(sock_rpc.BaseRPCServer):
+    """
+        Serve the functions of an XMLRPC server on a Unix
+        domain socket with the sock_rpc protocol, for local
+        clients (see utils.get_XMLRPC_server_proxy)
+    """
+    def __init__(self, path, xmlrpc_server, log):
+        self._xmlrpc_server = xmlrpc_server
+        sock_rpc.BaseRPCServer.__init__(self, None, None, log, path=path)
+        self.name = ''.join(('Local RPC server thread (', path, ')'))
+        
+    def dispatch(self, name, args):
+        """Call a function of the XMLRPC server, or an rpc. function"""
+        if name in self._functions:
+            return sock_rpc.BaseRPCServer.dispatch(self, name, args)
+        return self._xmlrpc_server._dispatch(name, list(args))
+        
+
+class BasicXMLRPCThread(utils.BaseThread):
     """
         XMLRPC server thread
         
         Accept and execute commands from
          XMLRPC clients
+        
+        workers = None for global_config.xmlrpc_workers,
+                  0 for a thread per request
     """
-    def __init__(self, host, port, log=None):
-        threading.Thread.__init__(self)
+    def __init__(self, host, port, log=None, workers=None):
+        utils.BaseThread.__init__(self)
         self._log = log
-        self.setDaemon(False)
         self._stop_event = threading.Event()
         self._host = host
         self._port = port
+        if workers is None:
+            workers = global_config.xmlrpc_workers
+        self._workers = workers
         self.name = ''.join(('XMLRPC server thread (', self._host, ':', str(self._port), ')' ))
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                 
     def run(self):
         """ The actual thread code """
         #if self._log:
         #    self._log.debug('Starting %s ' % self.name)
-        self._server = XMLRPCServer((self._host, self._port), logRequests=False)
+        if self._workers > 0:
+            self._server = PooledXMLRPCServer((self._host, self._port),
+                                    workers=self._workers,
+                                    accept_q_size=global_config.xmlrpc_accept_q,
+                                    log=self._log, logRequests=False)
+        else:
+            self._server = XMLRPCServer((self._host, self._port),
+                                    requestHandler=KeepAliveRequestHandler,
+                                    logRequests=False)
+            self._server.socket.settimeout(10)
         self._server.register_introspection_functions()        
+        self._server.register_multicall_functions()
         self._server.register_function(self.test)
-        self._server.socket.settimeout(10)
-        self._running = True
-        self._started = True
-        while not self._stop_event.isSet():
-            self._server.handle_request()
-        self._is_running = False
+        self._local_server = None
+        if global_config.local_rpc_enable:
+            try:
+                self._local_server = LocalRPCServer(utils.get_local_rpc_path(self._port),
+                                            self._server, self._log or utils.get_null_log())
+            except Exception, e:
+                if self._log:
+                    self._log.error('%s: local RPC server failed: %s' % (self.name, e))
+        self._set_started()
+        if self._workers > 0:
+            self._server.serve()
+        else:
+            while not self._stop_event.isSet():
+                self._server.handle_request()
+        self._running = False
         #if self._log:
             #self._log.debug('Stopping %s ' % self.name)
             #self._log.debug('Exiting %s ' % self.name)
@@ -70,8 +416,109 @@ class BasicXMLRPCThread(threading.Thread):
     def stop(self):
         """Stop the XMLRPC server thread"""
         if self._running:
-            self._server.socket.shutdown(socket.SHUT_RDWR)
-            self._server.socket.close()        
+            if self._local_server is not None:
+                self._local_server.stop()
+            # set the flag first, so run() does not wait on
+            #  the closed socket
             self._stop_event.set()
-            self.join()
+            if self._workers > 0:
+                self._server.close()
+            else:
+                self._server.socket.shutdown(socket.SHUT_RDWR)
+                self._server.socket.close()        
+                self._server.close_connections()
+            self._join()
+    
+                        
+                        
+def _benchmark(port=44450, n_calls=500):
+    """Compare a new ServerProxy per call, the keep-alive proxy
+        and the local RPC socket
+    
+    CPU times are for the whole process, client and server.
+    """
+    import os
+    import time
+    svr = BasicXMLRPCThread('localhost', port)
+    url = 'http://localhost:%d' % port
+    def run(label, func):
+        start_cpu = os.times()
+        start_time = time.time()
+        conns = func(n_calls)
+        secs = time.time() - start_time
+        cpu = [end - start for start, end in zip(start_cpu, os.times())]
+        print '%-24s %6.3f ms/call  user %6.3f  sys %6.3f ms/call  %d new connections' % \
+                (label, secs * 1000 / n_calls, cpu[0] * 1000 / n_calls,
+                    cpu[1] * 1000 / n_calls, conns)
+    transport = utils.KeepAliveTransport()
+    xml_proxy = xmlrpclib.ServerProxy(url, transport=transport)
+    def new_proxy(n):
+        for i in range(n):
+            xmlrpclib.ServerProxy(url).test()
+        return n
+    def keep_alive(n):
+        for i in range(n):
+            xml_proxy.test()
+        return transport.connects
+    def multicall(n):
+        utils.XMLRPC_multicall(xml_proxy, [('test',)] * n)
+        return 0
+    def local(n):
+        local_proxy = utils.LocalRPCProxy(utils.get_local_rpc_path(port))
+        for i in range(n):
+            local_proxy.test()
+        local_proxy('close')()
+        return 1
+    try:
+        print '%d calls' % n_calls
+        run('new proxy per call', new_proxy)
+        run('keep-alive proxy', keep_alive)
+        run('system.multicall', multicall)
+        if global_config.local_rpc_enable:
+            run('local RPC socket', local)
+    finally:
+        xml_proxy('close')()
+        svr.stop()
+    
+    
+def _benchmark_burst(port=44451, n_clients=16, n_calls=50):
+    """Burst of clients, each calling with a new proxy per call,
+        against a thread per request and the worker pool
+    
+    Print the peak server thread count, the time for the burst,
+    the time to stop the server and the system.stats of test().
+    """
+    import time
+    url = 'http://localhost:%d' % port
+    for workers in (0, global_config.xmlrpc_workers or 4):
+        svr = BasicXMLRPCThread('localhost', port, workers=workers)
+        clients = []
+        base = threading.activeCount() + n_clients
+        peak = [0]
+        def client():
+            for i in range(n_calls):
+                xmlrpclib.ServerProxy(url).test()
+                peak[0] = max(peak[0], threading.activeCount() - base)
+        start_time = time.time()
+        clients = [threading.Thread(target=client) for i in range(n_clients)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        secs = time.time() - start_time
+        stats = xmlrpclib.ServerProxy(url).system.stats()
+        start_time = time.time()
+        svr.stop()
+        stop_secs = time.time() - start_time
+        test = stats['methods']['test']
+        print 'workers %d: %d calls %.3f ms/call  peak new threads %d  stop %.1f ms' % \
+                (workers, test['count'], secs * 1000 / test['count'], peak[0],
+                stop_secs * 1000)
+        print '    test() mean %.3f ms  max %.3f ms  hist %s' % \
+                (test['total_ms'] / test['count'], test['max_ms'], test['hist'])
+        print '    server %s' % stats['server']
+    
     
+if __name__ == '__main__':
+    _benchmark()
+    _benchmark_burst()
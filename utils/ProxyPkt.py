@@ -31,8 +31,78 @@
 # 2 = ICCID
 #     Data field contents:
 #         Bytes 0 through 18: the ICCID number
+#
+# 4 = Connect
+#     Data field contents:
+#         Bytes 0 through 3: Source and destination ports
+#         Byte 4 (optional): capability flags
+#     A proxy that supports optional features appends the
+#     capability flags it offers.  The other proxy answers
+#     with a Connect packet containing the flags it accepted.
+#     Legacy proxies never send or answer the flags byte.
+#
+# 6 = Compressed Passthrough
+#     Data field contents are the same as Passthrough, except
+#     the passthrough data is a raw deflate stream segment.
+#     Each channel direction has its own deflate stream, so the
+#     sliding window is shared by all of the channel's packets.
+#     Every packet ends on a sync flush point.
+#     Only sent when CAP_ZLIB was accepted for the channel.
+#
+# 7 = Jumbo Passthrough
+#     Data field contents are the same as Passthrough.
+#     The total packet length can be up to MAX_JUMBO_PKT_LEN.
+#     Only sent when CAP_JUMBO was accepted for the channel.
+#
+# 8 = Sequenced
+#     Wraps a channel packet for reliable delivery.
+#     Data field contents:
+#         Bytes 0 through 3: Source and destination ports
+#         Byte 4: Sequence number LSB
+#         Byte 5: Sequence number MSB
+#         Byte 6: Type of the wrapped packet
+#         Bytes 7 through N: data of the wrapped packet
+#             following its ports
+#     Sequence numbers are per channel direction, start at 0
+#     and wrap at 65536.
+#     Only sent when CAP_ARQ was accepted for the channel.
+#
+# 9 = Ack
+#     Acknowledges Sequenced packets.
+#     Data field contents:
+#         Bytes 0 through 3: Source and destination ports
+#         Bytes 4 and 5: Cumulative ack, the sequence number of
+#             the last packet received in order (LSB first)
+#         Bytes 6 through N: Sequence numbers of missing packets
+#             (selective NAKs, 2 bytes each, LSB first)
+#
+# 10 = FEC
+#     Forward error correction frame.  Packets are sent in
+#     groups of up to k data frames followed by m parity frames.
+#     Data field contents:
+#         Byte 0: Group number (wraps at 256)
+#         Byte 1: Index of the frame in its data or parity frames
+#         Byte 2: k, 0 in a data frame
+#         Byte 3: m, 0 in a data frame
+#         Bytes 4 through N: a data frame holds a whole proxy
+#             packet.  A parity frame holds Reed-Solomon parity
+#             of the group's packets, zero padded to the length
+#             of the longest one.
+#     Any k frames of a group recover its k packets.
+#
+# 11 = Resume
+#     Re-attaches a sequenced channel after the RUDICS call
+#     was dropped and re-dialed.
+#     Data field contents:
+#         Bytes 0 through 3: Source and destination ports
+#         Bytes 4 and 5: Sequence number of the next packet the
+#             sender expects on the channel (LSB first)
+#     Each proxy sends one for every channel it kept across the
+#     drop and answers the other's with its own.  A proxy that
+#     no longer has the channel answers with a Disconnect.
 
 import sys
+import struct
 
 import utils
 
@@ -57,8 +127,14 @@ class ProxyPkt:
     PING = 3
     CONNECT = 4
     DISCONNECT = 5
+    COMPRESSED_PASSTHROUGH = 6
+    JUMBO_PASSTHROUGH = 7
+    SEQ = 8
+    ACK = 9
+    FEC = 10
+    RESUME = 11
     MIN_PKT_TYPE = 0
-    MAX_PKT_TYPE = 5
+    MAX_PKT_TYPE = 11
     
     # Passthrough, Connect and Disconnect
     #   Packet Byte Offsets
@@ -67,7 +143,15 @@ class ProxyPkt:
     DEST_PORT_LSB = DATA + 2
     DEST_PORT_MSB = DATA + 3
     PASSTHROUGH_DATA = DATA + 4
-
+    CONNECT_CAPS = PASSTHROUGH_DATA
+    
+    # Connect packet capability flags
+    CAP_ZLIB = 0x01
+    CAP_JUMBO = 0x02
+    CAP_ARQ = 0x04
+    
+    # Compressed passthrough deflate window (raw stream, 4KB window)
+    ZLIB_WBITS = -12
     
     # Sync byte values
     SYNC_BYTE_0_VALUE = '\xAA'
@@ -84,7 +168,14 @@ class ProxyPkt:
     MIN_PKT_LEN = 9
     MAX_PKT_LEN = 512
     MAX_PASSTHROUGH_DATA_LEN = MAX_PKT_LEN - MIN_PKT_LEN - PASSTHROUGH_DATA
+    MAX_JUMBO_PKT_LEN = 4096
+    MAX_JUMBO_PASSTHROUGH_DATA_LEN = MAX_JUMBO_PKT_LEN - MIN_PKT_LEN - \
+                                        (PASSTHROUGH_DATA - DATA)
     CKSUM_LEN = 2
+    SEQ_HDR_LEN = 3
+    SEQ_MODULUS = 65536
+    FEC_HDR_LEN = 4
+    MAX_FEC_PKT_LEN = MAX_JUMBO_PKT_LEN + MIN_PKT_LEN + FEC_HDR_LEN
        
     def __init__(self, pkt_buf=''):
         """Create a proxy packet object
@@ -97,29 +188,7 @@ class ProxyPkt:
         Store the new packet in self._pkt_buf
         Return self._pkt_buf
         """
-        # For speed, build the pkt using only
-        #  one string concatenation operation
-        parts = []
-        parts.append(ProxyPkt.SYNC_CODE_STR)
-        #print 'SYNC_CODE_STR is %s' % utils.bytes_to_hex(parts[0])
-        if data is None:
-            data_len = 0
-        else:
-            data_len = len(data)
-        pkt_len = data_len + ProxyPkt.MIN_PKT_LEN
-        len_lsb = pkt_len % 256
-        len_msb = pkt_len / 256
-        parts.append(chr(len_lsb))
-        parts.append(chr(len_msb))
-        parts.append(chr(type))
-        if data_len > 0:
-            parts.append(data)       
-        cksum = (utils.str_sum(ProxyPkt.SYNC_CODE_STR) + \
-                len_lsb + len_msb + type + \
-                utils.str_sum(data)) & 0xFFFF        
-        parts.append(chr(cksum % 256))
-        parts.append(chr(cksum / 256))
-        self._pkt_buf = ''.join(parts)
+        self._pkt_buf = _build_pkt(type, data)
         return self._pkt_buf
         
     def get_pkt_buf(self):
@@ -230,6 +299,18 @@ class ProxyPkt:
                 parts.append(' (CONNECT)\n')
             elif type == ProxyPkt.DISCONNECT:
                 parts.append(' (DISCONNECT)\n')
+            elif type == ProxyPkt.COMPRESSED_PASSTHROUGH:
+                parts.append(' (compressed passthrough)\n')
+            elif type == ProxyPkt.JUMBO_PASSTHROUGH:
+                parts.append(' (jumbo passthrough)\n')
+            elif type == ProxyPkt.SEQ:
+                parts.append(' (sequenced)\n')
+            elif type == ProxyPkt.ACK:
+                parts.append(' (ACK)\n')
+            elif type == ProxyPkt.FEC:
+                parts.append(' (FEC)\n')
+            elif type == ProxyPkt.RESUME:
+                parts.append(' (RESUME)\n')
             else:
                 parts.append(' (unknown type)\n')
             
@@ -260,46 +341,249 @@ def PingPkt():
         
 def PassthroughPkt(src_port, dest_port, data):
     """Return a string containing a passthrough packet"""
-    src_port_lsb = chr(src_port % 256)
-    src_port_msb = chr(src_port / 256)
-    dest_port_lsb = chr(dest_port % 256)
-    dest_port_msb = chr(dest_port / 256)
-    parts = []
-    parts.append(src_port_lsb)
-    parts.append(src_port_msb)
-    parts.append(dest_port_lsb)
-    parts.append(dest_port_msb)
-    parts.append(data)
-    pkt = ProxyPkt()
-    return pkt.build(ProxyPkt.PASSTHROUGH, ''.join(parts))
-    
-def ConnectPkt(src_port, dest_port):
-    """Return a string containing a CONNECT packet"""
-    src_port_lsb = chr(src_port % 256)
-    src_port_msb = chr(src_port / 256)
-    dest_port_lsb = chr(dest_port % 256)
-    dest_port_msb = chr(dest_port / 256)
-    parts = []
-    parts.append(src_port_lsb)
-    parts.append(src_port_msb)
-    parts.append(dest_port_lsb)
-    parts.append(dest_port_msb)
-    pkt = ProxyPkt()
-    return pkt.build(ProxyPkt.CONNECT, ''.join(parts))
+    return _build_pkt(ProxyPkt.PASSTHROUGH, data, (src_port, dest_port))
+    
+def JumboPassthroughPkt(src_port, dest_port, data):
+    """Return a string containing a jumbo passthrough packet"""
+    return _build_pkt(ProxyPkt.JUMBO_PASSTHROUGH, data, (src_port, dest_port))
+    
+def CompressedPassthroughPkt(src_port, dest_port, data):
+    """Return a string containing a compressed passthrough packet
+    
+    data = deflate stream segment
+    """
+    return _build_pkt(ProxyPkt.COMPRESSED_PASSTHROUGH, data, (src_port, dest_port))
+    
+def ConnectPkt(src_port, dest_port, caps=None):
+    """Return a string containing a CONNECT packet
+    
+    caps = None or capability flags
+    """
+    if caps is None:
+        return _build_pkt(ProxyPkt.CONNECT, None, (src_port, dest_port))
+    return _build_pkt(ProxyPkt.CONNECT, chr(caps), (src_port, dest_port))
     
 def DisconnectPkt(src_port, dest_port):
     """Return a string containing a DISCONNECT packet"""
-    src_port_lsb = chr(src_port % 256)
-    src_port_msb = chr(src_port / 256)
-    dest_port_lsb = chr(dest_port % 256)
-    dest_port_msb = chr(dest_port / 256)
-    parts = []
-    parts.append(src_port_lsb)
-    parts.append(src_port_msb)
-    parts.append(dest_port_lsb)
-    parts.append(dest_port_msb)
-    pkt = ProxyPkt()
-    return pkt.build(ProxyPkt.DISCONNECT, ''.join(parts))                  
+    return _build_pkt(ProxyPkt.DISCONNECT, None, (src_port, dest_port))
+    
+def SeqPkt(src_port, dest_port, seq, inner_type, data=None):
+    """Return a string containing a sequenced packet
+    
+    inner_type = type of the wrapped packet
+    data = data of the wrapped packet, following its ports
+    """
+    return _build_pkt(ProxyPkt.SEQ, data, (src_port, dest_port),
+                        _SEQ_STRUCT.pack(seq, inner_type))
+    
+def AckPkt(src_port, dest_port, cum_ack, naks=()):
+    """Return a string containing an ACK packet
+    
+    cum_ack = sequence number of the last packet received in order
+    naks = sequence numbers of missing packets
+    """
+    data = struct.pack('<%dH' % (len(naks) + 1), cum_ack, *naks)
+    return _build_pkt(ProxyPkt.ACK, data, (src_port, dest_port))
+    
+def ResumePkt(src_port, dest_port, next_seq):
+    """Return a string containing a RESUME packet
+    
+    next_seq = sequence number of the next packet expected
+    """
+    return _build_pkt(ProxyPkt.RESUME, _SEQ_NUM_STRUCT.pack(next_seq),
+                        (src_port, dest_port))
+    
+def FecPkt(group, index, k, m, data):
+    """Return a string containing an FEC frame
+    
+    k, m = 0 for a data frame, else the group's data and parity
+            frame counts
+    data = a whole proxy packet or parity bytes
+    """
+    return _build_pkt(ProxyPkt.FEC, data, None,
+                        _FEC_STRUCT.pack(group, index, k, m))
+
+
+# Precompiled packet field layouts
+_HDR_STRUCT = struct.Struct('<4sHB')     # sync code, length, type
+_PORTS_STRUCT = struct.Struct('<HH')     # source port, destination port
+_CKSUM_STRUCT = struct.Struct('<H')
+_SEQ_STRUCT = struct.Struct('<HB')      # sequence number, wrapped pkt type
+_FEC_STRUCT = struct.Struct('<BBBB')    # group, index, k, m
+_SEQ_NUM_STRUCT = struct.Struct('<H')
+_PORTS_LEN = _PORTS_STRUCT.size
+
+
+def max_pkt_len(pkt_type):
+    """Return the maximum total length of a pkt_type packet"""
+    if (pkt_type == ProxyPkt.JUMBO_PASSTHROUGH) or (pkt_type == ProxyPkt.SEQ):
+        return ProxyPkt.MAX_JUMBO_PKT_LEN
+    if pkt_type == ProxyPkt.FEC:
+        return ProxyPkt.MAX_FEC_PKT_LEN
+    return ProxyPkt.MAX_PKT_LEN
+
+
+def buf_cksum(buf, start=0, end=None):
+    """Return the 16 bit proxy packet checksum of buf[start:end]
+    
+    buf can be any object that supports the buffer interface
+    (string, bytearray or memoryview).  The bytes are unpacked
+    from buf where they are, into a tuple of ints that is summed,
+    so buf is not sliced or copied.
+    """
+    if end is None:
+        end = len(buf)
+    if end <= start:
+        return 0
+    return sum(struct.unpack_from('%dB' % (end - start), buf, start)) & 0xFFFF
+
+
+def _build_pkt(type, data=None, ports=None, prefix=None):
+    """Build a packet from its fields with one string join
+    
+    ports = None or (src_port, dest_port)
+    prefix = None or a string placed between the ports and data
+    Return a string containing the packet.
+    """
+    parts = [None]
+    if ports is not None:
+        parts.append(_PORTS_STRUCT.pack(ports[0], ports[1]))
+    if prefix is not None:
+        parts.append(prefix)
+    if data:
+        if not isinstance(data, str):
+            data = memoryview(data).tobytes()
+        parts.append(data)
+    pkt_len = ProxyPkt.HDR_LEN + sum([len(part) for part in parts[1:]]) + \
+                ProxyPkt.CKSUM_LEN
+    parts[0] = _HDR_STRUCT.pack(ProxyPkt.SYNC_CODE_STR, pkt_len, type)
+    cksum = 0
+    for part in parts:
+        cksum += buf_cksum(part)
+    parts.append(_CKSUM_STRUCT.pack(cksum & 0xFFFF))
+    return ''.join(parts)
+
+
+class ProxyPktView(object):
+    """Read-only view of a received proxy packet
+    
+    The header is decoded once, when the view is created.
+    Data accessors return memoryviews of the packet buffer
+    instead of copies.  Accessor names match ProxyPkt, so a
+    view can be used wherever a received ProxyPkt is used.
+    A view of a SEQ packet looks like the packet it wraps,
+    plus a sequence number.
+    """
+    __slots__ = ('_pkt_buf', '_len', '_type', '_src_port', '_dest_port',
+                '_seq', '_data_i')
+    
+    def __init__(self, pkt_buf):
+        """pkt_buf = string containing a whole packet"""
+        self._pkt_buf = pkt_buf
+        try:
+            sync, self._len, self._type = _HDR_STRUCT.unpack_from(pkt_buf)
+        except struct.error:
+            self._len = 0
+            self._type = 0
+        if self._len - ProxyPkt.MIN_PKT_LEN >= _PORTS_LEN:
+            self._src_port, self._dest_port = \
+                    _PORTS_STRUCT.unpack_from(pkt_buf, ProxyPkt.DATA)
+        else:
+            self._src_port = 0
+            self._dest_port = 0
+        self._seq = None
+        self._data_i = ProxyPkt.PASSTHROUGH_DATA
+        if (self._type == ProxyPkt.SEQ) and \
+                (self.get_data_len() >= _PORTS_LEN + ProxyPkt.SEQ_HDR_LEN):
+            self._seq, self._type = _SEQ_STRUCT.unpack_from(pkt_buf,
+                                                ProxyPkt.PASSTHROUGH_DATA)
+            self._data_i += ProxyPkt.SEQ_HDR_LEN
+            
+    def get_pkt_buf(self):
+        """Return a string containing the entire packet"""
+        return self._pkt_buf
+        
+    def get_len(self):
+        """Return the value of the length field"""
+        return self._len
+        
+    def get_type(self):
+        """Return the value of the type field
+        
+        For a SEQ packet, return the type of the wrapped packet.
+        """
+        return self._type
+        
+    def get_seq(self):
+        """Return the sequence number of a SEQ packet, otherwise None"""
+        return self._seq
+        
+    def get_data_len(self):
+        """Return the number of data bytes"""
+        return self._len - ProxyPkt.MIN_PKT_LEN
+        
+    def get_data(self):
+        """Return a memoryview of the data field"""
+        return memoryview(self._pkt_buf)[ProxyPkt.DATA:self._len - ProxyPkt.CKSUM_LEN]
+        
+    def get_src_port(self):
+        """Return the packet source port"""
+        return self._src_port
+        
+    def get_dest_port(self):
+        """Return the packet destination port"""
+        return self._dest_port
+        
+    def get_passthrough_data_len(self):
+        """Return the number of bytes of passthrough data
+            not including src and dest port numbers"""
+        return max(self._len - ProxyPkt.CKSUM_LEN - self._data_i, 0)
+        
+    def get_passthrough_data(self):
+        """Return a memoryview of the passthrough data"""
+        start_i = self._data_i
+        return memoryview(self._pkt_buf)[start_i:start_i + self.get_passthrough_data_len()]
+        
+    def get_passthrough_buffer(self):
+        """Return a read-only buffer of the passthrough data,
+            for functions like zlib's that do not take a memoryview
+        """
+        return buffer(self._pkt_buf, self._data_i, self.get_passthrough_data_len())
+        
+    def get_resume_seq(self):
+        """Return the next expected sequence number from a RESUME packet"""
+        if self.get_passthrough_data_len() < _SEQ_NUM_STRUCT.size:
+            return None
+        return _SEQ_NUM_STRUCT.unpack_from(self._pkt_buf, self._data_i)[0]
+        
+    def get_ack(self):
+        """Return (cum_ack, naks) from an ACK packet"""
+        n = self.get_passthrough_data_len() / 2
+        if n < 1:
+            return (None, [])
+        acks = struct.unpack_from('<%dH' % n, self._pkt_buf, self._data_i)
+        return (acks[0], list(acks[1:]))
+        
+    def get_caps(self):
+        """Return the capability flags of a CONNECT packet
+        
+        Return 0 if the packet has no flags byte.
+        """
+        if self.get_passthrough_data_len() < 1:
+            return 0
+        return ord(self._pkt_buf[ProxyPkt.CONNECT_CAPS])
+        
+    def cksum_is_valid(self):
+        """Return True if the pkt checksum is valid"""
+        cksum_i = self._len - ProxyPkt.CKSUM_LEN
+        if (cksum_i < ProxyPkt.DATA) or (len(self._pkt_buf) < self._len):
+            return False
+        stored_cksum = _CKSUM_STRUCT.unpack_from(self._pkt_buf, cksum_i)[0]
+        return buf_cksum(self._pkt_buf, 0, cksum_i) == stored_cksum
+        
+    def str(self):
+        """Return the pkt contents in printable form"""
+        return ProxyPkt(self._pkt_buf).str()
                      
    
        
@@ -341,6 +625,13 @@ if __name__ == '__main__':
     pkt_buf =  PassthroughPkt(5, 6, '\x01\x02\x03')
     pkt = ProxyPkt(pkt_buf)
     print pkt.str()
+    
+    print "Viewing the passthrough packet with a ProxyPktView"
+    view = ProxyPktView(pkt_buf)
+    print '  src = %d, dest = %d, data = %s, checksum valid = %s' % \
+            (view.get_src_port(), view.get_dest_port(),
+            utils.bytes_to_hex(view.get_passthrough_data().tobytes()),
+            view.cksum_is_valid())
           
     print 'Exiting ProxyPkt test'
     
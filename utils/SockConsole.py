@@ -11,13 +11,12 @@ import sock_utils
 import logs
 
 
-class SockConsole(threading.Thread):
+class SockConsole(utils.BaseThread):
     """ Connect to console client and handle input and output """
     def __init__(self, host, port, log, exit_callback=None):
         """
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._log = log
         self._exit_callback = exit_callback
         self._host = host
@@ -25,51 +24,47 @@ class SockConsole(threading.Thread):
         self._console_sock_h = None
         self._console_read_q = None
         self._console_write_q = None
+        self._listener = None
         self._stop_event = threading.Event()
         self.name = 'SockConsole thread'
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                                         
     def run(self):
         """The actual thread code"""
         #self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
+        self._listener = sock_utils.SockListener(self._log, self._host,
+                                                self._port, backlog=1)
         
         while not self._stop_event.isSet():
             if self._console_sock_h:
                 self._stop_event.wait(0.5)
                 continue
             #self._log.debug('SockConsole: waiting for client to connect')
-            sock, addr, connected_flag = \
-                        sock_utils.connect_to_client(self._log,
-                                                    self._host,
-                                                    self._port,
-                                                    self._stop_event)
-            #self._log.debug('SockConsole: returned from sock_utils.connect_to_client')
+            sock, addr = self._listener.accept()
+            #self._log.debug('SockConsole: returned from SockListener.accept')
+            if sock is None:
+                continue
             if self._stop_event.isSet():
+                utils.close_sock(sock)
                 continue
-            if connected_flag:
-                #self._log.debug('SockConsole: connected_flag is true')
-                self._console_sock_h = sock_utils.SockHandler(sock,
-                                     self._log,
-                                     log_all_data=False,
-                                     read_data_q=Queue.Queue(),
-                                     write_data_q=Queue.Queue(),
-                                     hand_exit_callback=self._my_exit_callback,
-                                     type='stream')
-                #self._log.debug('SockConsole: returned from sock_utils.SockHandler ')
-                self._log.debug('SockConsole: connected to client')
-                self._log.debug('  client port is %s' % str(self._console_sock_h.get_peer_port()))
-                self._log.debug('  local port is %s' % str(self._console_sock_h.get_sock_port()))                
-                self._console_read_q = self._console_sock_h.get_read_q()
-                self._console_write_q = self._console_sock_h.get_write_q()
+            self._console_sock_h = sock_utils.SockHandler(sock,
+                                 self._log,
+                                 log_all_data=False,
+                                 read_data_q=Queue.Queue(),
+                                 write_data_q=Queue.Queue(),
+                                 hand_exit_callback=self._my_exit_callback,
+                                 type='stream')
+            #self._log.debug('SockConsole: returned from sock_utils.SockHandler ')
+            self._log.debug('SockConsole: connected to client')
+            self._log.debug('  client port is %s' % str(self._console_sock_h.get_peer_port()))
+            self._log.debug('  local port is %s' % str(self._console_sock_h.get_sock_port()))                
+            self._console_read_q = self._console_sock_h.get_read_q()
+            self._console_write_q = self._console_sock_h.get_write_q()
             
         self._running = False
         #self._log.debug('Stopping %s ' % self.name)
+        self._listener.close()
         self._stop_children()
         if self._exit_callback:
             self._exit_callback(self)
@@ -114,6 +109,7 @@ class SockConsole(threading.Thread):
         """Stop this thread and its child threads"""
         if self._running:
             self._stop_event.set()
-            # force connect_to_client to return
-            sock_utils.dummy_connection(self._host, self._port)
-            self.join()
+            if self._listener is not None:
+                # wake the accept() wait
+                self._listener.close()
+            self._join()
@@ -0,0 +1,360 @@
+# Forward error correction for proxy packets
+#
+# There are two exposed classes:
+#     FecEncoder
+#     FecDecoder
+#
+# FecEncoder wraps a packet queue.  The socket write thread reads
+# FEC frames from it: each packet in a data frame, and after every
+# group of k packets, m Reed-Solomon parity frames.
+#
+# FecDecoder takes the packets assembled by a PktFramer, unwraps
+# data frames and rebuilds the packets of frames that were
+# corrupted (dropped by the framer's checksum test) from the
+# group's parity frames.  Packets are released in order.
+#
+# The code is a systematic Reed-Solomon erasure code over GF(256)
+# with a Cauchy parity matrix, so any k frames of a group recover
+# its k packets.  Each column of bytes across the group is one
+# code word.
+
+import time
+import struct
+import Queue
+import binascii
+from collections import deque
+
+from ProxyPkt import ProxyPkt, FecPkt, buf_cksum
+
+
+# GF(256) arithmetic, primitive polynomial x^8 + x^4 + x^3 + x^2 + 1
+_GF_EXP = [0] * 512
+_GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    _GF_EXP[_i] = _x
+    _GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11D
+for _i in range(255, 512):
+    _GF_EXP[_i] = _GF_EXP[_i - 255]
+del _x, _i
+
+# Multiply-by-constant translate tables, built on first use
+_mul_tables = {}
+
+_FEC_STRUCT = struct.Struct('<BBBB')    # group, index, k, m
+_LEN_STRUCT = struct.Struct('<H')
+_FEC_DATA = ProxyPkt.DATA + ProxyPkt.FEC_HDR_LEN
+MAX_GROUP_FRAMES = 255
+
+
+def _gf_mul(a, b):
+    if (a == 0) or (b == 0):
+        return 0
+    return _GF_EXP[_GF_LOG[a] + _GF_LOG[b]]
+
+
+def _gf_inv(a):
+    return _GF_EXP[255 - _GF_LOG[a]]
+
+
+def _mul_table(c):
+    """Return the str.translate table that multiplies bytes by c"""
+    table = _mul_tables.get(c)
+    if table is None:
+        table = ''.join([chr(_gf_mul(c, b)) for b in range(256)])
+        _mul_tables[c] = table
+    return table
+
+
+def _parity_coef(row, col, k):
+    """Return the Cauchy matrix element for parity row, data column"""
+    return _gf_inv((k + row) ^ col)
+
+
+def _lin_comb(coefs, bufs, length):
+    """Return the GF(256) sum of coefs[i] * bufs[i]
+
+    bufs = strings of length bytes
+    The products are computed with str.translate and summed (xor)
+    as long integers, so the work is done a string at a time.
+    """
+    acc = 0
+    for c, buf in zip(coefs, bufs):
+        if c == 0:
+            continue
+        if c != 1:
+            buf = buf.translate(_mul_table(c))
+        acc ^= int(binascii.hexlify(buf), 16)
+    return binascii.unhexlify('%0*x' % (2 * length, acc))
+
+
+def _gf_invert_matrix(matrix):
+    """Return the inverse of a square GF(256) matrix (list of rows)"""
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)]
+            for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = col
+        while rows[pivot][col] == 0:
+            pivot += 1
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv = _gf_inv(rows[col][col])
+        rows[col] = [_gf_mul(inv, v) for v in rows[col]]
+        for r in range(n):
+            f = rows[r][col]
+            if (r != col) and f:
+                rows[r] = [v ^ _gf_mul(f, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def _pad(buf, length):
+    return buf + '\x00' * (length - len(buf))
+
+
+class FecEncoder:
+    """Read proxy packets from a queue, return FEC frames
+
+    Used in place of the packet queue by a socket write thread.
+    Every packet goes out at once in a data frame.  The parity
+    frames follow when the group has data_pkts packets, or when
+    no packet arrives for flush_delay seconds, so a short burst
+    of traffic is protected without waiting for a full group.
+    """
+    def __init__(self, pkt_q, data_pkts=8, parity_pkts=2, flush_delay=0.2):
+        """
+        pkt_q = source of packet strings, Queue.Queue or PktScheduler
+        data_pkts = k, packets per group
+        parity_pkts = m, parity frames per group.
+                        m/k is the bandwidth overhead.  Up to m
+                        lost frames per group are recovered.
+        flush_delay = seconds to wait for more packets before
+                        closing a partial group
+        """
+        if (data_pkts < 1) or (parity_pkts < 1) or \
+                (data_pkts + parity_pkts > MAX_GROUP_FRAMES):
+            raise ValueError, 'invalid FEC group size %d + %d' % \
+                                (data_pkts, parity_pkts)
+        self._pkt_q = pkt_q
+        self._k = data_pkts
+        self._m = parity_pkts
+        self._flush_delay = flush_delay
+        self._group_num = 0
+        self._group = []
+        self._flush_time = 0
+        self._frames = deque()
+        self.data_frames = 0
+        self.parity_frames = 0
+
+    def put(self, pkt_buf, block=True, timeout=None):
+        """Enqueue a packet string on the source queue"""
+        self._pkt_q.put(pkt_buf, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        """Return the next FEC frame
+
+        Raise Queue.Empty if there is none, like Queue.get()
+        """
+        if not self._frames:
+            self._next_frames(block, timeout)
+        if not self._frames:
+            raise Queue.Empty
+        return self._frames.popleft()
+
+    def _next_frames(self, block, timeout):
+        """Wait for the next packet or the group flush time"""
+        if self._group:
+            wait = max(self._flush_time - time.time(), 0)
+            if timeout is not None:
+                wait = min(wait, timeout)
+        else:
+            wait = timeout
+        if not block:
+            wait = 0
+        try:
+            pkt_buf = self._pkt_q.get(wait != 0, wait)
+        except Queue.Empty:
+            if self._group and (time.time() >= self._flush_time):
+                self._end_group()
+            return
+        if not self._group:
+            self._flush_time = time.time() + self._flush_delay
+        self._frames.append(FecPkt(self._group_num, len(self._group), 0, 0, pkt_buf))
+        self.data_frames += 1
+        self._group.append(pkt_buf)
+        if len(self._group) >= self._k:
+            self._end_group()
+
+    def _end_group(self):
+        """Queue the parity frames of the current group"""
+        k = len(self._group)
+        length = max([len(pkt_buf) for pkt_buf in self._group])
+        padded = [_pad(pkt_buf, length) for pkt_buf in self._group]
+        for row in range(self._m):
+            coefs = [_parity_coef(row, col, k) for col in range(k)]
+            self._frames.append(FecPkt(self._group_num, row, k, self._m,
+                                        _lin_comb(coefs, padded, length)))
+        self.parity_frames += self._m
+        self._group = []
+        self._group_num = (self._group_num + 1) % 256
+
+    def get_stats(self):
+        """Return a dict of encoder counters"""
+        return {'data_frames': self.data_frames,
+                'parity_frames': self.parity_frames}
+
+
+class FecDecoder:
+    """Unwrap FEC frames and recover lost packets
+
+    Frames arrive in order on the stream, so a lost frame shows
+    up as a gap in a group's data frame indexes.  Packets after
+    a gap are held until the group's parity frames fill it, the
+    next group starts, or no frame of the group arrives for
+    hold_time seconds.  Packets that are not FEC frames are
+    passed through unchanged.
+    """
+    def __init__(self, log, hold_time=3.0):
+        """
+        log = log object
+        hold_time = seconds to hold packets waiting for parity
+        """
+        self._log = log
+        self._hold_time = hold_time
+        self._group_num = None
+        self._done_group_num = None
+        self._next_index = 0
+        self._data = {}         # index -> packet, current group
+                                #  (kept after release for recovery)
+        self._parity = {}       # index -> parity bytes, current group
+        self._k = None
+        self._m = None
+        self._last_frame_time = 0
+        self.recovered_pkts = 0
+        self.lost_pkts = 0
+        self.parity_frames = 0
+
+    def decode(self, pkt_buf):
+        """Return the list of packets released by pkt_buf"""
+        if ord(pkt_buf[ProxyPkt.TYPE]) != ProxyPkt.FEC:
+            return [pkt_buf]
+        out = []
+        group, index, k, m = _FEC_STRUCT.unpack_from(pkt_buf, ProxyPkt.DATA)
+        payload = pkt_buf[_FEC_DATA:-ProxyPkt.CKSUM_LEN]
+        if group == self._done_group_num:
+            # parity of a group that needed no repair
+            return out
+        if group != self._group_num:
+            self._end_group(out)
+            self._group_num = group
+        self._last_frame_time = time.time()
+        if k == 0:
+            self._data[index] = payload
+        elif self._k is None or self._k == k:
+            self._k = k
+            self._m = m
+            self._parity[index] = payload
+            self.parity_frames += 1
+            self._recover()
+        self._release(out)
+        if (self._k is not None) and (self._next_index >= self._k):
+            # group complete, ignore its remaining parity frames
+            done_group_num = self._group_num
+            self._reset()
+            self._done_group_num = done_group_num
+        elif (self._m is not None) and (index == self._m - 1) and (k != 0):
+            # last parity frame and still missing packets
+            self._end_group(out)
+        return out
+
+    def get_expire_time(self):
+        """Return the time held packets expire, None if none are held"""
+        if len(self._data) > self._next_index:
+            return self._last_frame_time + self._hold_time
+        return None
+
+    def expire(self):
+        """Return held packets whose group timed out"""
+        out = []
+        if (len(self._data) > self._next_index) and \
+                (time.time() - self._last_frame_time > self._hold_time):
+            self._end_group(out)
+        return out
+
+    def _release(self, out):
+        """Move in order packets to out"""
+        while self._next_index in self._data:
+            out.append(self._data[self._next_index])
+            self._next_index += 1
+
+    def _end_group(self, out):
+        """Give up on missing packets, release the held ones"""
+        if self._k is not None:
+            end = self._k
+        elif self._data:
+            end = max(self._data.keys()) + 1
+        else:
+            end = 0
+        for index in range(self._next_index, end):
+            if index in self._data:
+                out.append(self._data[index])
+            else:
+                self.lost_pkts += 1
+        self._reset()
+
+    def _reset(self):
+        self._group_num = None
+        self._done_group_num = None
+        self._next_index = 0
+        self._data = {}
+        self._parity = {}
+        self._k = None
+        self._m = None
+
+    def _recover(self):
+        """Rebuild missing data packets if there is enough parity"""
+        k = self._k
+        missing = [i for i in range(k) if i not in self._data]
+        if not missing or (len(missing) > len(self._parity)):
+            return
+        rows = sorted(self._parity.keys())[:len(missing)]
+        length = len(self._parity[rows[0]])
+        known = [i for i in range(k) if i in self._data]
+        # Parity minus the contribution of the known packets
+        #  leaves a system in the missing packets only
+        known_bufs = [_pad(self._data[i], length) for i in known]
+        syndromes = []
+        for row in rows:
+            coefs = [1] + [_parity_coef(row, col, k) for col in known]
+            syndromes.append(_lin_comb(coefs,
+                                [self._parity[row]] + known_bufs, length))
+        inv = _gf_invert_matrix([[_parity_coef(row, col, k) for col in missing]
+                                    for row in rows])
+        for i, index in enumerate(missing):
+            pkt_buf = self._unpad(_lin_comb(inv[i], syndromes, length))
+            if pkt_buf is None:
+                self._log.error('FEC recovered an invalid packet')
+                continue
+            self._data[index] = pkt_buf
+            self.recovered_pkts += 1
+
+    def _unpad(self, buf):
+        """Return the packet at the start of buf, None if not valid"""
+        if (len(buf) < ProxyPkt.MIN_PKT_LEN) or \
+                (buf[:ProxyPkt.LEN_LSB] != ProxyPkt.SYNC_CODE_STR):
+            return None
+        pkt_len = _LEN_STRUCT.unpack_from(buf, ProxyPkt.LEN_LSB)[0]
+        if (pkt_len > len(buf)) or (pkt_len < ProxyPkt.MIN_PKT_LEN):
+            return None
+        cksum_i = pkt_len - ProxyPkt.CKSUM_LEN
+        if buf_cksum(buf, 0, cksum_i) != _LEN_STRUCT.unpack_from(buf, cksum_i)[0]:
+            return None
+        return buf[:pkt_len]
+
+    def get_stats(self):
+        """Return a dict of decoder counters"""
+        return {'recovered_pkts': self.recovered_pkts,
+                'lost_pkts': self.lost_pkts,
+                'parity_frames': self.parity_frames}
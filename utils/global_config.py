@@ -54,4 +54,45 @@ field_bin_dir =             '/aal-pip/field/bin'
 # Global value for sys.setcheckinterval()
 check_interval =            25
 
+# Socket queue limits, bytes.
+# A socket queue stops taking data at sock_q_max_bytes.
+#  The producer blocks, and a socket read thread stops
+#  reading, so the pressure reaches the sender.
+# sock_buffer_budget caps the data held by all the
+#  socket queues of a process.
+sock_q_max_bytes =          64 * 1024
+sock_buffer_budget =        4 * 1024 * 1024
 
+
+
+# Socket I/O sizes and options.
+# sock_recv_size is the most data taken from a socket by
+#  one receive, sock_send_batch the most queued data
+#  joined into one send.
+# sock_tcp_nodelay = True sends small writes at once
+#  instead of waiting to coalesce them (Nagle).
+# sock_rcvbuf and sock_sndbuf set the kernel socket buffer
+#  sizes, bytes.  0 leaves the system default.
+# Each can be overridden per socket with sock_opts.
+sock_recv_size =            16 * 1024
+sock_send_batch =           64 * 1024
+sock_tcp_nodelay =          False
+sock_rcvbuf =               0
+sock_sndbuf =               0
+
+# Local RPC.
+# BasicXMLRPCThread servers also serve their functions on
+#  a Unix domain socket, local_rpc_dir/xmlrpc_<port>.sock,
+#  with the sock_rpc binary protocol.
+#  utils.get_XMLRPC_server_proxy() uses it for localhost URLs.
+# The XMLRPC ports stay open for the consoles and remote tools.
+local_rpc_enable =          True
+local_rpc_dir =             '/tmp'
+
+# XMLRPC server threads.
+# BasicXMLRPCThread servers handle requests with a fixed pool
+#  of xmlrpc_workers threads.  Up to xmlrpc_accept_q client
+#  connections with a request wait for a worker, more are closed.
+#  xmlrpc_workers = 0 starts a thread per request instead.
+xmlrpc_workers =            4
+xmlrpc_accept_q =           16
@@ -3,18 +3,18 @@
 from datetime import datetime,timedelta
 
 import utils
+import procfs
 
 
 # Iridium Time Fix JAN2018
 def get_iridium_time():
     """ Look for iridium system time in '/proc/iridium_time' """
-    [iridium_time, stderr] = call_subprocess('cat /proc/iridium_time')
-    if iridium_time == '-MSSTM: no network service':
+    epoch_counter = procfs.read_iridium_time()
+    if epoch_counter is None:
         # In the event of an error getting iridium network time
         return 9999
     else:
         # We have a good time response
-        epoch_counter = int(iridium_time.lstrip('-MSSTM: '))
         epoch_date = datetime(2014, 5, 11, 14, 23, 55, 00)
         time_diff = (epoch_counter * timedelta(milliseconds=90))
         sync_time = epoch_date + (epoch_counter * timedelta(milliseconds=90))
@@ -0,0 +1,253 @@
+# Readers of /proc files
+#
+# There is one exposed class:
+#     ProcFile
+#
+# and these exposed functions:
+#     read_file
+#     read_loadavg
+#     read_uptime
+#     format_uptime
+#     read_gps_pps
+#     read_iridium_time
+#     read_cpuinfo
+#     get_cpu_serial
+#
+# ProcFile keeps a file open and reads it again from the start
+# for each read(), so reading /proc/uptime or /proc/gps_pps costs
+# a seek and a read instead of forking cat.  If a read fails, e.g.
+# because a driver was reloaded, the file is opened again.
+#
+# read_file() returns the contents of a file under the root dir,
+# /proc unless given, using one cached ProcFile per path.  The
+# read_*() functions parse a file into typed values, and return
+# None if the file can not be read or parsed.  The root argument
+# lets them read copies of the files, e.g. fixture files in tests.
+
+import os
+import time
+import threading
+
+ROOT = '/proc'
+READ_SIZE = 4096
+
+
+class ProcFile:
+    """A file that is kept open and read from the start"""
+    def __init__(self, path, keep_open=True):
+        self._path = path
+        self._keep_open = keep_open
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def read(self):
+        """Return the contents of the file
+
+        Raise OSError if the file can not be read.
+        """
+        self._lock.acquire()
+        try:
+            for attempt in (1, 2):
+                try:
+                    if self._fd is None:
+                        self._fd = os.open(self._path, os.O_RDONLY)
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    chunks = []
+                    while True:
+                        data = os.read(self._fd, READ_SIZE)
+                        if not data:
+                            break
+                        chunks.append(data)
+                    if not self._keep_open:
+                        self._close_fd()
+                    return ''.join(chunks)
+                except OSError:
+                    self._close_fd()
+                    if attempt == 2:
+                        raise
+        finally:
+            self._lock.release()
+
+    def _close_fd(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def close(self):
+        self._lock.acquire()
+        self._close_fd()
+        self._lock.release()
+
+
+_files = {}
+_files_lock = threading.Lock()
+
+def read_file(name, root=None, keep_open=True):
+    """Return the contents of root/name
+
+    root = None for ROOT
+    keep_open = False to close the file after reading, for files
+                read only once
+    Raise OSError if the file can not be read.
+    """
+    path = os.path.join(root or ROOT, name)
+    _files_lock.acquire()
+    try:
+        proc_file = _files.get(path)
+        if proc_file is None:
+            proc_file = ProcFile(path, keep_open)
+            if keep_open:
+                _files[path] = proc_file
+    finally:
+        _files_lock.release()
+    return proc_file.read()
+
+
+def close_files():
+    """Close the cached files"""
+    _files_lock.acquire()
+    try:
+        for proc_file in _files.values():
+            proc_file.close()
+        _files.clear()
+    finally:
+        _files_lock.release()
+
+
+def read_loadavg(root=None):
+    """Return the (1, 5, 15) minute load averages"""
+    try:
+        fields = read_file('loadavg', root).split()
+        return (float(fields[0]), float(fields[1]), float(fields[2]))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_uptime(root=None):
+    """Return (uptime secs, idle secs)"""
+    try:
+        fields = read_file('uptime', root).split()
+        return (float(fields[0]), float(fields[1]))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def format_uptime(root=None):
+    """Return the time, uptime and load averages formatted
+        like the uptime command, without the number of users
+
+    e.g. ' 03:57:59 up 3 days,  2:05,  load average: 0.19, 0.18, 0.15'
+    Return '' if not available.
+    """
+    uptime = read_uptime(root)
+    loads = read_loadavg(root)
+    if (uptime is None) or (loads is None):
+        return ''
+    mins = int(uptime[0]) // 60
+    days = mins // (24 * 60)
+    hours = (mins // 60) % 24
+    mins = mins % 60
+    parts = [time.strftime(' %H:%M:%S'), ' up ']
+    if days:
+        parts.append('%d day%s, ' % (days, (days != 1) and 's' or ''))
+    if hours:
+        parts.append('%2d:%02d' % (hours, mins))
+    else:
+        parts.append('%d min' % mins)
+    parts.append(',  load average: %.2f, %.2f, %.2f' % loads)
+    return ''.join(parts)
+
+
+def read_gps_pps(root=None):
+    """Return the gps_pps driver status
+
+    Return a dict of 'sync_age' secs, 'sys_time_error' secs,
+     'lat' and 'long' in Garmin format (ddmm.mmmm).
+    Return None if the driver is not running.
+    """
+    # gps_pps looks like:
+    #     Sync Age,Sys Time Error,Lat,Long
+    #     60,-0.996319,4217.6544,-08342.6943
+    try:
+        lines = read_file('gps_pps', root).split('\n')
+        if lines[0].split(',')[0] != 'Sync Age':
+            return None
+        fields = lines[1].split(',')
+        return {'sync_age': int(fields[0]),
+                'sys_time_error': float(fields[1]),
+                'lat': float(fields[2]),
+                'long': float(fields[3])}
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_iridium_time(root=None):
+    """Return the Iridium system time counter (90 ms ticks)
+
+    Return None if the modem has no network service or the
+     driver is not running.
+    """
+    # iridium_time looks like:
+    #     -MSSTM: 12345678
+    # or:
+    #     -MSSTM: no network service
+    try:
+        text = read_file('iridium_time', root).strip()
+        if not text.startswith('-MSSTM:'):
+            return None
+        return int(text[len('-MSSTM:'):])
+    except (OSError, ValueError):
+        return None
+
+
+def read_cpuinfo(root=None):
+    """Return a dict of the 'name : value' lines of cpuinfo
+
+    For repeated names, e.g. on multi-core CPUs, the first
+    value is kept.  Return None if not available.
+    """
+    try:
+        text = read_file('cpuinfo', root, keep_open=False)
+    except OSError:
+        return None
+    info = {}
+    for line in text.split('\n'):
+        name, sep, value = line.partition(':')
+        if sep:
+            info.setdefault(name.strip(), value.strip())
+    return info
+
+
+def get_cpu_serial(root=None):
+    """Return the CPU serial number string, '?' if not known"""
+    info = read_cpuinfo(root)
+    if (info is None) or not info.get('Serial'):
+        return '?'
+    return info['Serial']
+
+
+def _benchmark(n_reads=200):
+    """Compare cat in a subprocess with ProcFile re-reads"""
+    import commands
+    for name in ('uptime', 'loadavg'):
+        start_time = time.time()
+        for i in range(n_reads):
+            commands.getoutput('cat /proc/%s' % name)
+        cat_secs = time.time() - start_time
+        start_time = time.time()
+        for i in range(n_reads):
+            read_file(name)
+        read_secs = time.time() - start_time
+        print '/proc/%-8s cat %7.3f ms   ProcFile %7.3f ms' % \
+                (name, cat_secs * 1000 / n_reads, read_secs * 1000 / n_reads)
+    print 'read_uptime() %s' % repr(read_uptime())
+    print 'read_loadavg() %s' % repr(read_loadavg())
+    print 'format_uptime() %s' % repr(format_uptime())
+    print 'get_cpu_serial() %s' % repr(get_cpu_serial())
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -7,16 +7,649 @@ import time
 import logging
 import socket
 import Queue
+import zlib
+import struct
+from collections import deque
 
 import sock_utils
 import utils
 import logs
-from ProxyPkt import ProxyPkt, PassthroughPkt, ConnectPkt, DisconnectPkt
+from ProxyPkt import ProxyPkt, PassthroughPkt, CompressedPassthroughPkt, \
+                        JumboPassthroughPkt, ConnectPkt, DisconnectPkt, \
+                        SeqPkt, AckPkt
 
 
-class Packetize(threading.Thread):
+class StreamCompressor:
+    """Compress the passthrough data of one channel direction
+    
+    All packets share one raw deflate stream, so repeated
+    strings in earlier packets improve the compression of
+    later ones.  Every packet ends on a sync flush point, so
+    the peer can decompress it as soon as it arrives.
+    Data that does not get small enough (already compressed or
+    encrypted data) is sent uncompressed.  The trial is made
+    on a copy of the stream so the peer's window stays in step.
+    After a failed trial, compression is not attempted for a
+    growing number of packets.
+    """
+    MAX_BACKOFF = 64
+    
+    def __init__(self, level=6, min_len=32):
+        """
+        level = zlib compression level
+        min_len = data shorter than this is never compressed
+        """
+        self._comp = zlib.compressobj(level, zlib.DEFLATED,
+                                        ProxyPkt.ZLIB_WBITS, 5)
+        self._min_len = min_len
+        self._backoff = 0
+        self._skip_count = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        
+    def compress(self, data, max_len=ProxyPkt.MAX_PASSTHROUGH_DATA_LEN):
+        """Return the compressed data or None if not worth compressing
+        
+        max_len = None is also returned if the compressed data
+                    would be longer than this.  It must be
+                    shorter than data in any case.
+        """
+        if len(data) < self._min_len:
+            return None
+        if self._skip_count > 0:
+            self._skip_count -= 1
+            return None
+        trial = self._comp.copy()
+        z = trial.compress(data) + trial.flush(zlib.Z_SYNC_FLUSH)
+        if len(z) > min(max_len, len(data) - 1):
+            self._backoff = min(max(1, self._backoff * 2), StreamCompressor.MAX_BACKOFF)
+            self._skip_count = self._backoff
+            return None
+        self._comp = trial
+        self._backoff = 0
+        self.raw_bytes += len(data)
+        self.compressed_bytes += len(z)
+        return z
+
+
+class LinkStats:
+    """Traffic counters of a proxy link or channel
+    
+    Counts bytes and packets in each direction and keeps one
+    second buckets of byte counts for rolling throughput.
+    Also keeps the high-water marks of named queues and totals
+    of named counters, such as framing errors.
+    Updated by several threads.
+    """
+    WINDOWS = (10, 60)      # rolling throughput windows, seconds
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._rx_bytes = 0
+        self._tx_bytes = 0
+        self._rx_pkts = 0
+        self._tx_pkts = 0
+        self._buckets = deque()     # [second, rx bytes, tx bytes]
+        self._q_hwms = {}
+        self._counters = {}
+        
+    def count_rx(self, n_bytes=0, n_pkts=0):
+        """Count received bytes and packets"""
+        self._lock.acquire()
+        self._rx_bytes += n_bytes
+        self._rx_pkts += n_pkts
+        if n_bytes:
+            self._bucket()[1] += n_bytes
+        self._lock.release()
+        
+    def count_tx(self, n_bytes=0, n_pkts=0):
+        """Count transmitted bytes and packets"""
+        self._lock.acquire()
+        self._tx_bytes += n_bytes
+        self._tx_pkts += n_pkts
+        if n_bytes:
+            self._bucket()[2] += n_bytes
+        self._lock.release()
+        
+    def note_q_depth(self, name, depth):
+        """Record the depth of a queue, keep the high-water mark"""
+        self._lock.acquire()
+        if depth > self._q_hwms.get(name, 0):
+            self._q_hwms[name] = depth
+        self._lock.release()
+        
+    def add_counters(self, counters):
+        """Add a dict of named counts to the totals"""
+        self._lock.acquire()
+        for name, count in counters.items():
+            self._counters[name] = self._counters.get(name, 0) + count
+        self._lock.release()
+        
+    def _bucket(self):
+        """Return the bucket of the current second, drop old ones
+        
+        Must be called with self._lock held.
+        """
+        now = int(time.time())
+        buckets = self._buckets
+        if (not buckets) or (buckets[-1][0] != now):
+            buckets.append([now, 0, 0])
+            while buckets[0][0] <= now - LinkStats.WINDOWS[-1]:
+                buckets.popleft()
+        return buckets[-1]
+        
+    def get_stats(self):
+        """Return a dict of counters, throughputs in bits per second
+        
+        Queue high-water marks are named '<queue>_hwm'.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            stats = {'rx_bytes': self._rx_bytes,
+                    'tx_bytes': self._tx_bytes,
+                    'rx_pkts': self._rx_pkts,
+                    'tx_pkts': self._tx_pkts}
+            for window in LinkStats.WINDOWS:
+                rx = 0
+                tx = 0
+                for sec, rx_bytes, tx_bytes in self._buckets:
+                    if sec > now - window:
+                        rx += rx_bytes
+                        tx += tx_bytes
+                secs = max(min(window, now - self._start_time), 1)
+                stats['rx_bps_%ds' % window] = 8 * rx / secs
+                stats['tx_bps_%ds' % window] = 8 * tx / secs
+            for name, hwm in self._q_hwms.items():
+                stats['%s_hwm' % name] = hwm
+            stats.update(self._counters)
+            return stats
+        finally:
+            self._lock.release()
+            
+    def str(self):
+        """Return the totals in printable form"""
+        stats = self.get_stats()
+        parts = ['rx %d bytes/%d pkts, tx %d bytes/%d pkts' % \
+                (stats['rx_bytes'], stats['rx_pkts'],
+                stats['tx_bytes'], stats['tx_pkts'])]
+        for name in sorted(self._q_hwms.keys()):
+            parts.append('%s high-water %d' % (name, stats['%s_hwm' % name]))
+        for name in sorted(self._counters.keys()):
+            if stats[name]:
+                parts.append('%s %d' % (name, stats[name]))
+        return ', '.join(parts)
+        
+        
+def _min_timeout(a, b):
+    """Return the shorter of two timeouts, None meaning no timeout"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+    
+    
+def _seq_diff(a, b):
+    """Return a - b in sequence number space"""
+    half = ProxyPkt.SEQ_MODULUS / 2
+    return ((a - b + half) % ProxyPkt.SEQ_MODULUS) - half
+
+
+class ArqChannel:
+    """Selective-repeat ARQ for one proxy channel
+    
+    Sending: channel packets are wrapped in SEQ packets and kept
+    in a retransmit buffer until acknowledged.  At most window
+    packets can be unacknowledged; send() blocks when the window
+    is full.  A packet is retransmitted when the peer NAKs it or
+    when the oldest unacknowledged packet is not acknowledged
+    within the retransmit timeout.  The timeout tracks the
+    measured round trip time.  If the write queue reports when
+    a packet is dequeued for the link (PktScheduler does), the
+    timer starts then, so packets waiting behind other traffic
+    do not time out.
+    
+    Receiving: SEQ packets are delivered in order.  Packets that
+    arrive after a gap are held and the missing ones are NAKed
+    at once, and again every nak_interval seconds until they
+    arrive.  In order packets are acknowledged every ack_every
+    packets or after ack_delay seconds.
+    
+    tick() runs the timers.  get_timeout() tells when it must
+    next be called.  A timer started by resume() pokes the
+    Wakeup given to set_wakeup().
+    While the link is down the channel can be parked, which
+    stops the timers, and resumed after a RESUME exchange.
+    """
+    MAX_NAKS = 16
+    _SEQ_NUM_STRUCT = struct.Struct('<H')
+    
+    def __init__(self, pkt_write_q, src_port, dest_port, log,
+                window=16, ack_every=4, ack_delay=0.5, nak_interval=2.0,
+                initial_rto=10.0, min_rto=3.0, max_rto=60.0):
+        """
+        pkt_write_q = SEQ and ACK pkts are written to this queue
+        src_port = source port stored in the pkts
+        dest_port = destination port stored in the pkts
+        log = log object
+        window = maximum number of unacknowledged pkts
+        ack_every = acknowledge after this many in order pkts
+        ack_delay = maximum seconds an in order pkt waits for an ACK
+        nak_interval = seconds between NAKs while pkts are missing
+        initial_rto, min_rto, max_rto = retransmit timeout seconds
+        """
+        self._pkt_write_q = pkt_write_q
+        self._src_port = src_port
+        self._dest_port = dest_port
+        self._log = log
+        self._window = window
+        self._stamp_on_dequeue = hasattr(pkt_write_q, 'set_sent_callback')
+        if self._stamp_on_dequeue:
+            pkt_write_q.set_sent_callback(src_port, dest_port, self._on_dequeue)
+        self._ack_every = ack_every
+        self._ack_delay = ack_delay
+        self._nak_interval = nak_interval
+        self._rto = initial_rto
+        self._initial_rto = initial_rto
+        self._min_rto = min_rto
+        self._max_rto = max_rto
+        self._srtt = None
+        self._rttvar = None
+        self._lock = threading.Lock()
+        self._window_open = threading.Condition(self._lock)
+        self._closed = False
+        self._parked = False
+        self._wakeup = None
+        # Sender state
+        self._send_base = 0     # oldest unacknowledged seq
+        self._next_seq = 0
+        self._unacked = {}      # seq -> utils.Bunch
+        # Receiver state
+        self._recv_next = 0     # next seq to deliver
+        self._recv_buf = {}     # seq -> out of order ProxyPktView
+        self._rx_unacked = 0
+        self._ack_time = None
+        # Counters
+        self.retransmits = 0
+        self.naks_sent = 0
+        self.dup_pkts = 0
+        self.out_of_window_pkts = 0
+        
+    def send(self, pkt_type, data=None, timeout=None):
+        """Send a channel pkt reliably
+        
+        pkt_type = PASSTHROUGH, COMPRESSED_PASSTHROUGH,
+                    JUMBO_PASSTHROUGH or DISCONNECT
+        data = pkt data following the ports
+        timeout = None or maximum seconds to wait for the window
+        Block while the window is full.
+        Return False if the channel was closed or dropped from
+        the write queue, or timed out.
+        """
+        self._lock.acquire()
+        try:
+            end_time = None
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while (len(self._unacked) >= self._window) and not self._closed:
+                if end_time is None:
+                    self._window_open.wait()
+                    continue
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return False
+                self._window_open.wait(remaining)
+            if self._closed:
+                return False
+            seq = self._next_seq
+            self._next_seq = (seq + 1) % ProxyPkt.SEQ_MODULUS
+            pkt_buf = SeqPkt(self._src_port, self._dest_port, seq, pkt_type, data)
+            rec = utils.Bunch(pkt_buf=pkt_buf, retransmitted=False)
+            self._set_queued(rec, time.time())
+            self._unacked[seq] = rec
+        finally:
+            self._lock.release()
+        if self._pkt_write_q.put(pkt_buf) is False:
+            # PktScheduler dropped the channel
+            return False
+        return True
+        
+    def on_ack(self, pkt):
+        """Handle an ACK pkt from the peer"""
+        cum_ack, naks = pkt.get_ack()
+        if cum_ack is None:
+            return
+        resend = []
+        self._lock.acquire()
+        try:
+            now = time.time()
+            rec = self._release_acked(cum_ack)
+            if (rec is not None) and (rec.sent_time is not None):
+                self._update_rto(now - rec.sent_time)
+            min_interval = self._srtt or self._min_rto
+            for seq in naks:
+                rec = self._unacked.get(seq)
+                # A pkt still in the write queue is not resent
+                if rec and (rec.sent_time is not None) and \
+                        (now - rec.sent_time >= min_interval):
+                    resend.append(self._mark_resent(rec, now))
+        finally:
+            self._lock.release()
+        for pkt_buf in resend:
+            self._pkt_write_q.put(pkt_buf)
+            
+    def receive(self, pkt):
+        """Handle a SEQ pkt from the peer
+        
+        Return the list of pkts that can now be delivered in order.
+        """
+        out = []
+        ack_buf = None
+        self._lock.acquire()
+        try:
+            seq = pkt.get_seq()
+            offset = _seq_diff(seq, self._recv_next)
+            ack_now = False
+            if offset < 0:
+                # Already delivered, the peer probably missed our ACK
+                self.dup_pkts += 1
+                ack_now = True
+            elif offset >= self._window:
+                self.out_of_window_pkts += 1
+            else:
+                self._recv_buf[seq] = pkt
+                while self._recv_next in self._recv_buf:
+                    out.append(self._recv_buf.pop(self._recv_next))
+                    self._recv_next = (self._recv_next + 1) % ProxyPkt.SEQ_MODULUS
+                self._rx_unacked += len(out)
+                if self._recv_buf:
+                    # gap, NAK the missing pkts now
+                    ack_now = True
+                elif self._rx_unacked >= self._ack_every:
+                    ack_now = True
+                elif (self._rx_unacked > 0) and (self._ack_time is None):
+                    self._ack_time = time.time() + self._ack_delay
+            if ack_now:
+                ack_buf = self._build_ack()
+        finally:
+            self._lock.release()
+        if ack_buf:
+            self._pkt_write_q.put(ack_buf)
+        return out
+        
+    def tick(self):
+        """Run the retransmit and delayed ACK timers"""
+        resend = None
+        ack_buf = None
+        self._lock.acquire()
+        try:
+            if self._parked:
+                return
+            now = time.time()
+            rec = self._unacked.get(self._send_base)
+            if rec and (now >= self._rto_expiry(rec)):
+                resend = self._mark_resent(rec, now)
+                self._rto = min(self._rto * 2, self._max_rto)
+            if (self._ack_time is not None) and (now >= self._ack_time):
+                ack_buf = self._build_ack()
+        finally:
+            self._lock.release()
+        if resend:
+            self._pkt_write_q.put(resend)
+        if ack_buf:
+            self._pkt_write_q.put(ack_buf)
+            
+    def flush_ack(self):
+        """Send a pending delayed ACK now"""
+        ack_buf = None
+        self._lock.acquire()
+        if self._ack_time is not None:
+            ack_buf = self._build_ack()
+        self._lock.release()
+        if ack_buf:
+            self._pkt_write_q.put(ack_buf)
+            
+    def wait_for_acks(self, timeout):
+        """Wait until all sent pkts are acknowledged
+        
+        Return True if they were.
+        """
+        self.flush_ack()
+        end_time = time.time() + timeout
+        while True:
+            self.tick()
+            self._lock.acquire()
+            try:
+                if not self._unacked:
+                    return True
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return False
+                timer = self._get_timeout()
+                if timer is not None:
+                    remaining = min(remaining, timer)
+                self._window_open.wait(remaining)
+            finally:
+                self._lock.release()
+        
+    def park(self):
+        """Stop the timers while the link is down"""
+        self._lock.acquire()
+        self._parked = True
+        self._lock.release()
+        
+    def resume(self, next_seq):
+        """Restart the channel after the link is restored
+        
+        next_seq = sequence number of the next pkt the peer expects
+        Pkts before next_seq are released, the rest are sent again.
+        """
+        self._lock.acquire()
+        try:
+            self._parked = False
+            if next_seq is not None:
+                self._release_acked((next_seq - 1) % ProxyPkt.SEQ_MODULUS)
+            # Forget the backoff of the dead link
+            if self._srtt is None:
+                self._rto = self._initial_rto
+            else:
+                self._rto = self._calc_rto()
+            now = time.time()
+            resend = []
+            for i in range(len(self._unacked)):
+                seq = (self._send_base + i) % ProxyPkt.SEQ_MODULUS
+                resend.append(self._mark_resent(self._unacked[seq], now))
+        finally:
+            self._lock.release()
+        for pkt_buf in resend:
+            self._pkt_write_q.put(pkt_buf)
+        if self._wakeup is not None:
+            # the retransmit timer is running again
+            self._wakeup.poke()
+            
+    def set_wakeup(self, wakeup):
+        """Poke wakeup when a timer starts outside the ticking threads"""
+        self._wakeup = wakeup
+        
+    def get_timeout(self):
+        """Return seconds until tick() has work, None if no timer runs"""
+        self._lock.acquire()
+        try:
+            return self._get_timeout()
+        finally:
+            self._lock.release()
+            
+    def _get_timeout(self):
+        """get_timeout(), must be called with self._lock held"""
+        if self._parked:
+            return None
+        times = []
+        rec = self._unacked.get(self._send_base)
+        if rec:
+            times.append(self._rto_expiry(rec))
+        if self._ack_time is not None:
+            times.append(self._ack_time)
+        if not times:
+            return None
+        return max(min(times) - time.time(), 0)
+            
+    def get_next_seq(self):
+        """Return the sequence number of the next pkt expected"""
+        self._lock.acquire()
+        try:
+            return self._recv_next
+        finally:
+            self._lock.release()
+            
+    def close(self):
+        """Release threads blocked in send()"""
+        self._lock.acquire()
+        self._closed = True
+        self._window_open.notifyAll()
+        self._lock.release()
+        if self._stamp_on_dequeue:
+            self._pkt_write_q.set_sent_callback(self._src_port, self._dest_port, None)
+            
+    def _on_dequeue(self, pkt_buf):
+        """Start the retransmit timer of a SEQ pkt taken for the link
+        
+        Called by the write queue, in the link write thread.
+        """
+        if ord(pkt_buf[ProxyPkt.TYPE]) != ProxyPkt.SEQ:
+            return
+        seq = ArqChannel._SEQ_NUM_STRUCT.unpack_from(pkt_buf, ProxyPkt.PASSTHROUGH_DATA)[0]
+        timer_started = False
+        self._lock.acquire()
+        try:
+            rec = self._unacked.get(seq)
+            if (rec is not None) and (rec.pkt_buf is pkt_buf) and \
+                    (rec.sent_time is None):
+                rec.sent_time = time.time()
+                timer_started = (seq == self._send_base)
+        finally:
+            self._lock.release()
+        if timer_started and (self._wakeup is not None):
+            # The timer may expire before the ticking thread's timeout
+            self._wakeup.poke()
+        
+    def get_stats(self):
+        """Return a dict of ARQ counters"""
+        self._lock.acquire()
+        try:
+            return {'unacked_pkts': len(self._unacked),
+                    'held_pkts': len(self._recv_buf),
+                    'rto': self._rto,
+                    'retransmits': self.retransmits,
+                    'naks_sent': self.naks_sent,
+                    'dup_pkts': self.dup_pkts,
+                    'out_of_window_pkts': self.out_of_window_pkts}
+        finally:
+            self._lock.release()
+            
+    def _release_acked(self, cum_ack):
+        """Drop the pkts up to cum_ack from the retransmit buffer
+        
+        Must be called with self._lock held.
+        Return the record of the newest pkt dropped if its round
+        trip time is a valid sample, else None.  It is valid only
+        if none of the dropped pkts were resent (Karn), since the
+        newest one may have been held behind a gap.
+        """
+        acked = _seq_diff(cum_ack, self._send_base) + 1
+        if not (0 < acked <= len(self._unacked)):
+            return None
+        all_fresh = True
+        for i in range(acked):
+            rec = self._unacked.pop(self._send_base)
+            all_fresh = all_fresh and not rec.retransmitted
+            self._send_base = (self._send_base + 1) % ProxyPkt.SEQ_MODULUS
+        self._window_open.notifyAll()
+        if all_fresh:
+            return rec
+        return None
+        
+    def _mark_resent(self, rec, now):
+        """Record a retransmission, return the pkt to resend"""
+        self._set_queued(rec, now)
+        rec.retransmitted = True
+        self.retransmits += 1
+        return rec.pkt_buf
+        
+    def _set_queued(self, rec, now):
+        """Record that rec's pkt is being written to the write queue"""
+        rec.queued_time = now
+        if self._stamp_on_dequeue:
+            # set by _on_dequeue()
+            rec.sent_time = None
+        else:
+            rec.sent_time = now
+            
+    def _rto_expiry(self, rec):
+        """Return the time rec's retransmit timer expires
+        
+        A pkt that is still in the write queue is resent only
+        after max_rto, in case the queue discarded it.
+        """
+        if rec.sent_time is None:
+            return rec.queued_time + self._max_rto
+        return rec.sent_time + self._rto
+        
+    def _update_rto(self, rtt):
+        """Update the retransmit timeout from a round trip time sample"""
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+        self._rto = self._calc_rto()
+        
+    def _calc_rto(self):
+        """Return the retransmit timeout for the current RTT estimate"""
+        return min(max(self._srtt + 4 * self._rttvar, self._min_rto),
+                    self._max_rto)
+                        
+    def _build_ack(self):
+        """Return an ACK pkt for the current receiver state
+        
+        Must be called with self._lock held.
+        """
+        naks = []
+        if self._recv_buf:
+            last = max([_seq_diff(seq, self._recv_next) for seq in self._recv_buf.keys()])
+            for i in range(last):
+                seq = (self._recv_next + i) % ProxyPkt.SEQ_MODULUS
+                if seq not in self._recv_buf:
+                    naks.append(seq)
+                    if len(naks) >= ArqChannel.MAX_NAKS:
+                        break
+        self.naks_sent += len(naks)
+        self._rx_unacked = 0
+        if naks:
+            # NAK again if the retransmissions are lost
+            self._ack_time = time.time() + self._nak_interval
+        else:
+            self._ack_time = None
+        cum_ack = (self._recv_next - 1) % ProxyPkt.SEQ_MODULUS
+        return AckPkt(self._src_port, self._dest_port, cum_ack, naks)
+
+
+# Packetize channel policies
+LATENCY_FIRST = 'latency'
+THROUGHPUT_FIRST = 'throughput'
+
+
+class Packetize(utils.BaseThread):
     """Packetize stream data from a socket. Write pkts to a queue.
     
+    Stream data that is already queued is merged into full packets.
+    With the LATENCY_FIRST policy, data is sent as soon as the
+    queue is empty.  With the THROUGHPUT_FIRST policy, a partial
+    packet is held for up to coalesce_delay seconds waiting for
+    more data.
+    
     Exit if the socket connection is dropped
         
     """ 
@@ -26,7 +659,13 @@ class Packetize(threading.Thread):
                 pkt_src_port,
                 pkt_dest_port,
                 log,
-                exit_callback=None):
+                exit_callback=None,
+                compress=False,
+                policy=LATENCY_FIRST,
+                coalesce_delay=0.2,
+                jumbo=False,
+                arq=None,
+                stats=None):
         """Instantiate the Packetize thread
         
         sock_h = socket handler (source of stream data)
@@ -35,54 +674,181 @@ class Packetize(threading.Thread):
         pkt_dest_port = destination address stored in the proxy pkts
         log = log object
         exit_callback = called when this thread exits
+        compress = True to send compressed passthrough pkts.
+                    The peer must have accepted CAP_ZLIB.
+        policy = LATENCY_FIRST or THROUGHPUT_FIRST
+        coalesce_delay = seconds a THROUGHPUT_FIRST partial packet
+                    may wait for more data
+        jumbo = True to send jumbo passthrough pkts.
+                    The peer must have accepted CAP_JUMBO.
+        arq = None or the channel's ArqChannel.  If not None,
+                    pkts are sent reliably through it.
+        stats = None or the channel's LinkStats.  Stream bytes
+                    and pkts sent are counted as tx.
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._sock_h = sock_h
+        self._stats = stats
         self._pkt_write_q = pkt_write_q
         self._pkt_src_port = pkt_src_port
         self._pkt_dest_port = pkt_dest_port
         self._log = log
         self._exit_callback = exit_callback
         self._stream_read_q = sock_h.get_read_q()
-        self._stop_event = threading.Event()
+        self._compressor = None
+        if compress:
+            self._compressor = StreamCompressor()
+        if policy == THROUGHPUT_FIRST:
+            self._coalesce_delay = coalesce_delay
+        else:
+            self._coalesce_delay = 0.0
+        if jumbo:
+            self._max_data_len = ProxyPkt.MAX_JUMBO_PASSTHROUGH_DATA_LEN
+        else:
+            self._max_data_len = ProxyPkt.MAX_PASSTHROUGH_DATA_LEN
+        self._arq = arq
+        if arq is not None:
+            self._max_data_len -= ProxyPkt.SEQ_HDR_LEN
+        self._pending = []
+        self._pending_len = 0
+        self._flush_time = 0
+        self._stop_event = utils.Wakeup()
         self.name = 'Packetize thread, pkt source port %s, pkt dest port %s' % \
                         (str(pkt_src_port), str(pkt_dest_port))
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                                         
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         
         while not self._stop_event.isSet():
             if not self._sock_h.is_running():
                 self._stop_event.set()
                 continue
-            data = utils.q_get(self._stream_read_q, get_timeout=0.5)
+            if self._pending:
+                timeout = max(self._flush_time - time.time(), 0)
+            else:
+                timeout = None
+            if self._arq is not None:
+                timeout = _min_timeout(timeout, self._arq.get_timeout())
+            data = utils.q_get(self._stream_read_q, get_timeout=timeout,
+                                wakeup=self._stop_event)
             if data is not None:
                 #self._log.debug('Packetize: received %s bytes' % str(len(data)))
-                self._send_passthrough_pkts(data)
+                self._add_pending(data)
+                self._drain_stream_read_q()
+            if self._pending:
+                self._send_pending(time.time() >= self._flush_time)
+            if self._arq is not None:
+                self._arq.tick()
             
+        if self._pending:
+            self._send_pending(True)
         self._running = False
         #self._log.debug('Stopping %s ' % self.name)
         if self._exit_callback:
             self._exit_callback(self)
         self._log.debug('Exiting %s ' % self.name)
         
+    def _add_pending(self, data):
+        """Hold data until it is sent"""
+        if not self._pending:
+            self._flush_time = time.time() + self._coalesce_delay
+        self._pending.append(data)
+        self._pending_len += len(data)
+        if self._stats is not None:
+            self._stats.count_tx(n_bytes=len(data))
+        
+    def _drain_stream_read_q(self):
+        """Add already queued stream data to the pending data"""
+        while self._pending_len < self._max_data_len:
+            data = utils.q_get(self._stream_read_q, get_timeout=0)
+            if data is None:
+                break
+            self._add_pending(data)
+            
+    def _send_pending(self, send_partial):
+        """Send all full packets of pending data
+        
+        send_partial = True to also send a final partial packet
+        """
+        data = ''.join(self._pending)
+        if send_partial:
+            send_len = len(data)
+        else:
+            send_len = len(data) - (len(data) % self._max_data_len)
+        if not self._send_passthrough_pkts(data[:send_len]):
+            self._pending = []
+            self._pending_len = 0
+            return
+        data = data[send_len:]
+        if data:
+            self._pending = [data]
+        else:
+            self._pending = []
+        self._pending_len = len(data)
+        
     def _send_passthrough_pkts(self, data):
-        """Send a series of passthrough proxy packets containing data"""
-        src = self._pkt_src_port
-        dest = self._pkt_dest_port
-        max_len = ProxyPkt.MAX_PASSTHROUGH_DATA_LEN
+        """Send a series of passthrough proxy packets containing data
+        
+        A compressed chunk is split into as many compressed
+        passthrough pkts as it needs, there is no compressed
+        jumbo pkt.  The peer's decompressor takes the stream in
+        any pieces.  Compression must also pay for the headers
+        of the extra pkts.
+        Return False if the channel can no longer send.
+        """
+        max_len = self._max_data_len
+        z_pkt_len = min(max_len, ProxyPkt.MAX_PASSTHROUGH_DATA_LEN)
+        pkt_overhead = ProxyPkt.MAX_PKT_LEN - z_pkt_len
         while data:
-            self._pkt_write_q.put(PassthroughPkt(src, dest, data[:max_len]))
+            chunk = data[:max_len]
             data = data[max_len:]
+            if self._compressor is not None:
+                extra_pkts = (len(chunk) - 1) / z_pkt_len
+                z = self._compressor.compress(chunk,
+                            len(chunk) - 1 - extra_pkts * pkt_overhead)
+                if z is not None:
+                    for i in range(0, len(z), z_pkt_len):
+                        if not self._send_pkt(ProxyPkt.COMPRESSED_PASSTHROUGH,
+                                                z[i:i + z_pkt_len]):
+                            return False
+                    continue
+            if len(chunk) > ProxyPkt.MAX_PASSTHROUGH_DATA_LEN:
+                pkt_type = ProxyPkt.JUMBO_PASSTHROUGH
+            else:
+                pkt_type = ProxyPkt.PASSTHROUGH
+            if not self._send_pkt(pkt_type, chunk):
+                return False
+        return True
+                
+    def _send_pkt(self, pkt_type, data):
+        """Build a passthrough pkt and write it to the pkt queue
+        
+        Return False if the pkt could not be sent.  The rest of
+        the stream (and a compressed stream's window) is lost with
+        it, so the channel is stopped.
+        """
+        if self._arq is not None:
+            # Blocks while the window is full
+            if not self._arq.send(pkt_type, data):
+                self._log.error('Packetize: port %s, ARQ channel closed, dropping stream data' % \
+                                str(self._pkt_src_port))
+                self._stop_event.set()
+                return False
+        else:
+            builder = _PASSTHROUGH_PKT_BUILDERS[pkt_type]
+            if self._pkt_write_q.put(builder(self._pkt_src_port,
+                                        self._pkt_dest_port, data)) is False:
+                # PktScheduler dropped the channel
+                self._log.error('Packetize: port %s, channel dropped, dropping stream data' % \
+                                str(self._pkt_src_port))
+                self._stop_event.set()
+                return False
+        if self._stats is not None:
+            self._stats.count_tx(n_pkts=1)
+        return True
         
     def is_running(self):
         return self._running
@@ -92,10 +858,17 @@ class Packetize(threading.Thread):
         #self._log.debug('Packetize: entering stop()')
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
+
+            
+_PASSTHROUGH_PKT_BUILDERS = {
+    ProxyPkt.PASSTHROUGH:               PassthroughPkt,
+    ProxyPkt.COMPRESSED_PASSTHROUGH:    CompressedPassthroughPkt,
+    ProxyPkt.JUMBO_PASSTHROUGH:         JumboPassthroughPkt,
+}
 
             
-class Depacketize(threading.Thread):
+class Depacketize(utils.BaseThread):
     """Depacketize proxy packets. Send stream to a socket.
     
     Exit if the client connection is dropped
@@ -104,35 +877,41 @@ class Depacketize(threading.Thread):
     def __init__(self,
                 sock_h,
                 log,
-                exit_callback=None):
+                exit_callback=None,
+                arq=None,
+                stats=None):
         """
         sock_h = socket handler (destination of stream data)
         pkt_read_q = source of proxy packets
         log = log object
         exit_callback = called when this thread exits
+        arq = None or the channel's ArqChannel.  SEQ and ACK
+                    pkts are handed to it.
+        stats = None or the channel's LinkStats.  Pkts received
+                    and stream bytes delivered are counted as rx.
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._sock_h = sock_h
         self._pkt_read_q = Queue.Queue()
         self._log = log
         self._exit_callback = exit_callback
         self._stream_write_q = sock_h.get_write_q()
-        self._stop_event = threading.Event()
+        self._stop_event = utils.Wakeup()
+        self._decompressor = None
+        self._arq = arq
+        if arq is not None:
+            # This thread runs the ARQ timers
+            arq.set_wakeup(self._stop_event)
+        self._stats = stats
         self._got_disconnect_pkt = False
         self.name = 'Depacketize thread, stream dest port is %s' % \
                         str(self._sock_h.get_peer_port())
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                                         
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         
         while not self._stop_event.isSet():
             if not self._sock_h.is_running():
@@ -140,27 +919,28 @@ class Depacketize(threading.Thread):
                 self._stop_event.set()
                 continue
             #self._log.debug('Depacketize: polling queue %s' % repr(self._pkt_read_q))
-            pkt_buf = utils.q_get(self._pkt_read_q, get_timeout=0.5)
-            if pkt_buf is None:
+            self._stop_event.clear_poke()
+            timeout = None
+            if self._arq is not None:
+                timeout = self._arq.get_timeout()
+            pkt = utils.q_get(self._pkt_read_q, get_timeout=timeout,
+                                wakeup=self._stop_event)
+            if self._arq is not None:
+                self._arq.tick()
+            if pkt is None:
                 continue
             #self._log.debug('Depacketize: got a pkt')
-            pkt = ProxyPkt(pkt_buf)
-            pkt_type = pkt.get_type()
-            if pkt_type == ProxyPkt.PASSTHROUGH:
-                #self._log.debug('Depacketize: a PASSTHROUGH pkt')
-                self._send_stream_data(pkt)
-                continue
-            if pkt_type == ProxyPkt.CONNECT:
-                # Got a CONNECT pkt from the other proxy.
-                #  Ignore since we are already connected.
-                continue
-            if pkt_type == ProxyPkt.DISCONNECT:
-                # Got a DISCONNECT pkt from the other proxy
-                self._log.debug('Depacketize: Got DISCONNECT')
-                self._got_disconnect_pkt = True
-                self._stop_event.set()
-                self._log.debug('Depacketize: exiting because got a DISCONNECT')
-                continue
+            if self._arq is None:
+                self._handle_pkt(pkt)
+            elif pkt.get_type() == ProxyPkt.ACK:
+                self._arq.on_ack(pkt)
+            elif pkt.get_seq() is not None:
+                for in_order_pkt in self._arq.receive(pkt):
+                    self._handle_pkt(in_order_pkt)
+                    if self._stop_event.isSet():
+                        break
+            else:
+                self._handle_pkt(pkt)
             
         self._running = False
         #self._log.debug('Stopping %s ' % self.name)
@@ -168,18 +948,60 @@ class Depacketize(threading.Thread):
             self._exit_callback(self)
         self._log.debug('Exiting %s ' % self.name)
             
+    def _handle_pkt(self, pkt):
+        """Handle one in order pkt from the other proxy"""
+        pkt_type = pkt.get_type()
+        if (pkt_type == ProxyPkt.PASSTHROUGH) or \
+                (pkt_type == ProxyPkt.JUMBO_PASSTHROUGH):
+            #self._log.debug('Depacketize: a PASSTHROUGH pkt')
+            self._send_stream_data(pkt)
+        elif pkt_type == ProxyPkt.COMPRESSED_PASSTHROUGH:
+            self._send_decompressed_stream_data(pkt)
+        elif pkt_type == ProxyPkt.CONNECT:
+            # Got a CONNECT pkt from the other proxy.
+            #  Ignore since we are already connected.
+            pass
+        elif pkt_type == ProxyPkt.DISCONNECT:
+            # Got a DISCONNECT pkt from the other proxy
+            self._log.debug('Depacketize: Got DISCONNECT')
+            self._got_disconnect_pkt = True
+            self._stop_event.set()
+            self._log.debug('Depacketize: exiting because got a DISCONNECT')
+            
     def _send_stream_data(self, pkt):
         """Send pkt's passthrough data to the client"""
         #self._log.debug('Depacketize: entering _send_stream')
-        stream_data_len = pkt.get_passthrough_data_len()
-        if stream_data_len > 0:
-            start_i = ProxyPkt.PASSTHROUGH_DATA
-            end_i = start_i + stream_data_len
-            self._stream_write_q.put(pkt.get_pkt_buf()[start_i:end_i])
+        if pkt.get_passthrough_data_len() > 0:
+            # the socket writers take buffers, the view is not copied
+            self._stream_write_q.put(pkt.get_passthrough_data())
+            if self._stats is not None:
+                self._stats.count_rx(n_bytes=pkt.get_passthrough_data_len())
+            
+    def _send_decompressed_stream_data(self, pkt):
+        """Decompress pkt's passthrough data and send it to the client"""
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(ProxyPkt.ZLIB_WBITS)
+        try:
+            data = self._decompressor.decompress(pkt.get_passthrough_buffer())
+        except zlib.error, e:
+            # The stream cannot be recovered, drop the connection
+            self._log.error('Depacketize: decompression failed, %s' % e)
+            self._stop_event.set()
+            return
+        if data:
+            self._stream_write_q.put(data)
+            if self._stats is not None:
+                self._stats.count_rx(n_bytes=len(data))
             
     def send(self, pkt):
-        """Depacketize and send the stream data to the client"""
-        self._pkt_read_q.put(pkt.get_pkt_buf())
+        """Depacketize and send the stream data to the client
+        
+        pkt = ProxyPktView of a received packet
+        """
+        self._pkt_read_q.put(pkt)
+        if self._stats is not None:
+            self._stats.count_rx(n_pkts=1)
+            self._stats.note_q_depth('rx_q', self._pkt_read_q.qsize())
         
     def is_running(self):
         return self._running
@@ -192,5 +1014,277 @@ class Depacketize(threading.Thread):
         #self._log.debug('Depacketize: entering stop()')
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
+
 
+
+class PktScheduler:
+    """A packet queue shared by all the channels of a proxy link
+    
+    Used in place of a Queue.Queue by the threads that write
+    proxy packets and the socket write thread that reads them.
+    Control packets (PING, ICCID, CONNECT, ACK) have strict priority.
+    Channel packets (passthrough, SEQ and DISCONNECT) are queued per
+    channel and dequeued by deficit round-robin, so a bulk
+    transfer cannot starve an interactive session.  A channel's
+    DISCONNECT stays behind the channel's data.
+    Writers block when their channel queue is full.  Writers
+    blocked on a channel that is dropped or flushed are released
+    and their put() returns False.
+    """
+    _CHANNEL_STRUCT = struct.Struct('<HH')     # src port, dest port
+    
+    def __init__(self, weights=None, default_weight=1,
+                quantum=ProxyPkt.MAX_PKT_LEN, max_channel_pkts=100,
+                stats=None):
+        """
+        weights = dict of channel weights, keyed by pkt source port
+        default_weight = weight of channels not in weights
+        quantum = bytes a weight 1 channel may send per round
+        max_channel_pkts = channel queue size
+        stats = None or a LinkStats.  Dequeued pkts are counted as tx.
+        """
+        self._weights = weights or {}
+        self._default_weight = default_weight
+        self._quantum = quantum
+        self._max_channel_pkts = max_channel_pkts
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        # Queue.Queue's names, so utils.q_get() can wait on us
+        self.not_empty = self._not_empty
+        self._not_full = threading.Condition(self._mutex)
+        self._control_q = deque()
+        self._channels = {}     # channel key -> utils.Bunch
+        self._active = deque()  # channels with queued pkts, in round order
+        self._data_pkt_count = 0
+        self._control_pkts_sent = 0
+        self._data_pkts_sent = 0
+        self._stats = stats
+        self._control_q_hwm = 0
+        self._data_q_hwm = 0
+        self._channel_q_hwms = {}   # channel key -> high-water mark
+        self._sent_callbacks = {}   # channel key -> callback
+        
+    def _channel_key(self, pkt_buf):
+        """Return the channel key of a channel pkt, None for a control pkt"""
+        pkt_type = ord(pkt_buf[ProxyPkt.TYPE])
+        if pkt_type in (ProxyPkt.PASSTHROUGH,
+                        ProxyPkt.COMPRESSED_PASSTHROUGH,
+                        ProxyPkt.JUMBO_PASSTHROUGH,
+                        ProxyPkt.SEQ,
+                        ProxyPkt.DISCONNECT):
+            return PktScheduler._CHANNEL_STRUCT.unpack_from(pkt_buf, ProxyPkt.DATA)
+        return None
+        
+    def put(self, pkt_buf, block=True, timeout=None):
+        """Enqueue a packet string
+        
+        Return False if the pkt's channel was dropped while
+        waiting for room, else True.
+        """
+        key = self._channel_key(pkt_buf)
+        self._mutex.acquire()
+        try:
+            if key is None:
+                self._control_q.append(pkt_buf)
+                self._control_q_hwm = max(self._control_q_hwm, len(self._control_q))
+            else:
+                ch = self._channels.get(key)
+                if ch is None:
+                    weight = self._weights.get(key[0], self._default_weight)
+                    ch = utils.Bunch(key=key, q=deque(), deficit=0,
+                                    quantum=weight * self._quantum,
+                                    topped_up=False, dropped=False)
+                    self._channels[key] = ch
+                if block:
+                    end_time = None
+                    if timeout is not None:
+                        end_time = time.time() + timeout
+                    while (len(ch.q) >= self._max_channel_pkts) and \
+                            not ch.dropped:
+                        if end_time is None:
+                            self._not_full.wait()
+                            continue
+                        remaining = end_time - time.time()
+                        if remaining <= 0:
+                            raise Queue.Full
+                        self._not_full.wait(remaining)
+                    if ch.dropped:
+                        return False
+                elif len(ch.q) >= self._max_channel_pkts:
+                    raise Queue.Full
+                if not ch.q:
+                    self._active.append(ch)
+                ch.q.append(pkt_buf)
+                self._data_pkt_count += 1
+                self._data_q_hwm = max(self._data_q_hwm, self._data_pkt_count)
+                if len(ch.q) > self._channel_q_hwms.get(key, 0):
+                    self._channel_q_hwms[key] = len(ch.q)
+            self._not_empty.notify()
+        finally:
+            self._mutex.release()
+        return True
+            
+    def get(self, block=True, timeout=None):
+        """Dequeue the next packet string to send
+        
+        Raise Queue.Empty if no packet is available.
+        """
+        self._mutex.acquire()
+        try:
+            if block:
+                end_time = None
+                if timeout is not None:
+                    end_time = time.time() + timeout
+                while self._is_empty():
+                    if end_time is None:
+                        self._not_empty.wait()
+                        continue
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    self._not_empty.wait(remaining)
+            elif self._is_empty():
+                raise Queue.Empty
+            callback = None
+            if self._control_q:
+                self._control_pkts_sent += 1
+                pkt_buf = self._control_q.popleft()
+            else:
+                pkt_buf, key = self._get_channel_pkt()
+                callback = self._sent_callbacks.get(key)
+        finally:
+            self._mutex.release()
+        if self._stats is not None:
+            self._stats.count_tx(len(pkt_buf), 1)
+        if callback is not None:
+            callback(pkt_buf)
+        return pkt_buf
+            
+    def _get_channel_pkt(self):
+        """Dequeue a channel pkt by deficit round-robin
+        
+        Return (pkt string, channel key).
+        """
+        while True:
+            ch = self._active[0]
+            if not ch.topped_up:
+                ch.deficit += ch.quantum
+                ch.topped_up = True
+            pkt_len = len(ch.q[0])
+            if pkt_len <= ch.deficit:
+                break
+            # Channel has used its quantum, move on to the next one
+            ch.topped_up = False
+            self._active.rotate(-1)
+        pkt_buf = ch.q.popleft()
+        ch.deficit -= pkt_len
+        if not ch.q:
+            self._active.popleft()
+            del self._channels[ch.key]
+        self._data_pkt_count -= 1
+        self._data_pkts_sent += 1
+        self._not_full.notifyAll()
+        return pkt_buf, ch.key
+        
+    def _qsize(self):
+        """Return the number of queued pkts, self._mutex held"""
+        return len(self._control_q) + self._data_pkt_count
+        
+    def _is_empty(self):
+        return (not self._control_q) and (self._data_pkt_count == 0)
+        
+    def empty(self):
+        self._mutex.acquire()
+        try:
+            return self._is_empty()
+        finally:
+            self._mutex.release()
+            
+    def qsize(self):
+        self._mutex.acquire()
+        try:
+            return len(self._control_q) + self._data_pkt_count
+        finally:
+            self._mutex.release()
+            
+    def drop_channel(self, src_port, dest_port):
+        """Discard the queued packets of one channel
+        
+        Writers blocked on the channel are released.  Later
+        packets with the same ports start a new channel queue.
+        """
+        self._mutex.acquire()
+        try:
+            ch = self._channels.pop((src_port, dest_port), None)
+            if ch is not None:
+                self._active.remove(ch)
+                self._discard(ch)
+                self._not_full.notifyAll()
+        finally:
+            self._mutex.release()
+            
+    def _discard(self, ch):
+        """Empty a dropped channel's queue, self._mutex held"""
+        self._data_pkt_count -= len(ch.q)
+        ch.q.clear()
+        ch.dropped = True
+            
+    def forget_channel(self, src_port, dest_port):
+        """Drop the statistics and callback of a closed channel"""
+        self._mutex.acquire()
+        self._channel_q_hwms.pop((src_port, dest_port), None)
+        self._sent_callbacks.pop((src_port, dest_port), None)
+        self._mutex.release()
+        
+    def set_sent_callback(self, src_port, dest_port, callback):
+        """Call callback(pkt_buf) when a pkt of the channel is dequeued
+        
+        The callback is called in the reading thread, without
+        the queue locked.  callback = None to remove it.
+        """
+        self._mutex.acquire()
+        if callback is None:
+            self._sent_callbacks.pop((src_port, dest_port), None)
+        else:
+            self._sent_callbacks[(src_port, dest_port)] = callback
+        self._mutex.release()
+        
+    def flush(self):
+        """Discard all queued packets"""
+        self._mutex.acquire()
+        try:
+            self._control_q.clear()
+            for ch in self._channels.values():
+                self._discard(ch)
+            self._channels = {}
+            self._active.clear()
+            self._data_pkt_count = 0
+            self._not_full.notifyAll()
+        finally:
+            self._mutex.release()
+            
+    def get_stats(self):
+        """Return a dict of queue depths and packet counts
+        
+        Channel depths and high-water marks are keyed by
+        'src_port:dest_port'.
+        """
+        self._mutex.acquire()
+        try:
+            channels = {}
+            for ch in self._channels.values():
+                channels['%d:%d' % ch.key] = len(ch.q)
+            channel_hwms = {}
+            for key, hwm in self._channel_q_hwms.items():
+                channel_hwms['%d:%d' % key] = hwm
+            return {'control_q_depth': len(self._control_q),
+                    'data_q_depth': self._data_pkt_count,
+                    'channel_q_depths': channels,
+                    'control_q_hwm': self._control_q_hwm,
+                    'data_q_hwm': self._data_q_hwm,
+                    'channel_q_hwms': channel_hwms,
+                    'control_pkts_sent': self._control_pkts_sent,
+                    'data_pkts_sent': self._data_pkts_sent}
+        finally:
+            self._mutex.release()
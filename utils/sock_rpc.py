@@ -3,25 +3,55 @@
 # Simple RPC Library
 
 import sys
+import time
+import socket
+import select
 import threading
 import Queue
 import marshal
+import struct
+import ast
 import logging
+from errno import EINTR, EAGAIN
 
-import sock_utils
 import utils
 import sock_utils
 import logs
 import global_config
+import hw_mgr_config
 
 """
     RPC clients create an RPCServerProxy and use it
-    to execute remote commands.
+    to execute remote commands, or share one connection
+    per server with get_server_proxy().
     RPC servers create an RPC server that is subclassed
     from BaseRPCServer.  See the module test code for
     a usage example.
+    
+    There are two protocols.  The server detects the one
+    a client uses from its first bytes.
+    
+    Protocol 2: the client sends PROTO2_MAGIC and the
+    server echoes it.  Every message is then a 4-byte
+    length followed by a marshalled tuple:
+        request     (req_id, name, args)
+        response    (req_id, ok, result or error string)
+    Requests are run by a pool of worker threads, so
+    responses can arrive out of order.
+    
+    Legacy protocol: a 2-byte length and the marshalled
+    tuple (name, arg, ...), where each arg is the Python
+    literal of the value as a string.  Requests are run
+    one at a time.
+    
+    Both protocols call only the functions registered
+    with the server.
 """
 
+PROTO2_MAGIC = 'RPC2'
+MAX_MSG_LEN = 16 * 1024 * 1024
+_LEN2 = struct.Struct('>I')
+
 
 class RPCError(Exception):
     def __init__(self, value):
@@ -30,135 +60,661 @@ class RPCError(Exception):
         return repr(self.value)
     
     
+class RPCTimeout(RPCError):
+    pass
+    
+    
+class _RPCSocket:
+    """A connected RPC socket, split into messages
+    
+    The socket is read and written directly, not through a
+    SockHandler, so a call costs no thread hand-offs, and reads
+    wait in select() rather than on a Queue timeout, which polls.
+    Any thread may send, one reader at a time may read.
+    """
+    RECV_SIZE = 64 * 1024
+    
+    def __init__(self, sock, len_bytes, send_timeout=None):
+        """
+            sock = connected socket
+            len_bytes = 2 for the legacy protocol, 4 for protocol 2
+            send_timeout = secs a send may block, None for no limit
+        """
+        self._sock = sock
+        self._sock.settimeout(send_timeout)
+        self._len_bytes = len_bytes
+        self._chunks = []
+        self._n_buffered = 0
+        self._send_lock = threading.Lock()
+        self._open = True
+        
+    def set_len_bytes(self, len_bytes):
+        self._len_bytes = len_bytes
+        
+    def is_open(self):
+        return self._open
+        
+    def send(self, data):
+        """Send data, raise RPCError if the connection is lost"""
+        self._send_lock.acquire()
+        try:
+            try:
+                self._sock.sendall(data)
+            except socket.error, e:
+                self.close()
+                raise RPCError('connection lost: %s' % e)
+        finally:
+            self._send_lock.release()
+            
+    def _recv(self, timeout, wakeup):
+        """Return data from the socket, None on timeout or wakeup
+        
+        Raise RPCError if the connection is lost.
+        """
+        if wakeup is not None:
+            if not wakeup.wait_readable(self._sock, timeout):
+                return None
+        else:
+            try:
+                if not select.select([self._sock], [], [], timeout)[0]:
+                    return None
+            except select.error, e:
+                if e.args[0] == EINTR:
+                    return None
+                raise RPCError('connection lost: %s' % e)
+            except (socket.error, ValueError):
+                raise RPCError('connection closed')
+        try:
+            data = self._sock.recv(_RPCSocket.RECV_SIZE)
+        except socket.timeout:
+            return None
+        except socket.error, e:
+            if e.args[0] in (EINTR, EAGAIN):
+                return None
+            self.close()
+            raise RPCError('connection lost: %s' % e)
+        if not data:
+            self.close()
+            raise RPCError('connection closed')
+        return data
+        
+    def read_bytes(self, n_bytes, timeout=None, wakeup=None):
+        """Return the next n_bytes of the stream
+        
+        Return None on timeout, or if wakeup is set or poked.
+        Raise RPCError if the connection is lost.
+        """
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while self._n_buffered < n_bytes:
+            if end_time is not None:
+                timeout = max(end_time - time.time(), 0)
+            chunk = self._recv(timeout, wakeup)
+            if chunk is None:
+                return None
+            self._chunks.append(chunk)
+            self._n_buffered += len(chunk)
+        buf = ''.join(self._chunks)
+        if len(buf) > n_bytes:
+            self._chunks = [buf[n_bytes:]]
+        else:
+            self._chunks = []
+        self._n_buffered -= n_bytes
+        return buf[:n_bytes]
+        
+    def peek(self, n_bytes, timeout=None, wakeup=None):
+        """Return the next n_bytes without consuming them"""
+        data = self.read_bytes(n_bytes, timeout, wakeup)
+        if data is not None:
+            self._chunks.insert(0, data)
+            self._n_buffered += len(data)
+        return data
+        
+    def read_msg(self, timeout=None, wakeup=None):
+        """Return the next unmarshalled message, None on timeout
+        
+        Raise RPCError if the stream is corrupt or the
+        connection is lost.
+        """
+        hdr = self.peek(self._len_bytes, timeout, wakeup)
+        if hdr is None:
+            return None
+        if self._len_bytes == 2:
+            size = ord(hdr[0]) * 256 + ord(hdr[1])
+        else:
+            size = _LEN2.unpack(hdr)[0]
+            if size > MAX_MSG_LEN:
+                raise RPCError('message length %d too long' % size)
+        msg = self.read_bytes(self._len_bytes + size, timeout, wakeup)
+        if msg is None:
+            return None
+        try:
+            return marshal.loads(msg[self._len_bytes:])
+        except (ValueError, EOFError, TypeError):
+            raise RPCError('invalid message')
+            
+    def close(self):
+        """Close the connection, wakes a thread reading it"""
+        if self._open:
+            self._open = False
+            utils.close_sock(self._sock)
+            
+            
+def _frame(msg, len_bytes):
+    """Return the marshalled, length prefixed msg
+    
+    Raise ValueError if msg cannot be marshalled or is too long.
+    """
+    data = marshal.dumps(msg)
+    size = len(data)
+    if len_bytes == 2:
+        if size > 0xFFFF:
+            raise ValueError, 'message length %d too long for the legacy protocol' % size
+        return ''.join([chr((size & 0xFF00) >> 8), chr(size & 0x00FF), data])
+    if size > MAX_MSG_LEN:
+        raise ValueError, 'message length %d too long' % size
+    return _LEN2.pack(size) + data
+    
+    
 class RPCServerProxy:
-    def __init__(self, host, port, log, timeout=8.0):
+    """
+        Call functions of an RPC server.
+        With protocol 2, several threads can have calls in flight
+        on one connection, and start_call()/get_result() let one
+        thread overlap its calls.  Whichever waiting thread gets
+        the read lock reads responses for all of them, and wakes
+        the others when their responses arrive.
+        If the connection drops, the calls in flight fail and
+        the next call reconnects.
+    """
+    def __init__(self, host, port, log, timeout=8.0, protocol=2, path=None):
+        """
+            protocol = 2, or 1 for the legacy protocol, where
+                the call args are Python literals as strings
+            path = Unix domain socket path of the server,
+                used instead of host, port
+        Raise RPCError if the server cannot be reached.
+        """
         self._log = log
+        self._host = host
+        self._port = port
+        self._path = path
         self._timeout = timeout
-        self._rpc_sock_h = sock_utils.connect_to_server(log, host, port)
-        if self._rpc_sock_h is None:
-            raise RPCError('Could not connect to RPC server')
-            return
-        utils.wait(1.0) # wait for server startup
-        self._write_q = self._rpc_sock_h.get_write_q()
-        self._read_q = self._rpc_sock_h.get_read_q()
+        self._protocol = protocol
+        self._conn = None
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._results = {}      # req_id -> (ok, result)
+        self._pending = set()   # req_ids sent and not yet answered
+        self._waiters = {}      # req_id -> Wakeup of the waiting thread
+        self._free_wakeups = []
+        self._reading = False
+        self._closed = False
+        self.last_use_time = time.time()
+        self._connect()
+        
+    def _connect(self):
+        """Connect and wait for the server to accept the protocol
+        
+        Called with the lock held, except from __init__.
+        Raise RPCError if not successful.
+        """
+        if self._path is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self._host, self._port)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self._path
+        try:
+            sock.settimeout(self._timeout)
+            sock.connect(address)
+        except socket.error, e:
+            sock.close()
+            raise RPCError('Could not connect to RPC server: %s' % e)
+        if self._protocol == 2:
+            conn = _RPCSocket(sock, 4, self._timeout)
+            conn.send(PROTO2_MAGIC)
+            if conn.read_bytes(len(PROTO2_MAGIC), self._timeout) != PROTO2_MAGIC:
+                conn.close()
+                raise RPCError('RPC server did not accept protocol 2')
+        else:
+            # The server reads requests as soon as it has accepted
+            #  the connection, so there is nothing to wait for.
+            conn = _RPCSocket(sock, 2, self._timeout)
+        self._conn = conn
+            
+    def is_connected(self):
+        return (self._conn is not None) and self._conn.is_open()
+        
+    def ping(self, timeout=2.0):
+        """Return True if the server answers"""
+        try:
+            if self._protocol != 2:
+                return self.is_connected()
+            return self.get_result(self.start_call('rpc.ping'), timeout) == 'pong'
+        except RPCError:
+            return False
         
     def call(self, *args):
+        """Call function args[0] with args[1:], return its result
+        
+        Return None on timeout or a legacy protocol error.
+        Raise RPCError if the server reports an error.
+        """
         self._log.info('RPCServerProxy.call: args = %s' % repr(args))
-        self._send_rpc_request(args)     
-        resp = self._get_rpc_response()
+        if self._protocol != 2:
+            resp = self._legacy_call(args)
+        else:
+            resp = self.get_result(self.start_call(*args))
         self._log.info('RPCServerProxy.call: resp = %s' % repr(resp))
         return(resp)
         
-    def _send_rpc_request(self, args):
-        # Send size and marshalled args to server
-        ser_args = marshal.dumps(args)
-        size = len(ser_args)
-        size_msb = chr((size & 0xFF00) >> 8)
-        size_lsb = chr(size & 0x00FF)
-        self._write_q.put(''.join([size_msb, size_lsb, ser_args]))     
-        
-    def _get_rpc_response(self):
-        # Get size and marshalled response from server
-        resp = utils.q_get(self._read_q, get_timeout=self._timeout)
-        if resp is None:
-            self._log.error('RPCServerProxy._get_rpc_response: timed out waiting for start of response')
-            return None
-        if len(resp) < 2:
-            self._log.error('RPCServerProxy._get_rpc_response: Did not get both size bytes')
+    def call_many(self, calls):
+        """Make a list of calls in one request
+        
+        calls = list of (name, arg, ...) tuples
+        The server runs the calls in order.
+        Return the list of results, with an RPCError in place of
+        the result of each call that failed.  Return None on timeout.
+        """
+        calls = [tuple(c) for c in calls]
+        if self._protocol != 2:
+            return [self._legacy_call(c) for c in calls]
+        resps = self.get_result(self.start_call('rpc.multicall', calls))
+        if resps is None:
             return None
-        size = ord(resp[0]) * 256 + ord(resp[1])
-        resp = resp[2:]
-        while len(resp) < size:
-            chunk = utils.q_get(self._read_q, get_timeout=self._timeout)
-            if chunk is None:
-               self._log.error('RPCServerProxy._get_rpc_response: timed out waiting for end of response')
-               return None
-            resp += chunk           
-        return marshal.loads(resp)
+        return [result if ok else RPCError(result) for ok, result in resps]
+        
+    def start_call(self, name, *args):
+        """Send a protocol 2 request, return its request id
+        
+        Raise RPCError if the server cannot be reached.
+        """
+        self._lock.acquire()
+        try:
+            if self._closed:
+                raise RPCError('RPCServerProxy is closed')
+            if not self.is_connected():
+                self._fail_pending('connection lost')
+                self._connect()
+            req_id = self._next_id
+            self._next_id = (self._next_id + 1) & 0x7FFFFFFF
+            frame = _frame((req_id, name, args), 4)
+            self._pending.add(req_id)
+            conn = self._conn
+            self.last_use_time = time.time()
+        finally:
+            self._lock.release()
+        try:
+            conn.send(frame)
+        except RPCError:
+            self._lock.acquire()
+            self._pending.discard(req_id)
+            self._lock.release()
+            raise
+        return req_id
+        
+    def get_result(self, req_id, timeout=None, raise_timeout=False):
+        """Wait for the result of a start_call() request
+        
+        timeout = None for the proxy's timeout
+        Return None on timeout, or raise RPCTimeout if raise_timeout.
+        Raise RPCError if the server reports an error or the
+        connection is lost.
+        """
+        if timeout is None:
+            timeout = self._timeout
+        end_time = time.time() + timeout
+        self._lock.acquire()
+        try:
+            while req_id not in self._results:
+                remaining = end_time - time.time()
+                if req_id not in self._pending:
+                    raise RPCError('no request %d in flight' % req_id)
+                if remaining <= 0:
+                    self._pending.discard(req_id)
+                    self._log.error('RPCServerProxy.get_result: timed out waiting for response')
+                    if raise_timeout:
+                        raise RPCTimeout('timed out waiting for response')
+                    return None
+                if self._reading:
+                    self._wait_for_reader(req_id, remaining)
+                else:
+                    self._read_response(remaining)
+            ok, result = self._results.pop(req_id)
+        finally:
+            self._lock.release()
+        if not ok:
+            raise RPCError(result)
+        return result
+        
+    def _wait_for_reader(self, req_id, timeout):
+        """Wait for the reader to get our response or give up
+            reading, lock held
+        """
+        if self._free_wakeups:
+            wakeup = self._free_wakeups.pop()
+        else:
+            wakeup = utils.Wakeup()
+        self._waiters[req_id] = wakeup
+        self._lock.release()
+        try:
+            wakeup.wait_set(timeout)
+        finally:
+            self._lock.acquire()
+            del self._waiters[req_id]
+            if self._closed:
+                wakeup.close()
+            else:
+                wakeup.clear_poke()
+                self._free_wakeups.append(wakeup)
+        
+    def _read_response(self, timeout):
+        """Read one response as the reader, lock held"""
+        self._reading = True
+        conn = self._conn
+        self._lock.release()
+        error = None
+        try:
+            try:
+                msg = conn.read_msg(timeout)
+            except RPCError, e:
+                msg = None
+                error = str(e)
+        finally:
+            self._lock.acquire()
+            self._reading = False
+        if conn is self._conn:
+            if msg is not None:
+                self._store_result(msg)
+            elif error is not None:
+                conn.close()
+                self._fail_pending(error)
+        # let a waiting thread take over reading
+        for wakeup in self._waiters.values():
+            wakeup.poke()
+            
+    def _fail_pending(self, error):
+        """Fail the calls in flight, lock held"""
+        for req_id in self._pending:
+            self._results[req_id] = (False, error)
+        self._pending = set()
+        
+    def _store_result(self, msg):
+        """Keep a response for the thread waiting on it, lock held"""
+        try:
+            req_id, ok, result = msg
+        except (TypeError, ValueError):
+            self._log.error('RPCServerProxy: invalid response %s' % repr(msg))
+            return
+        if req_id in self._pending:
+            self._pending.discard(req_id)
+            self._results[req_id] = (ok, result)
+            
+    def _legacy_call(self, args):
+        self._lock.acquire()
+        try:
+            if self._closed:
+                raise RPCError('RPCServerProxy is closed')
+            if not self.is_connected():
+                self._connect()
+            self.last_use_time = time.time()
+            try:
+                self._conn.send(_frame(args, 2))
+                resp = self._conn.read_msg(self._timeout)
+            except RPCError, e:
+                self._log.error('RPCServerProxy._legacy_call: %s' % e)
+                self._conn.close()
+                return None
+            if resp is None:
+                # a late response would be taken for the next one's
+                self._log.error('RPCServerProxy._legacy_call: timed out waiting for response')
+                self._conn.close()
+            return resp
+        finally:
+            self._lock.release()
         
     def close(self):
-        if self._rpc_sock_h and self._rpc_sock_h.is_running():
-            self._rpc_sock_h.stop()        
+        self._lock.acquire()
+        try:
+            self._closed = True
+            if self._conn is not None:
+                self._conn.close()
+            self._fail_pending('RPCServerProxy is closed')
+            for wakeup in self._waiters.values():
+                wakeup.poke()
+            for wakeup in self._free_wakeups:
+                wakeup.close()
+            self._free_wakeups = []
+        finally:
+            self._lock.release()
+        
+        
+class _ProxyPool:
+    """Shared protocol 2 RPCServerProxys, one per server
+    
+    One proxy serves all the threads of a process, since a
+    protocol 2 connection carries calls from several threads.
+    """
+    IDLE_CHECK_SECS = 30.0  # ping a proxy idle this long before use
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proxies = {}      # (host, port) -> RPCServerProxy
+        
+    def get(self, host, port, log, timeout=8.0, path=None):
+        """Return a working proxy for the server
+        
+        path = Unix domain socket path of the server, or None
+        Raise RPCError if the server cannot be reached.
+        """
+        key = (host, port, path)
+        self._lock.acquire()
+        try:
+            proxy = self._proxies.get(key)
+            if (proxy is not None) and \
+                    (time.time() - proxy.last_use_time > _ProxyPool.IDLE_CHECK_SECS) and \
+                    not proxy.ping():
+                log.info('RPC proxy for %s failed its check, reconnecting' % \
+                            (path or '%s:%d' % (host, port)))
+                proxy.close()
+                proxy = None
+            if (proxy is None) or proxy._closed:
+                proxy = RPCServerProxy(host, port, log, timeout, path=path)
+                self._proxies[key] = proxy
+            return proxy
+        finally:
+            self._lock.release()
+            
+    def drop(self, proxy):
+        """Close and forget a proxy whose connection was lost
+        
+        A connected proxy is left alone, since other threads
+        may have calls in flight on it.
+        Return True if the proxy was closed.
+        """
+        self._lock.acquire()
+        try:
+            if proxy.is_connected():
+                return False
+            for key, pooled in self._proxies.items():
+                if pooled is proxy:
+                    del self._proxies[key]
+            proxy.close()
+            return True
+        finally:
+            self._lock.release()
+            
+    def close(self):
+        self._lock.acquire()
+        try:
+            for proxy in self._proxies.values():
+                proxy.close()
+            self._proxies = {}
+        finally:
+            self._lock.release()
+            
+            
+_proxy_pool = _ProxyPool()
+
+
+def get_server_proxy(host, port, log, timeout=8.0, path=None):
+    """Return the process's shared RPCServerProxy for a server
+    
+    path = Unix domain socket path of the server, or None
+    Do not close() it, a proxy that was closed is replaced.
+    After a failed call, use drop_server_proxy() instead.
+    Raise RPCError if the server cannot be reached.
+    """
+    return _proxy_pool.get(host, port, log, timeout, path)
+    
+    
+def drop_server_proxy(proxy):
+    """Close a shared proxy after a failed call, if its connection
+        was lost
+    
+    A failed call on a working connection, e.g. a timeout or an
+    error raised by the server, does not affect the other
+    threads' calls on the proxy.
+    """
+    return _proxy_pool.drop(proxy)
+    
+    
+def close_server_proxies():
+    """Close the shared proxies, call before the process exits"""
+    _proxy_pool.close()
              
 
-class RPCConnectionThread(threading.Thread):
+class _RPCWorker(utils.BaseThread):
+    """Run protocol 2 requests for an RPCConnectionThread"""
+    def __init__(self, conn, req_q, log):
+        utils.BaseThread.__init__(self)
+        self._conn = conn
+        self._req_q = req_q
+        self._log = log
+        self._stop_event = utils.Wakeup()
+        self.name = 'RPC worker thread'
+        self._start_and_wait()
+        
+    def run(self):
+        self._set_started()
+        while not self._stop_event.isSet():
+            req = utils.q_get(self._req_q, get_timeout=None,
+                                wakeup=self._stop_event)
+            if req is not None:
+                self._conn.run_request(req)
+        self._running = False
+        
+        
+class RPCConnectionThread(utils.BaseThread):
     """Handle an RPC connection with a single client"""
-    def __init__(self, sock_h, base_rpc_server, log, exit_callback):
-        threading.Thread.__init__(self)
-        self._sock_h = sock_h
+    MAX_WORKERS = 4         # protocol 2 requests run at once
+    
+    def __init__(self, sock, base_rpc_server, log, exit_callback, timeout=8.0):
+        """
+            sock = connected client socket
+            timeout = secs a response may wait to be sent
+        """
+        utils.BaseThread.__init__(self)
         self._base_rpc_server = base_rpc_server
         self._log = log
         self._exit_callback = exit_callback
-        self._read_q = sock_h.get_read_q()
-        self._write_q = sock_h.get_write_q()
-        self._stop_event = threading.Event()
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._timeout = timeout
+        self._conn = _RPCSocket(sock, 2, timeout)
+        self._protocol = None
+        self._req_q = Queue.Queue()
+        self._workers = []
+        self._stop_event = utils.Wakeup()
+        self._start_and_wait()
          
     def run(self):
         """The actual thread code"""
         #self._log.info('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         
         while not self._stop_event.isSet():
-            if not self._sock_h.is_running():
+            try:
+                if self._protocol is None:
+                    self._get_protocol()
+                    continue
+                req = self._conn.read_msg(wakeup=self._stop_event)
+            except RPCError, e:
+                if self._conn.is_open():
+                    self._log.error('RPCConnectionThread: %s, closing connection' % e)
                 self._stop_event.set()
                 continue
-            cmd = self._get_rpc_request(timeout=0.5)
-            if cmd:
-                self._log.info('RPCConnectionThread.run: Executing %s' % cmd)
-                resp = eval(cmd)
-                self._log.info('RPCConnectionThread.run: %s returned %s' % (cmd, resp))
-                self._send_rpc_response(resp)
+            if req is None:
+                continue
+            if self._protocol == 2:
+                self._start_request(req)
+            else:
+                self._run_legacy_request(req)
                 
         self._running = False
-        if self._sock_h.is_running():
-            self._sock_h.stop()
+        for worker in self._workers:
+            worker.stop()
+        self._conn.close()
         self._exit_callback(self)
         #self._log.info('Exiting %s ' % self.name)
         
-    def _get_rpc_request(self, timeout=None):
-        # Get size and marshalled request from server
-        req = utils.q_get(self._read_q, get_timeout=timeout)
-        if req is None:
-            return None
-        if len(req) < 2:
-            self._log.error('RPCConnectionThread._get_rpc_request: Did not get both size bytes')
-            return None
-        size = ord(req[0]) * 256 + ord(req[1])
-        req = req[2:]
-        while len(req) < size:
-            chunk = utils.q_get(self._read_q, get_timeout=self._timeout)
-            if chunk is None:
-                self._log.error('RPCConnectionThread._get_rpc_request: timed out waiting for end of request')
-                return None
-            req += chunk
-        args = marshal.loads(req)        
-        self._log.info('RPCConnectionThread._get_rpc_request: args = %s' % repr(args))
-        cmd_parts = []
-        for i, arg in enumerate(args):
-            if i == 0:
-                cmd_parts.append(''.join(['self._base_rpc_server.', arg, '(']))
-            else:
-                if i != 1:
-                    cmd_parts.append(', ')
-                cmd_parts.append(arg)
-        cmd_parts.append(')')
-        cmd = ''.join(cmd_parts)
-        self._log.info('RPCConnectionThread._get_rpc_request: returning command: %s' % cmd)
-        return cmd   
-    
-    def _send_rpc_response(self, response):
-        # Send size and marshalled response to server
-        ser_resp = marshal.dumps(response)
-        size = len(ser_resp)
-        size_msb = chr((size & 0xFF00) >> 8)
-        size_lsb = chr(size & 0x00FF)
-        self._write_q.put(''.join([size_msb, size_lsb, ser_resp]))      
+    def _get_protocol(self):
+        """Detect the client's protocol from its first bytes
+        
+        A legacy request has a marshalled tuple after the size.
+        """
+        hdr = self._conn.peek(len(PROTO2_MAGIC), wakeup=self._stop_event)
+        if hdr is None:
+            return
+        if hdr == PROTO2_MAGIC:
+            self._conn.read_bytes(len(PROTO2_MAGIC))
+            self._conn.set_len_bytes(4)
+            self._conn.send(PROTO2_MAGIC)
+            self._protocol = 2
+        else:
+            self._protocol = 1
+        
+    def _start_request(self, req):
+        """Queue a protocol 2 request for the workers"""
+        self._req_q.put(req)
+        if (len(self._workers) < RPCConnectionThread.MAX_WORKERS) and \
+                (self._req_q.qsize() > 0):
+            self._workers.append(_RPCWorker(self, self._req_q, self._log))
+            
+    def run_request(self, req):
+        """Run a protocol 2 request and send its response"""
+        try:
+            req_id, name, args = req
+        except (TypeError, ValueError):
+            self._log.error('RPCConnectionThread: invalid request %s' % repr(req))
+            return
+        try:
+            result = (req_id, True, self._base_rpc_server.dispatch(name, args))
+            frame = _frame(result, 4)
+        except Exception, e:
+            frame = _frame((req_id, False, '%s: %s' % (e.__class__.__name__, e)), 4)
+        self._send(frame)
+        
+    def _run_legacy_request(self, req):
+        """Run a legacy request, whose args are Python literals"""
+        self._log.info('RPCConnectionThread._run_legacy_request: args = %s' % repr(req))
+        resp = None
+        try:
+            args = [ast.literal_eval(arg) for arg in req[1:]]
+            resp = self._base_rpc_server.dispatch(req[0], args)
+            self._log.info('RPCConnectionThread: %s returned %s' % (req[0], resp))
+            frame = _frame(resp, 2)
+        except Exception, e:
+            self._log.error('RPCConnectionThread: request %s failed: %s' % (repr(req), e))
+            frame = _frame(None, 2)
+        self._send(frame)
+        
+    def _send(self, frame):
+        try:
+            self._conn.send(frame)
+        except RPCError, e:
+            # the reader sees the closed connection and exits
+            self._log.error('RPCConnectionThread: %s' % e)
 
     def is_running(self):
         return self._running
@@ -167,72 +723,104 @@ class RPCConnectionThread(threading.Thread):
         """Stop this thread"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
         
 
-class BaseRPCServer(threading.Thread):
+class BaseRPCServer(utils.BaseThread):
     """ Connect to one RPC client at at time and handle RPC requests """
-    def __init__(self, host, port, log, exit_callback=None):
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+    def __init__(self, host, port, log, exit_callback=None, functions=None, path=None):
+        """
+            functions = list of callables the clients can call,
+                        more can be added with register_function()
+            path = Unix domain socket path to listen on
+                        instead of host, port
+        """
+        utils.BaseThread.__init__(self)
         self._log = log
         self._exit_callback = exit_callback
         self._host = host
         self._port = port
+        self._path = path
+        self._functions = {}
+        self.register_function(self._ping, 'rpc.ping')
+        self.register_function(self._multicall, 'rpc.multicall')
+        for func in functions or []:
+            self.register_function(func)
         self._children = []
+        self._listener = None
         self._stop_event = threading.Event()
         self.name = 'BaseRPCServer thread'
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                                         
     def run(self):
         """The actual thread code"""
         #self._log.info('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        # listen before the start handshake so clients can connect at once
+        self._listener = sock_utils.SockListener(self._log, self._host, self._port,
+                                                    path=self._path)
+        self._set_started()
         
         while not self._stop_event.isSet():
             # Wait for client to connect
             #self._log.info('BaseRPCServer.run: waiting for client to connect')
-            sock, addr, connected_flag = \
-                        sock_utils.connect_to_client(self._log,
-                                                    self._host,
-                                                    self._port,
-                                                    self._stop_event)
-            #self._log.info('BaseRPCServer.run: returned from sock_utils.connect_to_client')
+            sock, addr = self._listener.accept()
+            #self._log.info('BaseRPCServer.run: returned from SockListener.accept')
+            if sock is None:
+                continue
             if self._stop_event.isSet():
+                utils.close_sock(sock)
                 continue
             if len(self._children) > 10:
                 self._log.error('BaseRPCServer: more than 10 clients, connection refused')
-                sock.close()
+                utils.close_sock(sock)
                 continue
-            if connected_flag:
-                #self._log.info('BaseRPCServer: connected_flag is true')
-                self._rpc_sock_h = sock_utils.SockHandler(sock,
-                                     self._log,
-                                     log_all_data=False,
-                                     read_data_q=Queue.Queue(),
-                                     write_data_q=Queue.Queue(),
-                                     hand_exit_callback=self._my_exit_callback,
-                                     type='stream')
-                #self._log.info('BaseRPCServer.run: returned from sock_utils.SockHandler ')
-                self._log.info('BaseRPCServer: connected to client')
-                self._log.info('  client port is %s' % str(self._rpc_sock_h.get_peer_port()))
-                self._log.info('  local port is %s' % str(self._rpc_sock_h.get_sock_port()))
-                # Create a RPCConnectionThread to handle this client
-                self._children.append(RPCConnectionThread(self._rpc_sock_h,
-                                        self, self._log, self._my_exit_callback))              
+            self._log.info('BaseRPCServer: connected to client')
+            self._log.info('  client is %s' % utils.get_peer_addr_str(sock))
+            self._log.info('  local address is %s' % utils.get_sock_addr_str(sock))
+            # Create a RPCConnectionThread to handle this client
+            self._children.append(RPCConnectionThread(sock,
+                                    self, self._log, self._my_exit_callback))              
             
         self._running = False
         #self._log.info('Stopping %s ' % self.name)
+        self._listener.close()
         self._stop_children()
         if self._exit_callback:
             self._exit_callback(self)
         #self._log.info('Exiting %s ' % self.name)
         
+    def register_function(self, func, name=None):
+        """Let clients call func, by its own name unless name is given"""
+        if name is None:
+            name = func.__name__
+        self._functions[name] = func
+        
+    def dispatch(self, name, args):
+        """Call the function registered as name, return its result
+        
+        Raise RPCError if there is no such function.
+        """
+        func = self._functions.get(name)
+        if func is None:
+            raise RPCError('unknown function %s' % repr(name))
+        return func(*args)
+        
+    def _ping(self):
+        return 'pong'
+        
+    def _multicall(self, calls):
+        """Run a list of (name, arg, ...) calls in order
+        
+        Return the list of (ok, result or error string).
+        """
+        resps = []
+        for c in calls:
+            try:
+                resps.append((True, self.dispatch(c[0], c[1:])))
+            except Exception, e:
+                resps.append((False, '%s: %s' % (e.__class__.__name__, e)))
+        return resps
+        
     def _stop_children(self):
         for child in self._children:
             if child.is_running():
@@ -249,17 +837,24 @@ class BaseRPCServer(threading.Thread):
         """Stop this thread and its child threads"""
         if self._running:
             self._stop_event.set()
-            # force connect_to_client to return
-            sock_utils.dummy_connection(self._host, self._port)
-            self.join()
+            if self._listener is not None:
+                # wake the accept() wait
+                self._listener.close()
+            self._join()
             
             
 class TestRPCServer(BaseRPCServer):
     def __init__(self, host, port, log):
-        BaseRPCServer.__init__(self, host, port, log)
+        BaseRPCServer.__init__(self, host, port, log,
+                                functions=[self.test, self.delay])
         
     def test(self):
         return 'Passed the test'            
+        
+    def delay(self, secs, value):
+        """Return value after secs seconds"""
+        time.sleep(secs)
+        return value
    
 
 def _test_this_module(log):
@@ -282,6 +877,63 @@ def _test_this_module(log):
         print 'Response from test RPC call: %s' % resp
     else:
         print 'No response from test RPC call'
+        
+    # Overlapped calls, the short one should finish first
+    start_time = time.time()
+    slow_id = svr_proxy.start_call('delay', 0.5, 'slow')
+    fast_id = svr_proxy.start_call('delay', 0.1, 'fast')
+    fast = svr_proxy.get_result(fast_id)
+    fast_secs = time.time() - start_time
+    slow = svr_proxy.get_result(slow_id)
+    print 'Overlapped calls: %s after %.2f secs, %s after %.2f secs' % \
+            (fast, fast_secs, slow, time.time() - start_time)
+    
+    # Calls from several threads on one connection
+    results = {}
+    def caller(i):
+        results[i] = svr_proxy.call('delay', 0.2, i)
+    start_time = time.time()
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print '8 threaded calls took %.2f secs, results %s' % \
+            (time.time() - start_time, 'OK' if results == dict([(i, i) for i in range(8)]) else results)
+    
+    # Errors come back as exceptions
+    try:
+        svr_proxy.call('no_such_function')
+        print 'Unknown function call did not fail'
+    except RPCError, e:
+        print 'Unknown function call failed: %s' % e
+    
+    # Large messages
+    big = 'x' * (1024 * 1024)
+    print '1 MB echo %s' % ('OK' if svr_proxy.call('delay', 0, big) == big else 'failed')
+    
+    # Batched calls
+    start_time = time.time()
+    resps = svr_proxy.call_many([('delay', 0, i) for i in range(100)] + [('no_such_function',)])
+    print '100 batched calls took %.1f ms, %s' % ((time.time() - start_time) * 1000,
+            'OK' if resps[:100] == range(100) and isinstance(resps[100], RPCError) else resps)
+    svr_proxy.close()
+    
+    # Shared proxy, reconnects after the connection drops
+    proxy = get_server_proxy('localhost', rpc_svr_port, log)
+    print 'Shared proxy is %s' % ('reused' if get_server_proxy('localhost', rpc_svr_port, log) is proxy else 'not reused')
+    proxy._conn.close()
+    print 'Call after connection loss: %s' % proxy.call('test')
+    close_server_proxies()
+    
+    # Legacy protocol
+    try:
+        svr_proxy = RPCServerProxy('localhost', rpc_svr_port, log, protocol=1)
+    except RPCError, e:
+        print e
+        rpc_svr_thread.stop()
+        return
+    print 'Legacy protocol response: %s' % svr_proxy.call('delay', '0', "'legacy'")
     svr_proxy.close()
     rpc_svr_thread.stop()
     
@@ -311,17 +963,17 @@ def sock_rpc_set_power_state(device, state, server_proxy, hw_mgr_lock, log=None)
         if server_proxy is None:
             if log:
                 log.info('utils.sock_rpc_set_power_state: server_proxy is None, creating new one')
-            server_proxy = sock_rpc_get_server_proxy(hw_mgr_config.sock_rpc_svr_port, log)
+            server_proxy = _get_hw_mgr_server_proxy(log)
             if server_proxy is None:
                 if log:
                     log.info('utils.sock_rpc_set_power_state: server_proxy creation failed')
                 break
         try:
-            resp = server_proxy.call('set_power', ''.join(["'", device, "'"]), ''.join(["'", state, "'"]))
+            resp = server_proxy.call('set_power', device, state)
         except Exception, e:
             if log:
                 log.error('utils.sock_rpc_set_power_state exception: %s' % e)
-            server_proxy.close()
+            drop_server_proxy(server_proxy)
             server_proxy = None
             attempt += 1
             continue    # retry in case bad server_proxy was passed in
@@ -345,17 +997,17 @@ def sock_rpc_get_hw_status(value_name, server_proxy, hw_mgr_lock, log=None):
         if server_proxy is None:
             if log:
                 log.info('utils.sock_rpc_get_hw_status: server_proxy is None, creating new one')
-            server_proxy = sock_rpc_get_server_proxy(hw_mgr_config.sock_rpc_svr_port, log)
+            server_proxy = _get_hw_mgr_server_proxy(log)
             if server_proxy is None:
                 if log:
                     log.info('utils.sock_rpc_get_hw_status: server_proxy creation failed')
                 break
         try:
-            status_value = server_proxy.call('get_status', ''.join(["'", value_name, "'"]))
+            status_value = server_proxy.call('get_status', value_name)
         except Exception, e:
             if log:
                 log.error('utils.sock_rpc_get_hw_status exception:  %s' % e)
-            server_proxy.close()
+            drop_server_proxy(server_proxy)
             server_proxy = None
             attempt += 1
             continue    # retry in case bad hw_mgr_server was passed in
@@ -377,7 +1029,7 @@ def sock_rpc_get_full_hw_status(server_proxy, hw_mgr_lock, log):
     attempt = 1
     while (attempt <= 2):
         if server_proxy is None:
-            server_proxy = sock_rpc_get_server_proxy(hw_mgr_config.sock_rpc_svr_port, log)
+            server_proxy = _get_hw_mgr_server_proxy(log)
             if server_proxy is None:
                 hw_mgr_lock.release()
                 return [None, None]
@@ -385,7 +1037,7 @@ def sock_rpc_get_full_hw_status(server_proxy, hw_mgr_lock, log):
             status_dict = server_proxy.call('get_full_status')
         except Exception, e:
             log.error('utils.sock_rpc_get_full_hw_status exception:  %s' % e)
-            server_proxy.close()
+            drop_server_proxy(server_proxy)
             server_proxy = None
             attempt += 1
             continue    # retry in case bad hw_mgr_server was passed in
@@ -396,12 +1048,22 @@ def sock_rpc_get_full_hw_status(server_proxy, hw_mgr_lock, log):
 
 
 #====================  move to utils.py  ==================================
-def sock_rpc_get_server_proxy(svr_port, log=None):
-    """Create a socket server proxy for a remote server.
+def _get_hw_mgr_server_proxy(log=None):
+    """Get the shared server proxy for hw_mgr's local RPC socket.
+        Return the server proxy or None.
+    """
+    return sock_rpc_get_server_proxy(hw_mgr_config.XMLRPC_port, log,
+                            path=utils.get_local_rpc_path(hw_mgr_config.XMLRPC_port))
+    
+
+def sock_rpc_get_server_proxy(svr_port, log=None, path=None):
+    """Get the shared socket server proxy for a local server.
+        path = Unix domain socket path of the server, or None
         Return the server proxy or None.
     """
     try:
-        server_proxy = sock_rpc.RPCServerProxy('localhost', svr_port, log)
+        server_proxy = get_server_proxy('localhost', svr_port,
+                                        log or utils.get_null_log(), path=path)
     except Exception, e:
         if log:
             log.error('utils.get_sock_rpc_server_proxy exception: %s' % e)
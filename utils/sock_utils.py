@@ -1,37 +1,78 @@
 # Socket I/O Utilities
 # 
-# There is one exposed class:
+# There are six exposed classes:
 #     SockHandler
+#     ReactorSockHandler
+#     SockListener
+#     PktFramer
+#     ByteQueue
+#     ByteBudget
 #
-# and three exposed functions:
+# and six exposed functions:
 #     connect_to_server
 #     connect_to_client
 #     dummy_connection
+#     new_sock_q
+#     get_byte_budget
+#     set_sock_opts
 #     
 # connect_to_server is called to connect to a server and create
 # a SockHandler.  The SockHandler is the used for
 # all interaction with the socket.
 #
+# SockListener is a server's listening socket.  It stays open
+# between clients, so clients that connect while the server is
+# busy wait in the backlog.  close() wakes a thread waiting in
+# accept().
+#
 # connect_to_client waits until a client connect to a server. 
 #
 # SockHandler creates and manages socket read and write threads.
 # Queues are created and used to transmit
 # socket data and receive socket stream data or packets.
+#
+# ReactorSockHandler has the same queue interface, but its socket
+# is driven by the Reactor, one epoll thread for all the
+# ReactorSockHandlers of the process.
+#
+# PktFramer assembles proxy packets from a byte stream.
+#
+# ByteQueue is a Queue bounded by the bytes it holds.  A full
+# socket read queue stops the read thread, so the sender is
+# held back.  new_sock_q() returns one that counts against the
+# process' ByteBudget.
+#
+# Packet sockets are read with recv_into() into pooled bytearrays
+# that feed the framer, stream sockets with recv(), since their
+# data is queued as a new string.  The data waiting in a write
+# queue is joined into one send.
+# The receive size, send batch size, TCP_NODELAY and socket
+# buffer sizes come from global_config, and can be set for each
+# socket with a sock_opts dict (see set_sock_opts).
 
 import sys
+import os
 import time
 import logging
 import socket
+import select
+import fcntl
+import struct
 import Queue
 import threading
+import weakref
+from collections import deque
 from datetime import datetime,timedelta
-from errno import EINTR
+from errno import EINTR, EAGAIN, ECONNABORTED
 
 import utils
 import logs
-from ProxyPkt import ProxyPkt
+import global_config
+from ProxyPkt import ProxyPkt, buf_cksum, max_pkt_len
+from fec_utils import FecDecoder
 
-def connect_to_server(log, host, port, exit_callback=None, data_type='stream'):
+def connect_to_server(log, host, port, exit_callback=None, data_type='stream',
+                        fec=False, reactor=False, sock_opts=None):
     """Connect to a socket server at host, port
     
     exit_callback is called when the socket handler thread exits
@@ -39,6 +80,9 @@ def connect_to_server(log, host, port, exit_callback=None, data_type='stream'):
         without any interpretation.
     if data_type = 'packet', data read from the socket is assembled
         into proxy packets.  Only complete, valid packets are enqueued.    
+    fec = True to decode FEC frames in a 'packet' socket
+    reactor = True to return a ReactorSockHandler
+    sock_opts = dict of socket options, see set_sock_opts
     Return a SocketHandler if connection is successful
     Return None if not connected       
     """
@@ -50,6 +94,9 @@ def connect_to_server(log, host, port, exit_callback=None, data_type='stream'):
         try:
             sock.settimeout(0.5)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # buffer sizes set the TCP window scale, so they
+            #  must be set before connecting
+            set_sock_opts(sock, sock_opts)
         except OSError, e:
             if e.errno == EINTR:
                 continue
@@ -67,12 +114,20 @@ def connect_to_server(log, host, port, exit_callback=None, data_type='stream'):
             #print 'Socket error'
             return None
         break
+    if reactor:
+        return ReactorSockHandler(sock, log,
+                            hand_exit_callback=exit_callback,
+                            type=data_type,
+                            fec=fec,
+                            sock_opts=sock_opts)
     return SockHandler(sock, log,
                             log_all_data=False,
-                            read_data_q=Queue.Queue(100),
-                            write_data_q=Queue.Queue(100),
+                            read_data_q=new_sock_q(100),
+                            write_data_q=new_sock_q(100),
                             hand_exit_callback=exit_callback,
-                            type=data_type
+                            type=data_type,
+                            fec=fec,
+                            sock_opts=sock_opts
                             )
  
 def connect_to_client(log, host, port, stop_event):
@@ -81,34 +136,145 @@ def connect_to_client(log, host, port, stop_event):
     Return (sock, addr, connected_flag)
     Shuts down the socket server before returning.
     
-    accept() blocks until a client tries to connect.  
-    This causes a problem when the caller wants shut down the server.
-    To shut down the server and force a return from connect_to_client,
-    the caller should:
-      stop_event.set()
-      dummy_connection(host, port)
+    stop_event is checked every half second, so
+    dummy_connection() is no longer needed to stop the wait.
+    Servers that accept more than one client should use
+    a SockListener.
     """
     #log.debug('connect_to_client: waiting on port %s' % str(port))
     ret_val = (0, 0, False)
-    serve = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # The SO_REUSEADDR option must be set before binding
-    serve.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)        
-    serve.bind((host, port))
-    serve.listen(1)
+    listener = SockListener(log, host, port, backlog=1)
     while not stop_event.isSet():
-        try:        
-            sock, addr = serve.accept()
-        except OSError, e:
-            if e.errno == EINTR:
-                continue
-        except Exception:
+        sock, addr = listener.accept(0.5)
+        if sock is None:
             continue
         if not stop_event.isSet():
             ret_val = (sock, addr, True)
-            break
-    serve.shutdown(socket.SHUT_RDWR)
-    serve.close()
+        else:
+            utils.close_sock(sock)
+        break
+    listener.close()
     return ret_val                    
+
+
+class SockListener:
+    """
+        A listening server socket, open until close().
+        accept() waits for the next client in the backlog.
+        close() may be called from any thread, and makes
+        a waiting accept() return at once.
+    """
+    def __init__(self, log, host, port, backlog=16, path=None):
+        """
+            log =       log object
+            host, port = address to listen on, port 0 for any
+            backlog =   clients that may wait to be accepted
+            path =      Unix domain socket path to listen on
+                        instead of host, port.  A stale socket
+                        file is removed, and close() removes it.
+        Raise socket.error if the address cannot be bound.
+        """
+        self._log = log
+        self._lock = threading.Lock()
+        self._wakeup = utils.Wakeup()
+        self._accepting = False
+        self._path = path
+        if path is None:
+            self._serve = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            self._serve = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if path is None:
+                # The SO_REUSEADDR option must be set before binding
+                self._serve.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self._serve.bind((host, port))
+            else:
+                if os.path.exists(path):
+                    os.remove(path)
+                self._serve.bind(path)
+            self._serve.listen(backlog)
+            self._serve.setblocking(0)
+        except (socket.error, OSError):
+            self._serve.close()
+            raise
+        self.port = utils.get_sock_port(self._serve)
+        self._addr_str = path or str(self.port)
+        self.accept_count = 0
+        
+    def accept(self, timeout=None):
+        """Wait for a client to connect
+        
+        Return (sock, addr), a blocking socket and its peer address.
+        Return (None, None) after timeout seconds or close().
+        """
+        self._lock.acquire()
+        if self._wakeup.isSet():
+            self._lock.release()
+            return (None, None)
+        self._accepting = True
+        self._lock.release()
+        try:
+            return self._accept(timeout)
+        finally:
+            self._lock.acquire()
+            self._accepting = False
+            if self._wakeup.isSet():
+                self._shutdown()
+            self._lock.release()
+            
+    def _accept(self, timeout):
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while not self._wakeup.isSet():
+            try:
+                sock, addr = self._serve.accept()
+            except socket.error, e:
+                if e.args[0] not in (EAGAIN, EINTR, ECONNABORTED):
+                    # out of descriptors, or the like
+                    self._log.error('SockListener: accept failed on %s: %s' % \
+                                    (self._addr_str, str(e)))
+                    self._wakeup.wait(0.1)
+                    self._wakeup.clear_poke()
+            else:
+                sock.setblocking(1)
+                self.accept_count += 1
+                return (sock, addr)
+            wait = None
+            if end_time is not None:
+                wait = end_time - time.time()
+                if wait <= 0:
+                    break
+            self._wakeup.wait_readable(self._serve, wait)
+        return (None, None)
+        
+    def _shutdown(self):
+        if self._serve is not None:
+            self._serve.close()
+            self._serve = None
+            self._wakeup.close()
+            if self._path is not None:
+                try:
+                    os.remove(self._path)
+                except OSError:
+                    pass
+        
+    def get_sock_port(self):
+        """Return the listening port number"""
+        return self.port
+        
+    def is_open(self):
+        return not self._wakeup.isSet()
+        
+    def close(self):
+        """Stop listening, wake a thread waiting in accept()"""
+        self._lock.acquire()
+        try:
+            self._wakeup.set()
+            if not self._accepting:
+                self._shutdown()
+        finally:
+            self._lock.release()
                             
                             
 def dummy_connection(host, port):
@@ -132,26 +298,441 @@ def dummy_connection(host, port):
         break
 
 
-class PacketReadThread(threading.Thread):
+class ByteBudget:
+    """A cap on the bytes held by a set of ByteQueues
+    
+    When the cap is reached, ByteQueues that hold data stop
+    taking more until data is read from any of them.  The
+    bytes of a queue that is closed or garbage collected
+    are returned.
+    """
+    def __init__(self, max_bytes):
+        """max_bytes = the cap, 0 for none"""
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._used = 0
+        self._peak = 0
+        self._spent_count = 0
+        self._queues = {}           # id -> weakref to the ByteQueue
+        self._held = {}             # id -> bytes the queue holds
+        self._collected = deque()   # ids of garbage collected queues
+        
+    def register(self, q):
+        key = id(q)
+        def on_collected(ref, collected=self._collected, key=key):
+            # may run in any thread with any lock held, so just note it
+            collected.append(key)
+        self._lock.acquire()
+        self._forget_collected()
+        self._queues[key] = weakref.ref(q, on_collected)
+        self._held[key] = 0
+        self._lock.release()
+        
+    def add(self, q, n_bytes):
+        self._lock.acquire()
+        was_spent = self._is_spent()
+        self._held[id(q)] += n_bytes
+        self._used += n_bytes
+        self._peak = max(self._peak, self._used)
+        if self._is_spent() and not was_spent:
+            self._spent_count += 1
+        self._lock.release()
+        
+    def release(self, q, n_bytes):
+        """Return bytes read from a queue
+        
+        Wakes the producers of all the queues when the budget
+        is no longer spent.  Must not be called with a queue's
+        mutex held.
+        """
+        self._lock.acquire()
+        was_spent = self._is_spent()
+        self._held[id(q)] -= n_bytes
+        self._used -= n_bytes
+        self._forget_collected()
+        queues = []
+        if was_spent and not self._is_spent():
+            queues = [ref() for ref in self._queues.values()]
+        self._lock.release()
+        for q in queues:
+            if q is None:
+                continue
+            q.not_full.acquire()
+            q.not_full.notifyAll()
+            q.not_full.release()
+            
+    def is_spent(self):
+        if self._collected:
+            self._lock.acquire()
+            self._forget_collected()
+            self._lock.release()
+        return self._is_spent()
+        
+    def _is_spent(self):
+        return (self.max_bytes > 0) and (self._used >= self.max_bytes)
+        
+    def _forget_collected(self):
+        """Return the bytes of collected queues, self._lock held"""
+        while self._collected:
+            key = self._collected.popleft()
+            del self._queues[key]
+            self._used -= self._held.pop(key)
+        
+    def get_stats(self):
+        """Return a dict of budget counters"""
+        return {'max_bytes': self.max_bytes,
+                'used_bytes': self._used,
+                'peak_bytes': self._peak,
+                'spent_count': self._spent_count}
+        
+        
+class ByteQueue(Queue.Queue):
+    """A Queue of strings bounded by bytes as well as items
+    
+    put() blocks, or raises Queue.Full if not blocking, when
+    the queue holds max_bytes, until it is down to half that.
+    It also blocks while the ByteBudget is spent, unless the
+    queue is empty, so every queue can always make progress.
+    An item is taken whenever the queue is below the limit,
+    so items larger than max_bytes still pass.  close() returns
+    the bytes of a queue that will not be read to the budget.
+    """
+    def __init__(self, maxsize=0, max_bytes=0, budget=None):
+        """
+            maxsize = maximum items, 0 for no limit
+            max_bytes = high-water mark, bytes, 0 for no limit
+            budget = None or the ByteBudget shared with other queues
+        """
+        Queue.Queue.__init__(self, maxsize)
+        self.max_bytes = max_bytes
+        self._low_bytes = max_bytes / 2
+        self._budget = budget
+        self._bytes = 0
+        self._peak_bytes = 0
+        self._throttled = False
+        self._throttle_count = 0
+        if budget is not None:
+            budget.register(self)
+        
+    def put(self, item, block=True, timeout=None):
+        """Queue.put() with the byte limits"""
+        self.not_full.acquire()
+        try:
+            if not block:
+                if self._is_full():
+                    raise Queue.Full
+            elif timeout is None:
+                while self._is_full():
+                    self.not_full.wait()
+            else:
+                end_time = time.time() + timeout
+                while self._is_full():
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise Queue.Full
+                    self.not_full.wait(remaining)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        finally:
+            self.not_full.release()
+            
+    def get(self, block=True, timeout=None):
+        item = Queue.Queue.get(self, block, timeout)
+        if self._budget is not None:
+            self._budget.release(self, len(item))
+        return item
+        
+    def close(self):
+        """Discard the queued items, returning their bytes to the budget
+        
+        The queue can still be used.
+        """
+        self.not_full.acquire()
+        n_bytes = self._bytes
+        self.queue.clear()
+        self._bytes = 0
+        self._throttled = False
+        self.not_full.notifyAll()
+        self.not_full.release()
+        if (self._budget is not None) and n_bytes:
+            self._budget.release(self, n_bytes)
+        
+    def _is_full(self):
+        """Return True if put() must wait, self.mutex held"""
+        if 0 < self.maxsize <= self._qsize():
+            return True
+        if self._throttled:
+            return True
+        if (self._budget is not None) and self._bytes and self._budget.is_spent():
+            return True
+        return False
+        
+    def _put(self, item):
+        Queue.Queue._put(self, item)
+        self._bytes += len(item)
+        self._peak_bytes = max(self._peak_bytes, self._bytes)
+        if (self.max_bytes > 0) and (self._bytes >= self.max_bytes):
+            if not self._throttled:
+                self._throttle_count += 1
+            self._throttled = True
+        if self._budget is not None:
+            self._budget.add(self, len(item))
+            
+    def _get(self):
+        item = Queue.Queue._get(self)
+        self._bytes -= len(item)
+        if self._throttled and (self._bytes <= self._low_bytes):
+            self._throttled = False
+            # several producers may be waiting
+            self.not_full.notifyAll()
+        return item
+        
+    def get_bytes(self):
+        """Return the number of bytes queued"""
+        return self._bytes
+        
+    def get_stats(self):
+        """Return a dict of queue counters"""
+        return {'items': self.qsize(),
+                'bytes': self._bytes,
+                'peak_bytes': self._peak_bytes,
+                'throttle_count': self._throttle_count}
+        
+        
+_byte_budget = ByteBudget(global_config.sock_buffer_budget)
+
+def get_byte_budget():
+    """Return the ByteBudget of the process' socket queues"""
+    return _byte_budget
+    
+    
+def new_sock_q(maxsize=0, max_bytes=global_config.sock_q_max_bytes):
+    """Return a ByteQueue for a socket, in the process budget"""
+    return ByteQueue(maxsize, max_bytes, _byte_budget)
+    
+    
+def _close_q(q):
+    """Return the bytes of a socket queue nobody will read to the budget"""
+    if isinstance(q, ByteQueue):
+        q.close()
+        
+        
+def _sock_opt(sock_opts, name):
+    """Return socket option name from sock_opts or global_config"""
+    if sock_opts and (name in sock_opts):
+        return sock_opts[name]
+    return getattr(global_config, 'sock_' + name)
+
+
+def set_sock_opts(sock, sock_opts=None):
+    """Set the TCP_NODELAY and buffer size options of sock
+    
+    sock_opts = dict that overrides the global_config sock_ values:
+        'recv_size', 'send_batch', 'tcp_nodelay', 'rcvbuf', 'sndbuf'
+    Raise socket.error if the socket is closed.
+    """
+    if _sock_opt(sock_opts, 'tcp_nodelay') and (sock.family != socket.AF_UNIX):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    rcvbuf = _sock_opt(sock_opts, 'rcvbuf')
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sndbuf = _sock_opt(sock_opts, 'sndbuf')
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+
+class _BufPool:
+    """Receive bytearrays of one size, reused by the packet read
+        threads and handlers of the process
+    """
+    MAX_FREE = 32
+    
+    def __init__(self, buf_size):
+        self.buf_size = buf_size
+        self._free = deque()
+        
+    def get(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.buf_size)
+            
+    def put(self, buf):
+        if len(self._free) < _BufPool.MAX_FREE:
+            self._free.append(buf)
+            
+            
+_buf_pools = {}
+_buf_pools_lock = threading.Lock()
+
+def _get_buf_pool(buf_size):
+    """Return the receive buffer pool for buf_size"""
+    _buf_pools_lock.acquire()
+    try:
+        pool = _buf_pools.get(buf_size)
+        if pool is None:
+            pool = _BufPool(buf_size)
+            _buf_pools[buf_size] = pool
+        return pool
+    finally:
+        _buf_pools_lock.release()
+
+
+def _join_bufs(bufs):
+    """Return a list of buffers joined into one
+    
+    Queued data may be strings, bytearrays or memoryviews,
+    which ''.join() only accepts when they are all strings.
+    """
+    try:
+        return ''.join(bufs)
+    except TypeError:
+        joined = bytearray()
+        for buf in bufs:
+            joined += buf
+        return joined
+
+
+def _recv_into(sock, buf):
+    """Read from sock into buf, return a memoryview of the data"""
+    return memoryview(buf)[:sock.recv_into(buf)]
+
+
+class PktFramer:
+    """
+        Assemble proxy packets from a byte stream.
+        Received data is copied into a fixed size bytearray.
+        The sync code is located with a single search, the
+        length and type fields are decoded in one step and
+        every complete packet in the buffer is returned.
+        Bytes that cannot be part of a packet are discarded,
+        so line noise never accumulates in the buffer.
+    """
+    HDR_FMT = '<HB'         # length, type
+    CKSUM_FMT = '<H'
+    SYNC_LEN = len(ProxyPkt.SYNC_CODE_STR)
+
+    def __init__(self, log, buf_size=2 * ProxyPkt.MAX_FEC_PKT_LEN):
+        """
+            log =       log object
+            buf_size =  size of the preallocated receive buffer.
+                        Must be at least twice the maximum packet length.
+        """
+        self._log = log
+        self._buf_size = max(buf_size, 2 * ProxyPkt.MAX_FEC_PKT_LEN)
+        self._buf = bytearray(self._buf_size)
+        self._start = 0     # index of first unprocessed byte
+        self._end = 0       # index one past the last buffered byte
+        self.noise_bytes = 0
+        self.len_errors = 0
+        self.type_errors = 0
+        self.cksum_errors = 0
+
+    def feed(self, data):
+        """Buffer data and return a list of whole, valid packet strings"""
+        pkts = []
+        max_chunk = self._buf_size / 2
+        while data:
+            chunk = data[:max_chunk]
+            data = data[max_chunk:]
+            self._append(chunk)
+            self._extract_pkts(pkts)
+        return pkts
+
+    def _append(self, chunk):
+        """Copy chunk into the buffer, compacting it first if needed"""
+        n = len(chunk)
+        if self._end + n > self._buf_size:
+            pending = self._end - self._start
+            self._buf[0:pending] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = pending
+        self._buf[self._end:self._end + n] = chunk
+        self._end += n
+
+    def _extract_pkts(self, pkts):
+        """Append every complete packet in the buffer to pkts"""
+        buf = self._buf
+        i = self._start
+        end = self._end
+        while True:
+            sync_i = buf.find(ProxyPkt.SYNC_CODE_STR, i, end)
+            if sync_i < 0:
+                # Keep a possible partial sync code, drop the rest
+                keep_i = max(i, end - (PktFramer.SYNC_LEN - 1))
+                self.noise_bytes += keep_i - i
+                i = keep_i
+                break
+            self.noise_bytes += sync_i - i
+            i = sync_i
+            if end - i < ProxyPkt.HDR_LEN:
+                break
+            pkt_len, pkt_type = struct.unpack_from(PktFramer.HDR_FMT, buf,
+                                                    i + ProxyPkt.LEN_LSB)
+            if pkt_type > ProxyPkt.MAX_PKT_TYPE:
+                self._log.error('Got invalid proxy packet type (%s)' % str(pkt_type))
+                self.type_errors += 1
+                i += PktFramer.SYNC_LEN
+                continue
+            if (pkt_len > max_pkt_len(pkt_type)) or (pkt_len < ProxyPkt.MIN_PKT_LEN):
+                self._log.error('Got invalid proxy packet length (%s)' % str(pkt_len))
+                self.len_errors += 1
+                i += PktFramer.SYNC_LEN
+                continue
+            if end - i < pkt_len:
+                # Wait for the rest of the packet
+                break
+            cksum_i = i + pkt_len - ProxyPkt.CKSUM_LEN
+            stored_cksum = struct.unpack_from(PktFramer.CKSUM_FMT, buf, cksum_i)[0]
+            if buf_cksum(buf, i, cksum_i) != stored_cksum:
+                self._log.error('Got invalid proxy packet checksum')
+                self.cksum_errors += 1
+                i += PktFramer.SYNC_LEN
+                continue
+            pkts.append(str(buf[i:i + pkt_len]))
+            i += pkt_len
+        if i == end:
+            i = end = 0
+        self._start = i
+        self._end = end
+
+    def pending_len(self):
+        """Return the number of buffered, unframed bytes"""
+        return self._end - self._start
+
+    def get_stats(self):
+        """Return a dict of framing error counters"""
+        return {'noise_bytes': self.noise_bytes,
+                'len_errors': self.len_errors,
+                'type_errors': self.type_errors,
+                'cksum_errors': self.cksum_errors}
+
+
+class PacketReadThread(utils.BaseThread):
     """
         Read stream data from a socket,  assemble proxy packets
         and enqueue them.
         Only strings containing well-formed, whole packets are
         written to the queue.
+        With FEC decoding, the packets in FEC frames are enqueued
+        and lost ones are recovered where possible.
         The socket is closed and the thread exits
         if the peer disconnects.
     """
     def __init__(self, sock, log, log_data_flag=False, data_q=None,
-                    exit_callback=None):
+                    exit_callback=None, fec=False, recv_size=None):
         """
             sock =          socket to read from
             pkt_q =        packet queue
             log =           log object
             log_data_flag = True to log all socket data
+            fec =           True to decode FEC frames
+            recv_size =     most bytes read at a time,
+                            None for global_config.sock_recv_size
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
-        self._stop_event = threading.Event()
+        utils.BaseThread.__init__(self)
+        self._stop_event = utils.Wakeup()
         self._log = log
         self._sock = sock
         self._log_all_data = log_data_flag
@@ -164,14 +745,14 @@ class PacketReadThread(threading.Thread):
         self._data_path = '%s->%s' % (self._host, self._client)
         self.name = 'PacketReadThread (%s)' % self._data_path
         self._exit_callback = exit_callback
-        self._rx_byte_buf = ''
-        self._pkt_state = 0
-        self._pkt_read_index = 0
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._framer = PktFramer(log)
+        self._fec = None
+        if fec:
+            self._fec = FecDecoder(log)
+        if recv_size is None:
+            recv_size = global_config.sock_recv_size
+        self._buf_pool = _get_buf_pool(recv_size)
+        self._start_and_wait()
         
     def _print_buffer(self, data):
         """Print contents of a data buffer"""
@@ -186,12 +767,23 @@ class PacketReadThread(threading.Thread):
         except socket.error:
             # client disconnected
             self._stop_event.set()
-        self._running = True
-        self._started = True
+        buf = self._buf_pool.get()
+        self._set_started()
         while not self._stop_event.isSet():
+            self._stop_event.clear_poke()
             self._check_for_new_data_q()
+            timeout = None
+            if self._fec is not None:
+                expire_time = self._fec.get_expire_time()
+                if expire_time is not None:
+                    timeout = max(expire_time - time.time(), 0)
+            if not self._stop_event.wait_readable(self._sock, timeout):
+                if (self._fec is not None) and (self._data_q is not None):
+                    for pkt_buf in self._fec.expire():
+                        self._put(pkt_buf)
+                continue
             try:
-                data = self._sock.recv(ProxyPkt.MAX_PKT_LEN)
+                data = _recv_into(self._sock, buf)
             except socket.timeout, msg:
                 continue
             except socket.error:
@@ -211,129 +803,34 @@ class PacketReadThread(threading.Thread):
             if self._data_q is not None:
                 #self._log.debug('Received %s bytes from %s' % (str(len(data)), self._client))
                 self._handle_rx_data(data)
+        self._buf_pool.put(buf)
         self._running = False
         #self._log.debug('Stopping %s' % self.name)
         utils.close_sock(self._sock)
+        self._stop_event.close()
         if self._exit_callback:
             self._exit_callback(self)
         #self._log.debug('Exiting %s' % self.name)
             
     def _handle_rx_data(self, data):
-        """Buffer and packetize the input data"""
-        self._rx_byte_buf += data
-        self._packetize()
-        
-    def _packetize(self):
-        """Assemble and enqueue proxy packet buffers"""
-#         self._log.debug('in _packetize: rx_byte_buf is %s' % \
-#                             utils.bytes_to_hex(self._rx_byte_buf))
-#         self._log.debug('in _packetize: self._rx_byte_buf length is %s' % \
-#                             str(len(self._rx_byte_buf)))
-#         self._log.debug('in _packetize: self._pkt_read_index is %s' % \
-#                             str(self._pkt_read_index))
-        while True:
-            if self._pkt_read_index == len(self._rx_byte_buf):
-                return
-            if self._pkt_state == 0:
-                self._trim_rx_byte_buf()
-                if self._rx_byte_buf[self._pkt_read_index:self._pkt_read_index+1] == \
-                                        ProxyPkt.SYNC_BYTE_0_VALUE:
-                    self._pkt_state += 1
-                    #self._log.debug('  got sync byte 0')
-                else:
-                    self._pkt_state = 0
-                self._pkt_read_index += 1
-                continue
-            elif self._pkt_state == 1:
-                if self._rx_byte_buf[self._pkt_read_index:self._pkt_read_index+1] == \
-                                        ProxyPkt.SYNC_BYTE_1_VALUE:
-                    self._pkt_state += 1
-                    #self._log.debug('  got sync byte 1')
-                else:
-                    self._pkt_state = 0
-                self._pkt_read_index += 1
-                continue
-            elif self._pkt_state == 2:
-                if self._rx_byte_buf[self._pkt_read_index:self._pkt_read_index+1] == \
-                                        ProxyPkt.SYNC_BYTE_2_VALUE:
-                    self._pkt_state += 1
-                    #self._log.debug('  got sync byte 2')
-                else:
-                    self._pkt_state = 0
-                self._pkt_read_index += 1
-                continue
-            elif self._pkt_state == 3:
-                if self._rx_byte_buf[self._pkt_read_index:self._pkt_read_index+1] == \
-                                        ProxyPkt.SYNC_BYTE_3_VALUE:
-                    self._pkt_state += 1
-                    #self._log.debug('  got sync byte 3')
-                else:
-                    self._pkt_state = 0
-                self._pkt_read_index += 1
-                continue
-            elif self._pkt_state == 4:
-                # Get pkt length LSB
-                self._len_lsb = self._rx_byte_buf[self._pkt_read_index:self._pkt_read_index+1]
-                self._pkt_read_index += 1
-                self._pkt_state += 1
-                continue
-            elif self._pkt_state == 5:
-                # Get pkt length MSB
-                self._len_msb = self._rx_byte_buf[self._pkt_read_index:self._pkt_read_index+1]
-                self._pkt_read_index += 1
-                self._pkt_len = (ord(self._len_msb) * 256) + ord(self._len_lsb)
-                if self._pkt_len > ProxyPkt.MAX_PKT_LEN:
-                    self._log.error('Got invalid proxy packet length, too long')
-                    self._pkt_state = 0
-                    continue
-                if self._pkt_len < ProxyPkt.MIN_PKT_LEN:
-                    self._log.error('Got invalid proxy packet length, too short')
-                    self._pkt_state = 0
-                    continue
-                self._pkt_state += 1
-                #self._log.debug('  got good pkt length')
-                continue
-            elif self._pkt_state == 6:
-                # Get pkt type
-                self._pkt_type = self._rx_byte_buf[self._pkt_read_index:self._pkt_read_index+1]
-                self._pkt_read_index += 1
-                if self._pkt_type > chr(ProxyPkt.MAX_PKT_TYPE):
-                    self._log.error('Got invalid proxy packet type (%s)' % \
-                                    str(self._pkt_type))
-                    self._pkt_state = 0
-                    continue
-                self._pkt_state += 1
-                #self._log.debug('  got good pkt type')
-                continue
-            elif self._pkt_state == 7:
-                # Wait for pkt data and checksum to arrive
-                bytes_avail = len(self._rx_byte_buf) - self._pkt_read_index
-                bytes_needed = self._pkt_len - ProxyPkt.HDR_LEN
-                if bytes_avail < bytes_needed:
-                    return
-                else:
-                    start_i = self._pkt_read_index - ProxyPkt.HDR_LEN
-                    end_i = self._pkt_read_index + bytes_needed
-                    pkt = ProxyPkt(self._rx_byte_buf[start_i:end_i])
-                    self._rx_byte_buf = self._rx_byte_buf[end_i:]
-                if pkt.cksum_is_valid():
-                    self._data_q.put(pkt.get_pkt_buf())
-                    #self._log.debug('PacketReadThread: Received packet:')
-                    #self._log.debug(pkt.str())
-                else:
-                    self._log.error('Got invalid proxy packet checksum')
-                self._pkt_read_index = 0
-                self._pkt_state = 0
-                continue
+        """Frame the input data and enqueue whole packets"""
+        for pkt_buf in self._framer.feed(data):
+            if self._fec is None:
+                self._put(pkt_buf)
             else:
-                self._log.error('Invalid state value in sock_utils.PacketReadThread()')
-           
-    def _trim_rx_byte_buf(self):
-        """Prevent gibberish from overflowing the rx byte buf"""
-        pass
-#         if self._pkt_read_index >= 100:
-#             self._rx_byte_buf = self._rx_byte_buf[self._pkt_read_index:]
-#             self._pkt_read_index = 0
+                for fec_pkt_buf in self._fec.decode(pkt_buf):
+                    self._put(fec_pkt_buf)
+
+    def _put(self, data):
+        """Enqueue data, waiting while the queue is full
+        
+        The socket is not read meanwhile, which slows the sender.
+        """
+        while not utils.q_put(self._data_q, data, wakeup=self._stop_event):
+            if self._stop_event.isSet():
+                return
+            self._stop_event.clear_poke()
+            self._check_for_new_data_q()
 
     def _check_for_new_data_q(self):
         """
@@ -355,6 +852,15 @@ class PacketReadThread(threading.Thread):
         self._new_data_q = q
         self._new_data_q_avail = True       
         self._new_data_q_lock.release()
+        self._stop_event.poke()
+        
+    def get_stats(self):
+        """Return a dict of framer and FEC decoder counters"""
+        stats = self._framer.get_stats()
+        if self._fec is not None:
+            for name, value in self._fec.get_stats().items():
+                stats['fec_' + name] = value
+        return stats
         
     def is_running(self):
         return self._running                     
@@ -363,25 +869,29 @@ class PacketReadThread(threading.Thread):
         """Stop this thread and wait for it to end"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
 
 
-class SockWriteThread(threading.Thread):
+class SockWriteThread(utils.BaseThread):
     """Read data from a queue, write it to a socket.
+        The items waiting in the queue are joined and
+        written together.
         The socket is closed and the thread exits
         if the peer disconnects.
     """
     def __init__(self, sock, log, log_data_flag=False, data_q=None,
-                timeout=10, exit_callback=None):
+                timeout=10, exit_callback=None, send_batch=None):
         """
             sock =          socket to write data to
             data_q =        queue to read data from
             log =           log object
             log_data_flag = True to log all socket data
+            timeout =       seconds a write may make no progress
+            send_batch =    most queued bytes joined into one write,
+                            None for global_config.sock_send_batch
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
-        self._stop_event = threading.Event()
+        utils.BaseThread.__init__(self)
+        self._stop_event = utils.Wakeup()
         self._log = log
         self._sock = sock
         self._log_all_data = log_data_flag
@@ -395,11 +905,10 @@ class SockWriteThread(threading.Thread):
         self._data_path = '%s->%s' % (self._host, self._client)
         self.name = 'SockWriteThread (%s)' % self._data_path
         self._exit_callback = exit_callback
-        self._started = False
-        self._running = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        if send_batch is None:
+            send_batch = global_config.sock_send_batch
+        self._send_batch = send_batch
+        self._start_and_wait()
         
     def _print_buffer(self, data):
         """Print contents of a data buffer"""
@@ -414,48 +923,93 @@ class SockWriteThread(threading.Thread):
         except socket.error:
             # client disconnected
             self._stop_event.set()
-        self._started = True
-        self._running = True
-        while not self._stop_event.isSet():
-            self._check_for_new_data_q()
-            if self._data_q is None:
-                # no data queue exists yet
-                utils.wait(0.5)
-                continue
-            data = utils.q_get(self._data_q, get_timeout=1)
-            if data is None:
-                continue
-            #self._log.debug('SockWriteThread: dequeued a %s' % repr(data))
-            startTime = datetime.now()
-            # keep sending until all data is sent or timeout
-            while data and (not self._stop_event.isSet()):
-                while True:
-                    try:
-                        sent = self._sock.send(data[:ProxyPkt.MAX_PKT_LEN])
-                    except OSError, e:
-                        if e.errno == EINTR:
-                            continue
-                    except socket.error:
-                        # client disconnected
-                        self._stop_event.set()
-                        break  # out of while True
-                    break # out of while True
-                if self._stop_event.isSet():
-                    break
-                #self._log.debug('SockWriteThread: Sent %s bytes to %s' % (str(sent), self._client))
-                data = data[sent:]
-                elapsedTime = datetime.now() - startTime
-                if elapsedTime > self._timeout:
-                    self._log.error('Timed out writing to %s' % self._peer_addr_port)
-                    self._stop_event.set()
-                    break
+        self._set_started()
+        try:
+            while not self._stop_event.isSet():
+                self._write_next()
+        except Exception, e:
+            # Exit, so the handler stops instead of running
+            #  without a writer
+            self._log.error('SockWriteThread: error writing to %s, %s: %s' % \
+                            (self._client, e.__class__.__name__, e))
         self._running = False
         #self._log.debug('Stopping %s' % self.name)
         utils.close_sock(self._sock)
+        self._stop_event.close()
         if self._exit_callback:
             self._exit_callback(self)
         #self._log.debug('Exiting %s' % self.name)
         
+    def _write_next(self):
+        """Wait for queued data and write it to the socket"""
+        self._stop_event.clear_poke()
+        self._check_for_new_data_q()
+        if self._data_q is None:
+            # no data queue exists yet
+            self._stop_event.wait()
+            return
+        if hasattr(self._data_q, 'not_empty'):
+            timeout = None
+        else:
+            # a queue that cannot wake us, e.g. a FecEncoder
+            timeout = 0.5
+        data = utils.q_get(self._data_q, get_timeout=timeout,
+                            wakeup=self._stop_event)
+        if data is None:
+            return
+        data = self._batch(data)
+        self._print_buffer(data)
+        #self._log.debug('SockWriteThread: dequeued a %s' % repr(data))
+        startTime = datetime.now()
+        view = memoryview(data)
+        # keep sending until all data is sent or timeout
+        while view and (not self._stop_event.isSet()):
+            sent = 0
+            while True:
+                try:
+                    sent = self._sock.send(view)
+                except socket.timeout:
+                    # socket buffer still full
+                    pass
+                except OSError, e:
+                    if e.errno == EINTR:
+                        continue
+                except socket.error:
+                    # client disconnected
+                    self._stop_event.set()
+                    break  # out of while True
+                break # out of while True
+            if self._stop_event.isSet():
+                break
+            #self._log.debug('SockWriteThread: Sent %s bytes to %s' % (str(sent), self._client))
+            if sent:
+                view = view[sent:]
+                startTime = datetime.now()
+            elif datetime.now() - startTime > self._timeout:
+                self._log.error('Timed out writing to %s' % self._client)
+                self._stop_event.set()
+                break
+        
+    def _batch(self, data):
+        """Return data joined with the data waiting in the queue,
+            up to the send batch size
+        """
+        n_bytes = len(data)
+        if n_bytes >= self._send_batch:
+            return data
+        bufs = [data]
+        while n_bytes < self._send_batch:
+            try:
+                data = self._data_q.get(False)
+            except Queue.Empty:
+                break
+            if data:
+                bufs.append(data)
+                n_bytes += len(data)
+        if len(bufs) == 1:
+            return bufs[0]
+        return _join_bufs(bufs)
+        
     def _check_for_new_data_q(self):
         """
             If a new data queue is available, start
@@ -476,6 +1030,7 @@ class SockWriteThread(threading.Thread):
         self._new_data_q = q       
         self._new_data_q_avail = True
         self._new_data_q_lock.release()
+        self._stop_event.poke()
         
     def is_running(self):
         return self._running              
@@ -484,26 +1039,27 @@ class SockWriteThread(threading.Thread):
         """Stop this thread and wait for it to end"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
             
 
-class StreamReadThread(threading.Thread):
+class StreamReadThread(utils.BaseThread):
     """
         Read stream data from a socket, write it to a queue.
         The socket is closed and the thread exits
          if the client disconnects.
     """
     def __init__(self, sock, log, log_data_flag=False, data_q=None,
-                    exit_callback=None):
+                    exit_callback=None, recv_size=None):
         """
             sock =          socket to read from
             data_q =        queue to write to
             log =           log object
             log_data_flag = True to log all socket data
+            recv_size =     most bytes read at a time,
+                            None for global_config.sock_recv_size
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
-        self._stop_event = threading.Event()
+        utils.BaseThread.__init__(self)
+        self._stop_event = utils.Wakeup()
         self._log = log
         self._sock = sock
         self._log_all_data = log_data_flag
@@ -516,11 +1072,12 @@ class StreamReadThread(threading.Thread):
         self._data_path = '%s->%s' % (self._host, self._client)
         self.name = 'StreamReadThread (%s)' % self._data_path
         self._exit_callback = exit_callback
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        if recv_size is None:
+            recv_size = global_config.sock_recv_size
+        # The queued data must be a new string, which recv()
+        #  makes with one copy less than recv_into() a pool buffer
+        self._recv_size = recv_size
+        self._start_and_wait()
         
     def _print_buffer(self, data):
         """Print contents of a data buffer"""
@@ -535,12 +1092,14 @@ class StreamReadThread(threading.Thread):
         except socket.error:
             # client disconnected
             self._stop_event.set()
-        self._running = True
-        self._started = True
+        self._set_started()
         while not self._stop_event.isSet():
+            self._stop_event.clear_poke()
             self._check_for_new_data_q()
+            if not self._stop_event.wait_readable(self._sock):
+                continue
             try:
-                data = self._sock.recv(ProxyPkt.MAX_PKT_LEN)
+                data = self._sock.recv(self._recv_size)
             except socket.timeout, msg:
                 continue
             except socket.error:
@@ -559,15 +1118,27 @@ class StreamReadThread(threading.Thread):
                 break
             if data is not None:
                 #self._log.debug('Received %s bytes from %s' % (str(len(data)), self._client))
-                self._data_q.put(data)
+                self._put(data)
                 self._print_buffer(data)
         self._running = False
         #self._log.debug('Stopping %s' % self.name)
         utils.close_sock(self._sock)
+        self._stop_event.close()
         if self._exit_callback:
             self._exit_callback(self)
         #self._log.debug('Exiting %s' % self.name)
 
+    def _put(self, data):
+        """Enqueue data, waiting while the queue is full
+        
+        The socket is not read meanwhile, which slows the sender.
+        """
+        while not utils.q_put(self._data_q, data, wakeup=self._stop_event):
+            if self._stop_event.isSet():
+                return
+            self._stop_event.clear_poke()
+            self._check_for_new_data_q()
+
     def _check_for_new_data_q(self):
         """
             If a new data queue is available, start
@@ -588,6 +1159,7 @@ class StreamReadThread(threading.Thread):
         self._new_data_q = q
         self._new_data_q_avail = True       
         self._new_data_q_lock.release()
+        self._stop_event.poke()
         
     def is_running(self):
         return self._running                     
@@ -596,10 +1168,10 @@ class StreamReadThread(threading.Thread):
         """Stop this thread and wait for it to end"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
             
             
-class SockHandler(threading.Thread):
+class SockHandler(utils.BaseThread):
     """
         A class that creates a read and a write
          socket thread and contains state information
@@ -612,7 +1184,9 @@ class SockHandler(threading.Thread):
                  read_data_q=None,
                  write_data_q=None,
                  hand_exit_callback=None,
-                 type='stream'):
+                 type='stream',
+                 fec=False,
+                 sock_opts=None):
         """
             sock = socket object
             log = log object
@@ -622,9 +1196,10 @@ class SockHandler(threading.Thread):
                 without any interpretation.
             if type = 'packet', data read from the socket is assembled
                 into proxy packets.  Only complete, valid packets are enqueued.    
+            fec = True to decode FEC frames in a 'packet' socket
+            sock_opts = dict of socket options, see set_sock_opts
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        utils.BaseThread.__init__(self)
         self._stop_event = threading.Event()
         self._log = log
         self.sock = sock
@@ -640,32 +1215,41 @@ class SockHandler(threading.Thread):
         self._running = False
         self._started = False
         self._type = type
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._fec = fec
+        self._sock_opts = sock_opts
+        self._start_and_wait()
         
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s' % self.name)
+        try:
+            set_sock_opts(self.sock, self._sock_opts)
+        except socket.error:
+            # client disconnected, the read thread will exit
+            pass
+        recv_size = _sock_opt(self._sock_opts, 'recv_size')
         
         if self._type == 'stream':
             self._read_thread = StreamReadThread(self.sock, self._log,
                                     log_data_flag=self._log_all_data,
                                     data_q=self._read_data_q,
-                                    exit_callback=self._my_exit_callback)
+                                    exit_callback=self._my_exit_callback,
+                                    recv_size=recv_size)
         else:
             # must be packet type
             self._read_thread = PacketReadThread(self.sock, self._log,
                                     log_data_flag=self._log_all_data,
                                     data_q=self._read_data_q,
-                                    exit_callback=self._my_exit_callback)
+                                    exit_callback=self._my_exit_callback,
+                                    fec=self._fec,
+                                    recv_size=recv_size)
         
         self._write_thread = SockWriteThread(self.sock, self._log,
                                 log_data_flag=self._log_all_data,
                                 data_q=self._write_data_q,
-                                exit_callback=self._my_exit_callback)
-        self._running = True
-        self._started = True
+                                exit_callback=self._my_exit_callback,
+                                send_batch=_sock_opt(self._sock_opts, 'send_batch'))
+        self._set_started()
         
         self._stop_event.wait()
              
@@ -699,6 +1283,12 @@ class SockHandler(threading.Thread):
         """Return the handler socket write queue"""
         return self._write_data_q
         
+    def get_read_stats(self):
+        """Return the read thread's error counters, {} for a stream"""
+        if self._type == 'stream':
+            return {}
+        return self._read_thread.get_stats()
+        
     def get_peer_port(self):
         """Return the socket's peer port number"""
         return utils.get_peer_port(self.sock)
@@ -711,11 +1301,772 @@ class SockHandler(threading.Thread):
         return self._running
         
     def stop(self):
-        """Stop this thread and all its child threads"""
+        """Stop this thread and all its child threads
+        
+        Data left in the queues is discarded.
+        """
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
+        _close_q(self._read_data_q)
+        _close_q(self._write_data_q)
+
+
+class _WakeQueue(ByteQueue):
+    """A socket queue that wakes the reactor when an item is put,
+        or when an item is taken
+    """
+    def __init__(self, maxsize, on_put=None, on_get=None):
+        ByteQueue.__init__(self, maxsize, global_config.sock_q_max_bytes,
+                            _byte_budget)
+        self.on_put = on_put
+        self.on_get = on_get
+        
+    def _put(self, item):
+        ByteQueue._put(self, item)
+        if self.on_put is not None:
+            self.on_put()
+        
+    def _get(self):
+        item = ByteQueue._get(self)
+        if self.on_get is not None:
+            self.on_get()
+        return item
+
+
+def _wakes_on_put(q):
+    return isinstance(q, _WakeQueue) and (q.on_put is not None)
+
+
+def _wakes_on_get(q):
+    return isinstance(q, _WakeQueue) and (q.on_get is not None)
+
+
+class _Poller:
+    """select.epoll, or select.poll where epoll is not available
+    
+    Both take the same event flags on Linux.  Timeouts are in seconds.
+    """
+    IN = select.POLLIN
+    OUT = select.POLLOUT
+    ERR = select.POLLERR | select.POLLHUP
+    
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._scale = 1
+        else:
+            self._poller = select.poll()
+            self._scale = 1000
+        
+    def register(self, fd, mask):
+        self._poller.register(fd, mask)
+        
+    def modify(self, fd, mask):
+        self._poller.modify(fd, mask)
+        
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+        
+    def poll(self, timeout):
+        while True:
+            try:
+                return self._poller.poll(timeout * self._scale)
+            except (IOError, OSError, select.error), e:
+                if e.args[0] == EINTR:
+                    continue
+                raise
+                
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+
+
+class Reactor(threading.Thread):
+    """Drive the sockets of ReactorSockHandlers from one thread
+    
+    There is at most one Reactor per process, see get_reactor().
+    Sockets are non-blocking and polled with epoll.  Queues
+    given to ReactorSockHandler.set_write_q() are polled every
+    POLL_INTERVAL seconds, the handlers' own write queues wake
+    the reactor when data is put.  The thread exits when it has
+    had no handlers for IDLE_EXIT seconds, so
+    utils.wait_for_child_threads() is not held up by it.
+    """
+    POLL_INTERVAL = 0.05
+    IDLE_EXIT = 1.0
+    
+    def __init__(self, log):
+        threading.Thread.__init__(self)
+        self.setDaemon(False)
+        self._log = log
+        self.name = 'Reactor thread'
+        self._poller = _Poller()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poller.register(self._wake_r, _Poller.IN)
+        self._woken = False
+        self._handlers = {}         # fd -> ReactorSockHandler
+        self._commands = deque()    # (function, args) run in the reactor thread
+        self._running = True
+        
+    def wake(self):
+        """Make the reactor thread return from poll()"""
+        if not self._woken:
+            self._woken = True
+            try:
+                os.write(self._wake_w, 'x')
+            except OSError:
+                # pipe full, the reactor is already awake
+                pass
+                
+    def call(self, func, *args):
+        """Run func(*args) in the reactor thread
+        
+        Return False if the reactor has exited.
+        """
+        _reactor_lock.acquire()
+        try:
+            if not self._running:
+                return False
+            self._commands.append((func, args))
+        finally:
+            _reactor_lock.release()
+        self.wake()
+        return True
+        
+    def run(self):
+        """The actual thread code"""
+        self._log.debug('Starting %s' % self.name)
+        idle_time = time.time()
+        tick_time = 0
+        while True:
+            self._run_commands()
+            if self._handlers:
+                idle_time = time.time()
+            elif time.time() - idle_time > Reactor.IDLE_EXIT:
+                if self._exit_if_idle():
+                    break
+            woken = False
+            active = []
+            for fd, events in self._poller.poll(self._poll_timeout()):
+                if fd == self._wake_r:
+                    self._drain_wake_pipe()
+                    woken = True
+                    continue
+                handler = self._handlers.get(fd)
+                if handler is None:
+                    continue
+                active.append(handler)
+                if events & (_Poller.IN | _Poller.ERR):
+                    self._run_handler(handler, handler._on_readable)
+                if (events & _Poller.OUT) and handler._is_open():
+                    self._run_handler(handler, handler._on_writable)
+            # A wake-up is not tied to a socket, so all handlers
+            #  are checked, as they are every POLL_INTERVAL
+            now = time.time()
+            if woken or (now - tick_time >= Reactor.POLL_INTERVAL):
+                active = self._handlers.values()
+                tick_time = now
+            for handler in active:
+                self._run_handler(handler, handler._tick, now)
+                self._run_handler(handler, self._update, handler)
+        self._poller.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        self._log.debug('Exiting %s' % self.name)
+        
+    def _run_handler(self, handler, func, *args):
+        """Run a handler's event code, close the handler if it fails
+        
+        An exception must not end the reactor thread, which
+        serves every other socket too.
+        """
+        try:
+            func(*args)
+        except Exception, e:
+            self._log.error('Reactor: closing %s after %s: %s' % \
+                            (handler.name, e.__class__.__name__, e))
+            try:
+                handler._close()
+            except Exception:
+                self.remove(handler)
+        
+    def _exit_if_idle(self):
+        """Stop accepting handlers, return True if there are none"""
+        global _reactor
+        _reactor_lock.acquire()
+        try:
+            if self._commands:
+                return False
+            self._running = False
+            if _reactor is self:
+                _reactor = None
+            return True
+        finally:
+            _reactor_lock.release()
+        
+    def _poll_timeout(self):
+        """Return the poll() timeout, seconds"""
+        for handler in self._handlers.values():
+            if handler._needs_polling():
+                return Reactor.POLL_INTERVAL
+        return 0.5
+        
+    def _drain_wake_pipe(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError:
+            pass
+        # after the read, so a wake() during it is not lost
+        self._woken = False
+        
+    def _run_commands(self):
+        while self._commands:
+            func, args = self._commands.popleft()
+            func(*args)
+            
+    def add(self, handler):
+        """Start polling a handler's socket, reactor thread only"""
+        fd = handler.sock.fileno()
+        self._handlers[fd] = handler
+        handler._fd = fd
+        handler._mask = _Poller.IN
+        self._poller.register(fd, handler._mask)
+        
+    def remove(self, handler):
+        """Stop polling a handler's socket, reactor thread only"""
+        if self._handlers.get(handler._fd) is handler:
+            del self._handlers[handler._fd]
+            self._poller.unregister(handler._fd)
+            
+    def _update(self, handler):
+        """Poll for the events the handler is ready for"""
+        if not handler._is_open():
+            return
+        mask = handler._wanted_events()
+        if mask != handler._mask:
+            self._poller.modify(handler._fd, mask)
+            handler._mask = mask
+            
+            
+_reactor = None
+_reactor_lock = threading.Lock()
+
+def get_reactor(log):
+    """Return the process' Reactor, starting it if necessary"""
+    global _reactor
+    _reactor_lock.acquire()
+    try:
+        if _reactor is None:
+            _reactor = Reactor(log)
+            _reactor.start()
+        return _reactor
+    finally:
+        _reactor_lock.release()
+
+
+class ReactorSockHandler:
+    """
+        A SockHandler driven by the process' Reactor thread
+         instead of its own read and write threads.
+        The queue interface is the same as SockHandler's.
+        Data is written from a list of pending buffers, and
+        reading stops while the read queue is full.
+    """
+    MAX_WRITE_BUF = 64 * 1024   # bytes taken from the write queue ahead
+    
+    def __init__(self,
+                 sock,
+                 log,
+                 log_all_data=False,
+                 read_data_q=None,
+                 write_data_q=None,
+                 hand_exit_callback=None,
+                 type='stream',
+                 fec=False,
+                 write_timeout=10,
+                 sock_opts=None):
+        """
+            Arguments are the same as SockHandler's.
+            read_data_q, write_data_q = None to create queues
+                that wake the reactor
+            write_timeout = seconds a write may make no progress
+                before the socket is closed
+        """
+        self._log = log
+        self.sock = sock
+        self._log_all_data = log_all_data
+        self._exit_callback = hand_exit_callback
+        self._type = type
+        self._write_timeout = write_timeout
+        self.client_addr = utils.get_peer_addr_str(sock)
+        self.host_addr = utils.get_sock_addr_str(sock)  
+        self.name = 'reactor socket handler (host %s, client %s)' % (self.host_addr, self.client_addr)
+        self._framer = None
+        self._fec = None
+        if type != 'stream':
+            self._framer = PktFramer(log)
+            if fec:
+                self._fec = FecDecoder(log)
+        self._rx_pending = deque()  # read data waiting for room in the read q
+        self._tx_bufs = deque()     # data taken from the write q
+        self._tx_offset = 0         # bytes of _tx_bufs[0] already sent
+        self._tx_len = 0
+        self._tx_time = time.time() # time of the last write progress
+        self._fd = None
+        self._mask = 0
+        self._reactor = get_reactor(log)
+        if read_data_q is None:
+            read_data_q = _WakeQueue(100, on_get=self._wake_for_room)
+        self._read_data_q = read_data_q
+        if write_data_q is None:
+            write_data_q = _WakeQueue(100, on_put=self._wake)
+        self._write_data_q = write_data_q
+        self._recv_size = _sock_opt(sock_opts, 'recv_size')
+        self._buf_pool = None
+        if self._framer is not None:
+            self._buf_pool = _get_buf_pool(self._recv_size)
+        self._send_batch = _sock_opt(sock_opts, 'send_batch')
+        self._running = True
+        self._closed = False
+        try:
+            set_sock_opts(sock, sock_opts)
+        except socket.error:
+            # client disconnected, the first read will close us
+            pass
+        sock.setblocking(0)
+        if not self._reactor.call(self._reactor.add, self):
+            # the reactor exited while we were starting, use a new one
+            self._reactor = get_reactor(log)
+            self._reactor.call(self._reactor.add, self)
+        
+    def _wake(self):
+        self._reactor.wake()
+        
+    def _wake_for_room(self):
+        if self._rx_pending:
+            self._reactor.wake()
+        
+    # Interface used by the socket's clients
+    
+    def set_read_q(self, q):
+        """Set the socket read queue"""
+        self._read_data_q = q
+        self._reactor.wake()
+
+    def set_write_q(self, q):
+        """Set the socket write queue"""
+        self._write_data_q = q
+        self._reactor.wake()
+        
+    def get_read_q(self):
+        """Return the handler socket read queue"""
+        return self._read_data_q
+        
+    def get_write_q(self):
+        """Return the handler socket write queue"""
+        return self._write_data_q
+        
+    def get_read_stats(self):
+        """Return the framer's error counters, {} for a stream"""
+        if self._framer is None:
+            return {}
+        stats = self._framer.get_stats()
+        if self._fec is not None:
+            for name, value in self._fec.get_stats().items():
+                stats['fec_' + name] = value
+        return stats
+        
+    def get_peer_port(self):
+        """Return the socket's peer port number"""
+        return utils.get_peer_port(self.sock)
+        
+    def get_sock_port(self):
+        """Return the socket's port number"""
+        return utils.get_sock_port(self.sock)
+    
+    def is_running(self):
+        return self._running
+        
+    def stop(self):
+        """Close the socket
+        
+        The socket is closed by the reactor thread soon after
+        this returns.  Does not wait, so it may be called from
+        an exit callback.  Data left in the queues is discarded.
+        """
+        if self._running:
+            self._running = False
+            if not self._reactor.call(self._close):
+                self._close()
+        _close_q(self._read_data_q)
+        _close_q(self._write_data_q)
+            
+    # Called in the reactor thread
+    
+    def _is_open(self):
+        return not self._closed
+    
+    def _needs_polling(self):
+        """Return True if the handler has work without a socket event"""
+        if self._rx_pending and not _wakes_on_get(self._read_data_q):
+            return True
+        return (not _wakes_on_put(self._write_data_q)) or \
+                (self._fec is not None)
+        
+    def _wanted_events(self):
+        mask = 0
+        if not self._rx_pending:
+            mask |= _Poller.IN
+        if self._tx_bufs:
+            mask |= _Poller.OUT
+        return mask
+        
+    def _on_readable(self):
+        buf = None
+        if self._buf_pool is not None:
+            buf = self._buf_pool.get()
+        try:
+            try:
+                if buf is None:
+                    # stream data is queued as a new string, see StreamReadThread
+                    data = self.sock.recv(self._recv_size)
+                else:
+                    data = _recv_into(self.sock, buf)
+            except socket.error, e:
+                if e.args[0] in (EAGAIN, EINTR):
+                    return
+                # client disconnected
+                self._close()
+                return
+            if not data:
+                self._close()
+                return
+            if self._log_all_data:
+                self._log.info('Rx from %s:%s' % (self.client_addr,
+                                repr(memoryview(data).tobytes())))
+            if self._framer is None:
+                self._rx_pending.append(data)
+            else:
+                for pkt_buf in self._framer.feed(data):
+                    if self._fec is None:
+                        self._rx_pending.append(pkt_buf)
+                    else:
+                        self._rx_pending.extend(self._fec.decode(pkt_buf))
+        finally:
+            if buf is not None:
+                self._buf_pool.put(buf)
+        self._deliver()
+        
+    def _deliver(self):
+        """Move read data to the read queue while there is room"""
+        q = self._read_data_q
+        if q is None:
+            return
+        while self._rx_pending:
+            try:
+                q.put_nowait(self._rx_pending[0])
+            except Queue.Full:
+                return
+            self._rx_pending.popleft()
+            
+    def _fill_tx_bufs(self):
+        """Take data from the write queue"""
+        q = self._write_data_q
+        if q is None:
+            return
+        while self._tx_len < ReactorSockHandler.MAX_WRITE_BUF:
+            try:
+                data = q.get(False)
+            except Queue.Empty:
+                return
+            if data:
+                if not self._tx_bufs:
+                    self._tx_time = time.time()
+                self._tx_bufs.append(data)
+                self._tx_len += len(data)
+                
+    def _on_writable(self):
+        while self._tx_bufs:
+            if (len(self._tx_bufs) > 1) and \
+                    (len(self._tx_bufs[0]) - self._tx_offset < self._send_batch):
+                self._join_tx_bufs()
+            data = self._tx_bufs[0]
+            offset = self._tx_offset
+            try:
+                sent = self.sock.send(memoryview(data)[offset:])
+            except socket.error, e:
+                if e.args[0] in (EAGAIN, EINTR):
+                    return
+                # client disconnected
+                self._close()
+                return
+            if self._log_all_data:
+                self._log.info('Tx to %s:  %s' % (self.client_addr,
+                                repr(data[offset:offset + sent])))
+            self._tx_time = time.time()
+            self._tx_len -= sent
+            self._tx_offset += sent
+            if self._tx_offset < len(data):
+                return
+            self._tx_bufs.popleft()
+            self._tx_offset = 0
+            self._fill_tx_bufs()
+            
+    def _join_tx_bufs(self):
+        """Join the unsent data at the head of _tx_bufs into one write"""
+        bufs = [self._tx_bufs.popleft()[self._tx_offset:]]
+        self._tx_offset = 0
+        n_bytes = len(bufs[0])
+        while self._tx_bufs and (n_bytes < self._send_batch):
+            data = self._tx_bufs.popleft()
+            bufs.append(data)
+            n_bytes += len(data)
+        self._tx_bufs.appendleft(_join_bufs(bufs))
             
+    def _tick(self, now):
+        """Do the work that is not driven by socket events"""
+        if self._closed:
+            return
+        if self._fec is not None:
+            self._rx_pending.extend(self._fec.expire())
+        self._deliver()
+        self._fill_tx_bufs()
+        if self._tx_bufs:
+            if now - self._tx_time > self._write_timeout:
+                self._log.error('Timed out writing to %s' % self.client_addr)
+                self._close()
+            elif not (self._mask & _Poller.OUT):
+                # try at once, the reactor polls for OUT if it blocks
+                self._on_writable()
             
+    def _close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._running = False
+        self._reactor.remove(self)
+        utils.close_sock(self.sock)
+        self.sock.close()
+        if self._exit_callback:
+            # Callbacks may stop other handlers and wait for threads,
+            #  so they are not run in the reactor thread
+            threading.Thread(target=self._exit_callback, args=(self,),
+                            name='%s exit callback' % self.name).start()
+
 
+def _echo_server(port):
+    """Echo the data of every connection, runs in a child process"""
+    serve = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serve.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)        
+    serve.bind(('localhost', port))
+    serve.listen(64)
+    socks = [serve]
+    while True:
+        readable = select.select(socks, [], [])[0]
+        for s in readable:
+            if s is serve:
+                socks.append(serve.accept()[0])
+                continue
+            data = s.recv(65536)
+            if not data:
+                socks.remove(s)
+                s.close()
+                if len(socks) == 1:
+                    os._exit(0)
+                continue
+            s.sendall(data)
             
+
+def _measure(log, port, n_conns, n_bytes, reactor):
+    """Proxy n_bytes through each of n_conns echo connections
+    
+    Return (peak thread count, context switches, CPU seconds)
+    """
+    import resource
+    chunk = 'x' * ProxyPkt.MAX_PKT_LEN
+    handlers = [connect_to_server(log, 'localhost', port, reactor=reactor)
+                for i in range(n_conns)]
+    to_send = [n_bytes] * n_conns
+    to_recv = [n_bytes] * n_conns
+    threads = threading.activeCount()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    while sum(to_recv):
+        progress = False
+        for i, h in enumerate(handlers):
+            try:
+                while to_send[i] > 0:
+                    h.get_write_q().put_nowait(chunk[:to_send[i]])
+                    to_send[i] -= len(chunk)
+                    progress = True
+            except Queue.Full:
+                pass
+            try:
+                while True:
+                    to_recv[i] -= len(h.get_read_q().get_nowait())
+                    progress = True
+            except Queue.Empty:
+                pass
+        threads = max(threads, threading.activeCount())
+        if not progress:
+            time.sleep(0.001)
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    for h in handlers:
+        h.stop()
+    csw = (end_usage.ru_nvcsw + end_usage.ru_nivcsw) - \
+            (usage.ru_nvcsw + usage.ru_nivcsw)
+    cpu = (end_usage.ru_utime + end_usage.ru_stime) - \
+            (usage.ru_utime + usage.ru_stime)
+    return threads, csw, cpu
+    
+    
+def _runTest(log, port=47123, n_bytes=2 * 1024 * 1024):
+    """Benchmark SockHandler against ReactorSockHandler
+    
+    Stream data is echoed by a child process, so the CPU time
+    and context switches are those of the handlers and the
+    benchmark loop.
+    """
+    print 'Proxying %d MB each way per connection' % (n_bytes / (1024 * 1024))
+    print 'backend    conns   threads   ctx switches/MB   CPU ms/MB'
+    for n_conns in (1, 4, 16):
+        for reactor in (False, True):
+            pid = os.fork()
+            if pid == 0:
+                _echo_server(port)
+            time.sleep(0.2)
+            threads, csw, cpu = _measure(log, port, n_conns, n_bytes, reactor)
+            os.waitpid(pid, 0)
+            mb = 2.0 * n_conns * n_bytes / (1024 * 1024)
+            print '%-9s  %5d   %7d   %15.0f   %9.1f' % \
+                    (('threads', 'reactor')[reactor], n_conns, threads,
+                    csw / mb, 1000 * cpu / mb)
+            utils.wait(Reactor.IDLE_EXIT + 0.5)
+
+
+def _accept_clients(accept, accepted):
+    """Accept clients until accept() returns None, runs in a thread
+    
+    accept() returns a socket or None.  (peer port, accept time)
+    is appended to accepted for each client.
+    """
+    while True:
+        sock = accept()
+        if sock is None:
+            return
+        accepted.append((utils.get_peer_port(sock), time.time()))
+        utils.close_sock(sock)
+        
+        
+def _connect_clients(port, n_clients):
+    """Connect n_clients one after another
+    
+    Return ({local port: connect start time}, refused count)
+    """
+    starts = {}
+    refused = 0
+    for i in range(n_clients):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(2.0)
+        start = time.time()
+        try:
+            s.connect(('localhost', port))
+            starts[utils.get_sock_port(s)] = start
+        except socket.error:
+            refused += 1
+        s.close()
+    return starts, refused
+    
+    
+def _test_listener(log, port=47124, n_clients=200):
+    """Compare a SockListener accept loop with connect_to_client
+    
+    Clients connect back to back, as in a connection storm.
+    Print the clients refused, the median and worst accept
+    latency and the time stop takes to end the accept loop.
+    """
+    print 'Accepting %d back to back clients' % n_clients
+    print 'server              refused   median ms   max ms   stop ms'
+    for use_listener in (False, True):
+        accepted = []
+        if use_listener:
+            listener = SockListener(log, 'localhost', port)
+            def accept():
+                return listener.accept()[0]
+            def stop():
+                listener.close()
+        else:
+            stop_event = threading.Event()
+            def accept():
+                sock, addr, connected_flag = connect_to_client(log,
+                                    'localhost', port, stop_event)
+                if connected_flag:
+                    return sock
+                return None
+            def stop():
+                stop_event.set()
+        t = threading.Thread(target=_accept_clients, args=(accept, accepted))
+        t.start()
+        time.sleep(0.2)
+        starts, refused = _connect_clients(port, n_clients)
+        time.sleep(0.2)
+        latencies = [accept_time - starts[peer_port]
+                     for peer_port, accept_time in accepted
+                     if peer_port in starts]
+        stop_time = time.time()
+        stop()
+        t.join()
+        stop_time = time.time() - stop_time
+        if latencies:
+            latencies.sort()
+            median_ms = 1000 * latencies[len(latencies) / 2]
+            max_ms = 1000 * latencies[-1]
+        else:
+            median_ms = max_ms = 0
+        print '%-18s  %7d   %9.2f   %6.0f   %7.1f' % \
+                (('connect_to_client', 'SockListener')[use_listener],
+                refused, median_ms, max_ms, 1000 * stop_time)
+        
+        
+def _test_budget(n_queues=70, n_bytes=60000):
+    """Check that closed and dropped queues return their budget bytes
+    
+    Each queue is left holding n_bytes, which together is more
+    than the budget, then a fresh queue must still take two items.
+    """
+    budget = ByteBudget(4 * 1024 * 1024)
+    chunk = 'x' * 1000
+    for close in (True, False):
+        for i in range(n_queues):
+            q = ByteQueue(0, 64 * 1024, budget)
+            for j in range(n_bytes / len(chunk)):
+                q.put_nowait(chunk)
+            if close:
+                q.close()
+            q = None
+        q = ByteQueue(0, 64 * 1024, budget)
+        q.put_nowait(chunk)
+        q.put_nowait(chunk)
+        q.get_nowait()
+        stats = budget.get_stats()
+        print 'ByteBudget after %d %s queues: %d bytes used, peak %d' % \
+                (n_queues, ('dropped', 'closed')[close],
+                stats['used_bytes'], stats['peak_bytes'])
+        assert stats['used_bytes'] == len(chunk)
+        q.close()
+        
+        
+if __name__ == '__main__':
+    print 'Testing sock_utils with the ByteBudget and SockListener tests and SockHandler benchmark'
+    log = logs.open('sock_utils_test',
+                    '/tmp',
+                    logging.INFO,
+                    file_max_bytes = 50000,
+                    num_backup_files = 1)
+    _test_budget()
+    _test_listener(log)
+    _runTest(log)
+    utils.wait_for_child_threads()
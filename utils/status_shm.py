@@ -0,0 +1,326 @@
+# Shared memory status tables
+#
+# There are two exposed classes:
+#     StatusTable
+#     StatusReader
+#
+# StatusTable is the writer.  A manager process (hw_mgr) creates
+# one for its status dict and publishes the dict after each
+# refresh.  StatusReader maps the same file in any other process
+# and returns a consistent snapshot of the values with no IPC
+# round trip.
+#
+# The table is a file, normally under /dev/shm, mmaped by the
+# writer and the readers.  Its layout is fixed when the writer
+# creates it:
+#
+#     header      magic 'STS1', sequence number, number of
+#                 fields, writer's pid, last publish time
+#     directory   one entry per field: name, slot offset
+#     slots       one per field: publish time, type code,
+#                 value length and value
+#
+# A slot holds an int, float, bool, None or a string up to
+# VALUE_SIZE bytes.  A value that does not fit, or has another
+# type, is marked missing, and readers get it from the manager's
+# RPC methods instead.
+#
+# The sequence number is a seqlock.  The writer makes it odd
+# before it changes the slots and even again when it is done.
+# A reader copies the table and uses the copy only if the
+# sequence number was even and unchanged across the copy.
+#
+# The writer creates the table under a temp name and renames it,
+# so readers never see a half written header.  A reader whose
+# writer has exited, or whose file was replaced by a new writer,
+# reopens the file.
+
+import os
+import time
+import mmap
+import struct
+from errno import ESRCH
+
+MAGIC = 'STS1'
+NAME_SIZE = 32              # max field name length
+VALUE_SIZE = 120            # max string value length
+READ_RETRIES = 100          # snapshot copies tried while the writer writes
+CHECK_SECS = 1.0            # secs between reader checks of the writer
+
+_HEADER = struct.Struct('<4sIIId')      # magic, seq, n_fields, pid, publish time
+_SEQ_OFFSET = 4
+_DIR_ENTRY = struct.Struct('<%dsI' % NAME_SIZE)     # name, slot offset
+_SLOT_HEAD = struct.Struct('<dcxH')     # publish time, type code, value length
+_SLOT_SIZE = _SLOT_HEAD.size + VALUE_SIZE
+_INT = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_SEQ = struct.Struct('<I')
+
+# type codes
+_MISSING = 'x'
+_NONE = 'n'
+_BOOL = 'b'
+_INT_CODE = 'i'
+_FLOAT_CODE = 'f'
+_STR = 's'
+
+
+def _encode(value):
+    """Return (type code, value bytes) of a slot value"""
+    if value is None:
+        return _NONE, ''
+    if isinstance(value, bool):
+        return _BOOL, value and '\x01' or '\x00'
+    if isinstance(value, (int, long)):
+        if -2**63 <= value < 2**63:
+            return _INT_CODE, _INT.pack(value)
+        return _MISSING, ''
+    if isinstance(value, float):
+        return _FLOAT_CODE, _FLOAT.pack(value)
+    if isinstance(value, str) and len(value) <= VALUE_SIZE:
+        return _STR, value
+    return _MISSING, ''
+
+
+def _decode(code, data):
+    """Return the value of a slot, raise KeyError if missing"""
+    if code == _INT_CODE:
+        return _INT.unpack(data)[0]
+    if code == _FLOAT_CODE:
+        return _FLOAT.unpack(data)[0]
+    if code == _STR:
+        return data
+    if code == _BOOL:
+        return data == '\x01'
+    if code == _NONE:
+        return None
+    raise KeyError
+
+
+def _pid_is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != ESRCH
+    return True
+
+
+class StatusTable:
+    """
+        Writer of a shared memory status table
+
+        path = the table file, replaced if it exists
+        names = the field names, fixed for the life of the table
+    """
+    def __init__(self, path, names):
+        self._path = path
+        self._names = list(names)
+        self._offsets = {}
+        for name in self._names:
+            if len(name) > NAME_SIZE:
+                raise ValueError, 'status name too long: %s' % name
+        slots_offset = _HEADER.size + _DIR_ENTRY.size * len(self._names)
+        size = slots_offset + _SLOT_SIZE * len(self._names)
+        buf = bytearray(size)
+        _HEADER.pack_into(buf, 0, MAGIC, 0, len(self._names), os.getpid(), 0.0)
+        for i, name in enumerate(self._names):
+            offset = slots_offset + _SLOT_SIZE * i
+            self._offsets[name] = offset
+            _DIR_ENTRY.pack_into(buf, _HEADER.size + _DIR_ENTRY.size * i, name, offset)
+            _SLOT_HEAD.pack_into(buf, offset, 0.0, _MISSING, 0)
+        temp_path = '%s.%d' % (path, os.getpid())
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.write(fd, str(buf))
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        os.rename(temp_path, path)
+        self._seq = 0
+        self.publishes = 0
+
+    def get_names(self):
+        return list(self._names)
+
+    def publish(self, values, timestamp=None):
+        """Write the values of a status dict to the table
+
+        values = dict of name: value, names not in the
+                 table are ignored
+        timestamp = publish time, None for now
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        mm = self._mm
+        self._seq += 1
+        _SEQ.pack_into(mm, _SEQ_OFFSET, self._seq)
+        try:
+            for name, value in values.iteritems():
+                offset = self._offsets.get(name)
+                if offset is None:
+                    continue
+                code, data = _encode(value)
+                _SLOT_HEAD.pack_into(mm, offset, timestamp, code, len(data))
+                start = offset + _SLOT_HEAD.size
+                mm[start:start + len(data)] = data
+            _FLOAT.pack_into(mm, _HEADER.size - _FLOAT.size, timestamp)
+        finally:
+            self._seq += 1
+            _SEQ.pack_into(mm, _SEQ_OFFSET, self._seq)
+        self.publishes += 1
+
+    def close(self, remove=True):
+        """Unmap the table, and remove its file if remove"""
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            if remove:
+                try:
+                    os.remove(self._path)
+                except OSError:
+                    pass
+
+
+class StatusReader:
+    """
+        Reader of a shared memory status table
+
+        Not thread safe, threads share a reader under a lock.
+        Raise IOError if the table does not exist or is
+        not valid.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._mm = None
+        self._open()
+
+    def _open(self):
+        fd = os.open(self._path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            if st.st_size < _HEADER.size:
+                raise IOError, 'status table %s is too short' % self._path
+            mm = mmap.mmap(fd, st.st_size, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        magic, seq, n_fields, pid, publish_time = _HEADER.unpack_from(mm, 0)
+        size = _HEADER.size + (_DIR_ENTRY.size + _SLOT_SIZE) * n_fields
+        if (magic != MAGIC) or (size != st.st_size):
+            mm.close()
+            raise IOError, 'status table %s is not valid' % self._path
+        self._fields = []
+        for i in range(n_fields):
+            name, offset = _DIR_ENTRY.unpack_from(mm, _HEADER.size + _DIR_ENTRY.size * i)
+            self._fields.append((name.rstrip('\x00'), offset))
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = mm
+        self._size = size
+        self._ino = st.st_ino
+        self._pid = pid
+        self._check_time = time.time()
+
+    def _check_writer(self):
+        """Reopen the table if its writer has been replaced
+
+        Return False if there is no live writer.
+        """
+        now = time.time()
+        if now - self._check_time < CHECK_SECS:
+            return True
+        self._check_time = now
+        try:
+            if os.stat(self._path).st_ino != self._ino:
+                self._open()
+        except (OSError, IOError):
+            return False
+        return _pid_is_running(self._pid)
+
+    def _copy(self):
+        """Return a consistent copy of the table, None if the
+            writer kept changing it
+        """
+        mm = self._mm
+        for i in range(READ_RETRIES):
+            seq = _SEQ.unpack_from(mm, _SEQ_OFFSET)[0]
+            if not (seq & 1):
+                data = mm[:self._size]
+                if _SEQ.unpack_from(mm, _SEQ_OFFSET)[0] == seq:
+                    return data
+            time.sleep(0)
+        return None
+
+    def get_snapshot(self):
+        """Return (values, times) dicts of name: value and
+            name: publish time, None if the table is not available
+
+        Missing values are left out.
+        """
+        if (self._mm is None) or not self._check_writer():
+            return None
+        data = self._copy()
+        if data is None:
+            return None
+        values = {}
+        times = {}
+        for name, offset in self._fields:
+            stamp, code, length = _SLOT_HEAD.unpack_from(data, offset)
+            start = offset + _SLOT_HEAD.size
+            try:
+                values[name] = _decode(code, data[start:start + length])
+            except KeyError:
+                continue
+            times[name] = stamp
+        return values, times
+
+    def get_values(self, names):
+        """Return the list of values of names, None if the table is
+            not available or a value is missing
+        """
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return None
+        values = snapshot[0]
+        try:
+            return [values[name] for name in names]
+        except KeyError:
+            return None
+
+    def get_publish_time(self):
+        """Return the time of the writer's last publish"""
+        return _FLOAT.unpack_from(self._mm, _HEADER.size - _FLOAT.size)[0]
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+def _benchmark(n_reads=20000):
+    """Time snapshots of a 40 value table"""
+    path = '/tmp/status_shm_test_%d' % os.getpid()
+    status = dict([('int_%d' % i, i) for i in range(15)] +
+                  [('float_%d' % i, i * 0.5) for i in range(20)] +
+                  [('str_%d' % i, 'value %d' % i) for i in range(5)])
+    table = StatusTable(path, status.keys())
+    try:
+        table.publish(status)
+        reader = StatusReader(path)
+        assert reader.get_snapshot()[0] == status
+        start_time = time.time()
+        for i in range(n_reads):
+            reader.get_snapshot()
+        secs = time.time() - start_time
+        print '%d values, %.1f us/snapshot' % (len(status), secs * 1e6 / n_reads)
+        start_time = time.time()
+        for i in range(n_reads):
+            table.publish(status)
+        secs = time.time() - start_time
+        print '%d values, %.1f us/publish' % (len(status), secs * 1e6 / n_reads)
+        reader.close()
+    finally:
+        table.close()
+
+
+if __name__ == '__main__':
+    _benchmark()
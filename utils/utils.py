@@ -7,8 +7,10 @@ import threading
 import socket
 import Queue
 import xmlrpclib
+import httplib
 import subprocess
 import socket
+import select
 import fcntl
 import struct
 import sys
@@ -16,11 +18,15 @@ import os
 import os.path
 import shutil
 from datetime import datetime,timedelta
-from errno import EINTR
+from errno import EINTR, ECONNRESET, ECONNABORTED, EPIPE
 import commands
+import logging
+import urlparse
 
 import hw_mgr_config
 import usb_mgr_config
+import global_config
+import status_shm
 
 
 def wait(wait_secs):
@@ -79,13 +85,19 @@ def get_ip_address(ifname):
     )[20:24])
     
     
+def _addr_str(name):
+    """Format a socket name, a Unix socket name is a path"""
+    if isinstance(name, str):
+        return name
+    addr, port = name
+    return ''.join((addr, ':', str(port)))
+
 def get_peer_addr_str(sock):
     """Get sock's peer address in xxx.xxx.xxx.xxx:pppp format"""
     addr_port = '0.0.0.0:0000'
     # Use try block in case socket is closed
     try:
-        addr, port = sock.getpeername()
-        addr_port = (''.join((addr, ':', str(port))))
+        addr_port = _addr_str(sock.getpeername())
     except socket.error:
         pass    
     return addr_port    
@@ -95,28 +107,31 @@ def get_sock_addr_str(sock):
     addr_port = '0.0.0.0:0000'
     # Use try block in case socket is closed
     try:
-        addr, port = sock.getsockname()
-        addr_port = (''.join((addr, ':', str(port))))
+        addr_port = _addr_str(sock.getsockname())
     except socket.error:
         pass    
     return addr_port
 
 def get_peer_port(sock):
-    """Get sock's peer port number"""
+    """Get sock's peer port number, 0 for a Unix socket"""
     port = 0
     # Use try block in case socket is closed
     try:
-        addr, port = sock.getpeername()
+        name = sock.getpeername()
+        if not isinstance(name, str):
+            addr, port = name
     except socket.error:
         pass    
     return port
 
 def get_sock_port(sock):
-    """Get sock's port number"""
+    """Get sock's port number, 0 for a Unix socket"""
     port = 0
     # Use try block in case socket is closed
     try:
-        addr, port = sock.getsockname()
+        name = sock.getsockname()
+        if not isinstance(name, str):
+            addr, port = name
     except socket.error:
         pass    
     return port
@@ -142,11 +157,40 @@ def q_flush(q):
         q.get()
         
         
-def q_get(q, get_timeout=10):
+def q_get(q, get_timeout=10, wakeup=None):
     """ Read from a queue with timeout.
-    timeout is integer or floating point seconds.
+    timeout is integer or floating point seconds,
+     None to wait until data arrives.
+    wakeup = None or a Wakeup.  If the Wakeup is set or
+     poked, return None at once.  Waiting on a Wakeup needs a
+     queue with the not_empty condition and _qsize() of
+     Queue.Queue, others are read with the timeout only.
     Return None if timeout.
     """
+    if (wakeup is not None) and (get_timeout != 0) and hasattr(q, 'not_empty'):
+        cond = q.not_empty
+        wakeup.watch(cond)
+        try:
+            end_time = None
+            if get_timeout is not None:
+                end_time = time.time() + get_timeout
+            cond.acquire()
+            try:
+                while not q._qsize():
+                    if wakeup.is_poked():
+                        return None
+                    if end_time is None:
+                        cond.wait()
+                        continue
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return None
+                    cond.wait(remaining)
+            finally:
+                cond.release()
+        finally:
+            wakeup.unwatch(cond)
+        get_timeout = 0
     block = True
     if get_timeout == 0:
         block = False
@@ -155,6 +199,220 @@ def q_get(q, get_timeout=10):
     except Queue.Empty:
         return None      
     
+    
+def q_put(q, item, put_timeout=None, wakeup=None):
+    """ Write to a queue, waiting while it is full.
+    put_timeout = seconds to wait, None to wait for room.
+    wakeup = None or a Wakeup.  If the Wakeup is set or
+     poked, return at once.  Waiting on a Wakeup needs a
+     queue with the not_full condition and maxsize of
+     Queue.Queue, or an _is_full() method.
+    Return True if the item was queued.
+    """
+    if (wakeup is None) or not hasattr(q, 'not_full'):
+        try:
+            q.put(item, True, put_timeout)
+            return True
+        except Queue.Full:
+            return False
+    cond = q.not_full
+    wakeup.watch(cond)
+    try:
+        end_time = None
+        if put_timeout is not None:
+            end_time = time.time() + put_timeout
+        while True:
+            cond.acquire()
+            try:
+                while _q_is_full(q):
+                    if wakeup.is_poked():
+                        return False
+                    if end_time is None:
+                        cond.wait()
+                        continue
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return False
+                    cond.wait(remaining)
+            finally:
+                cond.release()
+            try:
+                q.put(item, False)
+                return True
+            except Queue.Full:
+                # another producer took the room
+                continue
+    finally:
+        wakeup.unwatch(cond)
+        
+        
+def _q_is_full(q):
+    """Return True if q is full, q's mutex held"""
+    if hasattr(q, '_is_full'):
+        return q._is_full()
+    return 0 < q.maxsize <= q._qsize()
+    
+    
+class Wakeup:
+    """A thread's stop flag that wakes the thread at once
+    
+    Used like threading.Event in a thread's run() loop.
+    set() and poke() wake the thread if it waits in wait(),
+    q_get(..., wakeup=) or wait_readable().  poke() wakes it
+    without setting the flag, e.g. to look at a new queue.  A
+    poke is pending until the thread calls clear_poke().
+    wait_readable() and wait_set() select on a self-pipe, opened on first
+    use.  Only one thread should wait on a Wakeup.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._flag = False
+        self._poked = False
+        self._q_conds = []      # conditions of queues being waited on
+        self._pipe = None
+        
+    def isSet(self):
+        return self._flag
+        
+    def set(self):
+        """Set the flag and wake the thread"""
+        self._wake(True)
+        
+    def poke(self):
+        """Wake the thread without setting the flag"""
+        self._wake(False)
+        
+    def _wake(self, flag):
+        self._cond.acquire()
+        try:
+            if flag:
+                self._flag = True
+            self._poked = True
+            self._cond.notifyAll()
+            q_conds = list(self._q_conds)
+            if self._pipe is not None:
+                try:
+                    os.write(self._pipe[1], 'x')
+                except OSError:
+                    # pipe full, the thread is already awake
+                    pass
+        finally:
+            self._cond.release()
+        for cond in q_conds:
+            cond.acquire()
+            cond.notifyAll()
+            cond.release()
+            
+    def is_poked(self):
+        """Return True if set, or poked since clear_poke()"""
+        return self._poked
+        
+    def clear_poke(self):
+        """Acknowledge the pokes so far"""
+        self._cond.acquire()
+        try:
+            self._poked = self._flag
+            if (self._pipe is not None) and not self._flag:
+                try:
+                    while os.read(self._pipe[0], 4096):
+                        pass
+                except OSError:
+                    pass
+        finally:
+            self._cond.release()
+            
+    def wait(self, timeout=None):
+        """Wait until set or poked, return the flag"""
+        self._cond.acquire()
+        try:
+            if not self._poked:
+                self._cond.wait(timeout)
+            return self._flag
+        finally:
+            self._cond.release()
+            
+    def _open_pipe(self):
+        """Return the read end of the self-pipe, opening it if needed"""
+        self._cond.acquire()
+        try:
+            if self._pipe is None:
+                self._pipe = os.pipe()
+                for fd in self._pipe:
+                    fcntl.fcntl(fd, fcntl.F_SETFL,
+                                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                if self._poked:
+                    os.write(self._pipe[1], 'x')
+            return self._pipe[0]
+        finally:
+            self._cond.release()
+            
+    def wait_set(self, timeout=None):
+        """Wait until set or poked, return the flag
+        
+        Unlike wait(), the wait is a select() on the self-pipe,
+        so a timeout does not make it poll.
+        """
+        pipe_r = self._open_pipe()
+        try:
+            select.select([pipe_r], [], [], timeout)
+        except select.error:
+            pass
+        return self._flag
+        
+    def wait_readable(self, sock, timeout=None):
+        """Wait until sock is readable, the Wakeup is set or
+            poked, or timeout seconds
+        
+        Return True if sock is readable.
+        """
+        pipe_r = self._open_pipe()
+        try:
+            readable = select.select([sock, pipe_r], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == EINTR:
+                return False
+            # closed socket, let the caller's read fail
+            return True
+        except (socket.error, ValueError):
+            return True
+        return sock in readable
+        
+    def wait_readable_any(self, socks, timeout=None):
+        """Like wait_readable() for a list of sockets
+        
+        Return the list of readable sockets.
+        """
+        pipe_r = self._open_pipe()
+        try:
+            readable = select.select(socks + [pipe_r], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == EINTR:
+                return []
+            raise
+        return [sock for sock in readable if sock is not pipe_r]
+        
+    def watch(self, cond):
+        """Notify cond when woken, used by q_get()"""
+        self._cond.acquire()
+        self._q_conds.append(cond)
+        self._cond.release()
+        
+    def unwatch(self, cond):
+        self._cond.acquire()
+        self._q_conds.remove(cond)
+        self._cond.release()
+        
+    def close(self):
+        """Close the self-pipe, the thread no longer waits on it"""
+        self._cond.acquire()
+        try:
+            if self._pipe is not None:
+                os.close(self._pipe[0])
+                os.close(self._pipe[1])
+                self._pipe = None
+        finally:
+            self._cond.release()
+    
         
 def wait_for_child_threads():
     """Wait for all child threads to exit
@@ -208,7 +466,12 @@ def str_sum(data):
     for x in data:
         sum += ord(x)
     return sum
-                   
+
+
+def dict_str(d):
+    """Return a dict as 'name value' pairs sorted by name, for logs"""
+    return ', '.join(['%s %s' % (name, d[name]) for name in sorted(d.keys())])
+
         
 def bytes_to_hex(byteStr):
     """
@@ -227,34 +490,118 @@ def bytes_to_hex(byteStr):
     
  
    
-class ThreadSkeleton(threading.Thread):
+class BaseThread(threading.Thread):
+    """
+        A thread with event-based start and stop handshakes.
+        The subclass __init__ calls BaseThread.__init__() first
+        and self._start_and_wait() last.  run() calls
+        self._set_started() when the thread is ready, which
+        releases the constructor at once.  stop() sets
+        self._stop_event and waits up to STOP_TIMEOUT seconds
+        for run() to return.
+        The handshakes wait on Wakeup self-pipes, since a timed
+        threading.Event.wait() polls.
+        start_secs is the time from start to _set_started().
+    """
+    STOP_TIMEOUT = 10.0
+    
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(False)
+        self._stop_event = threading.Event()
+        self._ready = Wakeup()
+        self._start_time = None
+        self.start_secs = None
+        self._running = False
+        self._started = False
+        # run() is wrapped to wake _join() when it returns
+        self._exited = Wakeup()
+        self._thread_run = self.run
+        self.run = self._run_and_signal
+        
+    def _run_and_signal(self):
+        try:
+            self._thread_run()
+        finally:
+            self._exited.set()
+            
+    def _start_and_wait(self):
+        """Start the thread, return when it is ready or has died"""
+        self._start_time = time.time()
+        self.start()
+        while not self._ready.wait_set(1.0):
+            if not self.isAlive():
+                break
+        self._ready.close()
+                
+    def _set_started(self):
+        """Called by run() when the thread is ready"""
+        self._running = True
+        self._started = True
+        if self._start_time is not None:
+            self.start_secs = time.time() - self._start_time
+        self._ready.set()
+        
+    def _join(self, timeout=None):
+        """Wait up to timeout seconds for run() to return
+        
+        timeout = None for STOP_TIMEOUT
+        Return False if the thread is still running.
+        """
+        if timeout is None:
+            timeout = self.STOP_TIMEOUT
+        if threading.currentThread() is self:
+            return False
+        try:
+            if not self._exited.wait_set(timeout):
+                log = getattr(self, '_log', None)
+                if log is not None:
+                    log.error('%s did not stop within %.1f seconds' % \
+                                (self.name, timeout))
+                return False
+            # run() has returned, the thread is ending
+            self.join()
+            return True
+        finally:
+            # The pipe is reopened if _join() is called again, and
+            #  set() still works without it
+            self._exited.close()
+        
+    def get_start_secs(self):
+        """Return the seconds the thread took to start, None if not started"""
+        return self.start_secs
+        
+    def is_running(self):
+        return self._running
+        
+    def stop(self):
+        """Stop this thread and wait for it to end"""
+        if self._running:
+            self._stop_event.set()
+            self._join()
+    
+    
+class ThreadSkeleton(BaseThread):
     """
         
     """ 
     def __init__(self, log, exit_callback=None):
         """
         """
-        threading.Thread.__init__(self)
-        self.setDaemon(False)
+        BaseThread.__init__(self)
         self._log = log
         self._exit_callback = exit_callback
         self._children = []
-        self._stop_event = threading.Event()
         self.name = 'ThreadSkeleton'
-        self._running = False
-        self._started = False
-        self.start()
-        while not self._started:
-            utils.wait(0.05)
+        self._start_and_wait()
                                         
     def run(self):
         """The actual thread code"""
         self._log.debug('Starting %s ' % self.name)
-        self._running = True
-        self._started = True
+        self._set_started()
         
         while not self._stop_event.isSet():
-            utils.wait(0.5)
+            self._stop_event.wait(0.5)
             
         self._running = False
         #self._log.debug('Stopping %s ' % self.name)
@@ -268,14 +615,11 @@ class ThreadSkeleton(threading.Thread):
         """Child threads call this when they die"""
         pass
         
-    def is_running(self):
-        return self._running
-        
     def stop(self):
         """Stop this thread and its child threads"""
         if self._running:
             self._stop_event.set()
-            self.join()
+            self._join()
     
     
 def process_is_running(exe_file_name, log=None):
@@ -724,11 +1068,53 @@ def set_power_state(device, state, server_proxy, hw_mgr_lock, log=None):
     return None
     
 
+_hw_status_reader = None
+_hw_status_open_time = 0
+_hw_status_lock = threading.Lock()
+
+def read_hw_status(value_names=None):
+    """Read hw_mgr status values from its shared memory table
+    value_names = list of names, None for the whole dict
+    Return the list of values, or the status dict.
+    Return None if the table or a value is not available,
+     the XMLRPC methods are used then.
+    """
+    global _hw_status_reader
+    global _hw_status_open_time
+    if not hw_mgr_config.status_shm_enable:
+        return None
+    _hw_status_lock.acquire()
+    try:
+        reader = _hw_status_reader
+        if reader is None:
+            # a missing table is looked for again after a while
+            now = time.time()
+            if now - _hw_status_open_time < status_shm.CHECK_SECS:
+                return None
+            _hw_status_open_time = now
+            try:
+                reader = status_shm.StatusReader(hw_mgr_config.status_shm_file)
+            except (OSError, IOError):
+                return None
+            _hw_status_reader = reader
+        if value_names is None:
+            snapshot = reader.get_snapshot()
+            if snapshot is None:
+                return None
+            return snapshot[0]
+        return reader.get_values(value_names)
+    finally:
+        _hw_status_lock.release()
+    
+
 def get_hw_status(value_name, server_proxy, hw_mgr_lock, log=None):
     """Get a status value from hw_mgr
     Return [status_value, hw_mgr_server]
     Return [None, None] if unsucessful.
     """
+    values = read_hw_status([value_name])
+    if values is not None:
+        return [values[0], server_proxy]
     hw_mgr_lock.acquire()
     attempt = 1
     while (attempt <= 2):
@@ -766,6 +1152,9 @@ def get_full_hw_status(server_proxy, hw_mgr_lock, log):
     Return [status_dict, hw_mgr_server]
     Return [None, None] if unsucessful.
     """
+    status_dict = read_hw_status()
+    if status_dict is not None:
+        return [status_dict, server_proxy]
     hw_mgr_lock.acquire()
     attempt = 1
     while (attempt <= 2):
@@ -796,28 +1185,401 @@ def get_full_hw_status(server_proxy, hw_mgr_lock, log):
     return [None, None]
 
 
-def get_XMLRPC_server_proxy(server_URL, log=None):
-    """Create an XMLRPC server proxy for a remote server.
+def get_hw_status_list(value_names, server_proxy, hw_mgr_lock, log=None):
+    """Get several status values from hw_mgr in one request
+    Return [status_values, hw_mgr_server]
+    Return [None, None] if unsucessful.
+    """
+    status_values = read_hw_status(value_names)
+    if status_values is not None:
+        return [status_values, server_proxy]
+    hw_mgr_lock.acquire()
+    attempt = 1
+    while (attempt <= 2):
+        if server_proxy is None:
+            server_proxy = get_XMLRPC_server_proxy(hw_mgr_config.XMLRPC_URL, log)
+            if server_proxy is None:
+                hw_mgr_lock.release()
+                return [None, None]
+        try:
+            status_values = XMLRPC_multicall(server_proxy,
+                                [('get_status', name) for name in value_names])
+        except Exception, e:
+            if log:
+                log.error('utils.get_hw_status_list: exception:  %s' % e)
+            server_proxy = None
+            attempt += 1
+            continue    # retry in case bad hw_mgr_server was passed in
+        hw_mgr_lock.release()
+        return [status_values, server_proxy]
+    hw_mgr_lock.release()
+    return [None, None]
+
+
+def wait_for_hw_status(value_name, op, value, timeout=None, stop_event=None, log=None):
+    """Wait until a hw_mgr status value meets a condition
+    The condition is status value op value, op is one
+     of < <= > >= == !=.  hw_mgr tests it after each refresh.
+    timeout = secs, None to wait until stop_event is set
+    Return the status value when the condition is met.
+    Return None at timeout, when stop_event is set, or
+     if hw_mgr rejects the arguments.
+    """
+    if timeout is not None:
+        end_time = time.time() + timeout
+    while (stop_event is None) or not stop_event.isSet():
+        wait_secs = hw_mgr_config.wait_for_max_secs
+        if timeout is not None:
+            wait_secs = min(wait_secs, end_time - time.time())
+            if wait_secs <= 0:
+                return None
+        server_proxy = get_XMLRPC_server_proxy(hw_mgr_config.XMLRPC_URL, log)
+        try:
+            if server_proxy is None:
+                raise ValueError, 'no server proxy'
+            result = server_proxy.wait_for(value_name, [op, value], wait_secs)
+        except Exception, e:
+            if log:
+                log.error('utils.wait_for_hw_status: exception:  %s' % e)
+            # hw_mgr not running, try again later
+            wait(min(wait_secs, 1.0))
+            continue
+        if result == 'failed':
+            if log:
+                log.error('utils.wait_for_hw_status: hw_mgr rejected %s %s %s' % \
+                            (value_name, op, repr(value)))
+            return None
+        [met, status_value] = result
+        if met:
+            return status_value
+    return None
+    
+    
+class HwStatusSubscriber:
+    """
+        Keep a copy of hw_mgr status values, updated by hw_mgr
+        after each refresh that changes them
+        
+        An XMLRPC server on callback_port takes the changes.
+        callback(changes) is called with each dict of changed
+        values.  The subscription is renewed every
+        RESUBSCRIBE_SECS by get_value(), in case hw_mgr was
+        restarted.  url = None for hw_mgr's XMLRPC server.
+    """
+    RESUBSCRIBE_SECS = 60
+    
+    def __init__(self, value_names, callback_port, log, callback=None,
+                    url=None):
+        # BasicXMLRPCThread imports utils
+        from BasicXMLRPCThread import BasicXMLRPCThread
+        self._value_names = list(value_names)
+        self._callback_port = callback_port
+        self._log = log
+        self._callback = callback
+        self._url = url or hw_mgr_config.XMLRPC_URL
+        self._lock = threading.Lock()
+        self._values = {}
+        self._pushed = set()        # names pushed since the last subscribe
+        self._subscribe_time = 0
+        self._server = BasicXMLRPCThread('localhost', callback_port, log, workers=1)
+        self._server._server.register_function(self._status_changed, 'status_changed')
+        self._subscribe()
+        
+    def _status_changed(self, changes):
+        self._lock.acquire()
+        self._values.update(changes)
+        self._pushed.update(changes)
+        self._lock.release()
+        if self._callback is not None:
+            self._callback(changes)
+        return 'OK'
+        
+    def _subscribe(self):
+        """Subscribe, return True if successful"""
+        self._subscribe_time = time.time()
+        self._lock.acquire()
+        self._pushed = set()
+        self._lock.release()
+        server_proxy = get_XMLRPC_server_proxy(self._url, self._log)
+        try:
+            if server_proxy is None:
+                raise ValueError, 'no server proxy'
+            values = server_proxy.subscribe(self._value_names, self._callback_port)
+        except Exception, e:
+            self._log.error('HwStatusSubscriber: subscribe failed:  %s' % e)
+            return False
+        if values == 'failed':
+            self._log.error('HwStatusSubscriber: hw_mgr rejected %s' % self._value_names)
+            return False
+        # a push that overtook the reply has newer values
+        self._lock.acquire()
+        for name, value in values.items():
+            if name not in self._pushed:
+                self._values[name] = value
+        self._lock.release()
+        return True
+        
+    def get_value(self, value_name):
+        """Return a status value, None if not known"""
+        if time.time() - self._subscribe_time > HwStatusSubscriber.RESUBSCRIBE_SECS:
+            self._subscribe()
+        return self._values.get(value_name)
+        
+    def close(self):
+        server_proxy = get_XMLRPC_server_proxy(self._url, self._log)
+        try:
+            server_proxy.unsubscribe(self._callback_port)
+        except Exception:
+            pass
+        self._server.stop()
+        
+
+class KeepAliveTransport(xmlrpclib.Transport):
+    """XMLRPC transport that keeps HTTP/1.1 connections open
+    
+    Thread safe.  Each request takes an idle connection to
+    the server, or opens a new one, and puts it back when the
+    response has been read.  The socket timeout is set on each
+    connection, the process default timeout is not used.
+    """
+    MAX_IDLE = 4            # idle connections kept per transport
+    
+    def __init__(self, timeout=10):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+        self._idle_lock = threading.Lock()
+        self._idle = []     # [(host, HTTPConnection), ...]
+        self.connects = 0
+        self.requests = 0
+        
+    def request(self, host, handler, request_body, verbose=0):
+        conn, reused = self._get_conn(host)
+        try:
+            return self._request(conn, host, handler, request_body, verbose)
+        except (socket.error, httplib.BadStatusLine), e:
+            conn.close()
+            # The server may have closed an idle connection before
+            #  reading the request.  Retry once on a new connection.
+            if not reused or (isinstance(e, socket.error) and \
+                    (e.args[0] not in (ECONNRESET, ECONNABORTED, EPIPE))):
+                raise
+            conn, reused = self._new_conn(host), False
+            return self._request(conn, host, handler, request_body, verbose)
+            
+    def _request(self, conn, host, handler, request_body, verbose):
+        """Send a request on conn, return the parsed response"""
+        try:
+            if verbose:
+                conn.set_debuglevel(1)
+            self.send_request(conn, handler, request_body)
+            self.send_host(conn, host)
+            self.send_user_agent(conn)
+            self.send_content(conn, request_body)
+            response = conn.getresponse(buffering=True)
+            self.requests += 1
+            if response.status != 200:
+                response.read()
+                raise xmlrpclib.ProtocolError(host + handler, response.status,
+                                                response.reason, response.msg)
+            self.verbose = verbose
+            result = self.parse_response(response)
+        except xmlrpclib.Fault:
+            self._put_conn(host, conn)
+            raise
+        except:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_conn(host, conn)
+        return result
+        
+    def _get_conn(self, host):
+        """Return [connection, reused]"""
+        self._idle_lock.acquire()
+        try:
+            for i, (idle_host, conn) in enumerate(self._idle):
+                if idle_host == host:
+                    del self._idle[i]
+                    return [conn, True]
+        finally:
+            self._idle_lock.release()
+        return [self._new_conn(host), False]
+        
+    def _new_conn(self, host):
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        self.connects += 1
+        return httplib.HTTPConnection(chost, timeout=self.timeout)
+        
+    def _put_conn(self, host, conn):
+        self._idle_lock.acquire()
+        try:
+            if len(self._idle) < KeepAliveTransport.MAX_IDLE:
+                self._idle.append((host, conn))
+                return
+        finally:
+            self._idle_lock.release()
+        conn.close()
+        
+    def close(self):
+        self._idle_lock.acquire()
+        try:
+            for host, conn in self._idle:
+                conn.close()
+            self._idle = []
+        finally:
+            self._idle_lock.release()
+            
+            
+def get_null_log():
+    """Return a log object that discards its messages"""
+    log = logging.getLogger('null')
+    if not log.handlers:
+        log.addHandler(logging.NullHandler())
+        log.propagate = False
+    return log
+
+
+def get_local_rpc_path(port):
+    """Return the Unix socket path of the local XMLRPC server on port"""
+    return os.path.join(global_config.local_rpc_dir, 'xmlrpc_%d.sock' % port)
+
+
+class _LocalRPCMethod:
+    def __init__(self, rpc, name):
+        self._rpc = rpc
+        self._name = name
+        
+    def __getattr__(self, name):
+        return _LocalRPCMethod(self._rpc, '.'.join((self._name, name)))
+        
+    def __call__(self, *args):
+        import sock_rpc     # sock_rpc imports utils
+        try:
+            req_id = self._rpc.start_call(self._name, *args)
+        except sock_rpc.RPCError, e:
+            raise socket.error(e.value)
+        try:
+            return self._rpc.get_result(req_id, raise_timeout=True)
+        except sock_rpc.RPCTimeout:
+            raise socket.timeout('timed out')
+        except sock_rpc.RPCError, e:
+            raise xmlrpclib.Fault(1, e.value)
+        
+
+class LocalRPCProxy:
+    """Call the functions of a local XMLRPC server
+    
+    Used like an xmlrpclib.ServerProxy.  The calls go over the
+    server's Unix domain socket in the marshal based sock_rpc
+    protocol, with no XML, HTTP or TCP.  Errors are raised as
+    xmlrpclib.Fault, or socket.timeout, like an XMLRPC call.
+    """
+    def __init__(self, path, log=None, timeout=10):
+        """Raise sock_rpc.RPCError if the server cannot be reached"""
+        import sock_rpc     # sock_rpc imports utils
+        self._rpc = sock_rpc.RPCServerProxy(None, None, log or get_null_log(),
+                                            timeout, path=path)
+        
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _LocalRPCMethod(self._rpc, name)
+        
+    def __call__(self, attr):
+        """A workaround to get special attributes, like ServerProxy"""
+        if attr == 'close':
+            return self._rpc.close
+        raise AttributeError('Attribute %r not found' % (attr,))
+        
+    def _call_many(self, calls):
+        import sock_rpc     # sock_rpc imports utils
+        resps = self._rpc.call_many(calls)
+        if resps is None:
+            raise socket.timeout('timed out')
+        for resp in resps:
+            if isinstance(resp, sock_rpc.RPCError):
+                raise xmlrpclib.Fault(1, resp.value)
+        return resps
+        
+
+_XMLRPC_proxies = {}        # (server_URL, timeout) -> ServerProxy
+_XMLRPC_proxies_lock = threading.Lock()
+
+
+def get_XMLRPC_server_proxy(server_URL, log=None, timeout=10):
+    """Get the shared XMLRPC server proxy for a remote server.
+        The proxy keeps its connections open between calls
+        and can be used by several threads at once.
+        A server on localhost is called through its local RPC
+        socket, if it has one (see global_config.local_rpc_enable).
+        timeout = socket timeout secs for the proxy's calls
         Return the server proxy or None.
     """
-    socket.setdefaulttimeout(10)
+    key = (server_URL, timeout)
+    _XMLRPC_proxies_lock.acquire()
     try:
-        server_proxy = xmlrpclib.ServerProxy(server_URL)
-    except xmlrpclib.ProtocolError, err:
-        if log:
-            log.error("utils._get_XMLRPC_server_proxy: XMLRPC protocol exception:")
-            log.error("URL: %s" % err.url)
-            log.error("HTTP/HTTPS headers: %s" % err.headers)
-            log.error("Error code: %d" % err.errcode)
-            log.error("Error message: %s" % err.errmsg)
-        return None
+        server_proxy = _XMLRPC_proxies.get(key)
+        if server_proxy is None:
+            server_proxy = _get_local_rpc_proxy(server_URL, log, timeout)
+        if server_proxy is None:
+            server_proxy = xmlrpclib.ServerProxy(server_URL,
+                                transport=KeepAliveTransport(timeout))
+        _XMLRPC_proxies[key] = server_proxy
     except Exception, e:
         if log:
             log.error('utils._get_XMLRPC_server_proxy: exception:  %s' % e)
         return None
+    finally:
+        _XMLRPC_proxies_lock.release()
     return server_proxy
 
 
+def _get_local_rpc_proxy(server_URL, log, timeout):
+    """Return a LocalRPCProxy for a localhost server URL, or None"""
+    if not global_config.local_rpc_enable:
+        return None
+    url = urlparse.urlparse(server_URL)
+    if (url.hostname not in ('localhost', '127.0.0.1')) or (url.port is None):
+        return None
+    path = get_local_rpc_path(url.port)
+    if not os.path.exists(path):
+        return None
+    import sock_rpc     # sock_rpc imports utils
+    try:
+        return LocalRPCProxy(path, log, timeout)
+    except sock_rpc.RPCError, e:
+        if log:
+            log.error('utils._get_local_rpc_proxy: %s, using XMLRPC' % e)
+        return None
+
+
+def close_XMLRPC_server_proxies():
+    """Close the connections of the shared XMLRPC server proxies"""
+    _XMLRPC_proxies_lock.acquire()
+    try:
+        for server_proxy in _XMLRPC_proxies.values():
+            server_proxy('close')()
+        _XMLRPC_proxies.clear()
+    finally:
+        _XMLRPC_proxies_lock.release()
+
+
+def XMLRPC_multicall(server_proxy, calls):
+    """Make several XMLRPC calls in one system.multicall request.
+        calls = list of (name, arg, ...)
+        Return the list of results.
+        Raise xmlrpclib.Fault if one of the calls failed.
+    """
+    if isinstance(server_proxy, LocalRPCProxy):
+        return server_proxy._call_many(calls)
+    multicall = xmlrpclib.MultiCall(server_proxy)
+    for c in calls:
+        getattr(multicall, c[0])(*c[1:])
+    return list(multicall())
+
+
 def round_datetime_to_sec(dt):
     """Round a datetime to the nearest second.
         Return [rounded_dt, adj_usecs].